@@ -22,11 +22,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import CrawlerDatabase
+import Database
+import ExtractionSpec
 import Keys
 import ParseModule
 import argparse
-import itertools
 import requests
 import sys
 import time
@@ -39,6 +39,9 @@ YIELD_SIZE_KEY = 'yield size'
 GRAINS_KEY = 'grains'
 HOPS_KEY = 'hops'
 YEASTS_KEY = 'yeasts'
+INGREDIENTS_KEY = 'ingredients'
+RECIPE_FIELDS = [Keys.URL_KEY, TITLE_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+HOST = 'beerrecipes.org'
 
 # Import things so that they have the same name regardless of whether we are using python2 or python3.
 if sys.version_info[0] < 3:
@@ -46,11 +49,13 @@ if sys.version_info[0] < 3:
 else:
     import urllib.parse as urlparse
 
-# Handle another python2/3 difference.
-if sys.version_info[0] < 3:
-    zip_func = itertools.izip
-else:
-    zip_func = zip
+# Where to find each part of the recipe.
+RECIPE_SPEC = ExtractionSpec.ExtractionSpec([
+    ExtractionSpec.Text(TITLE_KEY, "h1[itemprop=name]"),
+    ExtractionSpec.TextList(INGREDIENTS_KEY, "span[itemprop=ingredients]", required=False),
+    ExtractionSpec.Text(YIELD_SIZE_KEY, "span[itemprop=recipeYield]", required=False),
+    ExtractionSpec.TextAfter(STYLE_KEY, "p", "Beer Style:", required=False),
+])
 
 # Factory function.
 def create():
@@ -59,6 +64,8 @@ def create():
 class BR(ParseModule.ParseModule):
     """Module for parsing web pages from beerrecipes.org."""
 
+    VERSION = 1 # Bump whenever a change alters what parse returns
+
     def __init__(self):
         """Constructor."""
         ParseModule.ParseModule.__init__(self)
@@ -67,35 +74,36 @@ class BR(ParseModule.ParseModule):
         """Builds the cookies dictionary that will be passed with the HTTP GET requests."""
         return None
 
+    def get_hosts(self):
+        """Returns the hostnames whose pages the module parses."""
+        return [HOST]
+
+    def get_namespace(self):
+        """Recipes are stored at the top level of the page document, which is where RecipeWriter looks for them."""
+        return None
+
     def is_interesting_url(self, url):
         """Returns TRUE if this URL is something this class can parse. Returns FALSE otherwise."""
         parsed = urlparse.urlparse(url)
-        return parsed.netloc.find("beerrecipes.org") >= 0
+        return parsed.netloc.find(HOST) >= 0
+
+    def relevant_fragments(self, url, soup):
+        """Returns the list of tags, from the page, that are worth keeping when only storing fragments of the page source."""
+        return RECIPE_SPEC.fragments(soup)
 
     def parse(self, url, soup):
         """Parses the contents downloaded from the URL, extracts the recipe, and stores it in the database."""
+        """The crawler only passes pages that is_interesting_url accepted."""
 
-        # Ignore links from other sites.
-        if not self.is_interesting_url(url):
-            print("Invalid network location for this module: " + url)
+        recipe = RECIPE_SPEC.extract(soup)
+        if recipe is None:
             return None
 
-        recipe = {}
+        # The ingredients are all in one list, so sort them out.
         fermentables = []
         hops = []
         yeasts = []
-
-        # Find the title.
-        brew_name = soup.find("h1", {"itemprop": "name"})
-        if brew_name is None:
-            print("Failed to find the brew name.")
-            return None
-        recipe[TITLE_KEY] = brew_name.get_text().strip()
-
-        # Find and parse the ingredients.
-        ingredient_items = soup.find_all("span", {"itemprop": "ingredients"})
-        for ingredient_item in ingredient_items:
-            item_text = ingredient_item.get_text().strip()
+        for item_text in recipe.pop(INGREDIENTS_KEY):
             if item_text.find("minutes") > 0 or item_text.find("flameout") > 0 or item_text.find("knockout") > 0 or item_text.find("end of boil") > 0 or item_text.find("dry hop") > 0:
                 hops.append(item_text)
             elif item_text.find("pack") > 0 or item_text.find("yeast") > 0:
@@ -106,20 +114,6 @@ class BR(ParseModule.ParseModule):
         recipe[HOPS_KEY] = hops
         recipe[YEASTS_KEY] = yeasts
 
-        # Find the yield.
-        yield_item = soup.find("span", {"itemprop": "recipeYield"})
-        if yield_item:
-            recipe[YIELD_SIZE_KEY] = yield_item.get_text().strip()
-
-        # Find the style.
-        paragraphs = soup.find_all("p")
-        for paragraph in paragraphs:
-            paragraph_text = paragraph.get_text()
-            style_offset = paragraph_text.find("Beer Style:")
-            if style_offset > 0:
-                newline_offset = paragraph_text.find("\n", style_offset)
-                recipe[STYLE_KEY] = paragraph_text[style_offset+len("Beer Style:"):newline_offset].strip()
-
         # Return the recipe so it can be stored in the database.
         return recipe
 
@@ -132,13 +126,14 @@ def main():
     parser.add_argument("--dump", action="store_true", default=False, help="Dumps recipes to stdout.", required=False)
     parser.add_argument("--style", default="", help="Style of beers to dump.", required=False)
     parser.add_argument("--mongodb-addr", default="localhost:27017", help="Address of the mongo database.", required=False)
+    parser.add_argument("--db", default=None, help="URI of the database (mongodb://host:port or sqlite:///path/to/file.db). Overrides --mongodb-addr.", required=False)
     args = parser.parse_args()
 
     # Instantiate the object that connects to the database.
     db = None
-    if args.mongodb_addr is not None:
-        db = CrawlerDatabase.MongoDatabase()
-        db.connect(args.mongodb_addr)
+    db_uri = args.db if args.db else args.mongodb_addr
+    if db_uri is not None:
+        db = Database.open_database(db_uri)
 
     # This option exists for testing by allowing the user to give a URL directly to the parser.
     if args.url:
@@ -158,16 +153,13 @@ def main():
         if db is None:
             print("ERROR: No database.")
 
-        parser = BR()
-        all_pages = db.retrieve_all_pages()
+        # Let the database do the filtering and only send the recipe fields.
+        style = None
+        if len(args.style) > 0:
+            style = args.style
+        all_pages = db.query_pages(host=HOST, style=style, has_fields=[TITLE_KEY], fields=RECIPE_FIELDS)
         for page in all_pages:
-            if Keys.URL_KEY in page and parser.is_interesting_url(page[Keys.URL_KEY]):
-                if TITLE_KEY in page:
-                    if len(args.style) > 0:
-                        if STYLE_KEY in page and page[STYLE_KEY].lower().find(args.style.lower()) != -1:
-                            print(page)
-                    else:
-                        print(page)
+            print(page)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Writes pages to the database on a background thread so that storage overlaps with fetching"""
+
+import logging
+import sys
+import threading
+import time
+import traceback
+
+# Import things so that they have the same name regardless of whether we are using python2 or python3.
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+DEFAULT_QUEUE_SIZE = 1000
+PUT_TIMEOUT_SECS = 1.0 # How often a blocked producer checks that the writer thread is still running
+
+class BackgroundWriter(object):
+    """Owns a database connection on its own thread and writes the pages it is given, in batches."""
+
+    def __init__(self, open_db_func, max_queue_size=DEFAULT_QUEUE_SIZE):
+        """Constructor. open_db_func is called on the writer thread to create the connection that the writer owns."""
+        super(BackgroundWriter, self).__init__()
+        self.open_db_func = open_db_func
+        self.queue = queue.Queue(max_queue_size) # Bounded, so a slow database slows the crawl instead of using unbounded memory
+        self.db = None
+        self.num_written = 0 # Pages that were handed to the database successfully
+        self.oldest_unflushed_time = None # When the oldest write that hasn't reached the database was queued
+        self.connected = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.connected.wait()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def put(self, item):
+        """Queues the item, blocking while the queue is full. Returns FALSE if the writer thread has stopped."""
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT_SECS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def store_page(self, url, last_visit_time, raw_content, extracted_content):
+        """Queues the page to be written. Blocks if the queue is full."""
+        if self.db is None:
+            return False
+        return self.put((time.time(), url, last_visit_time, raw_content, extracted_content))
+
+    def get_queue_depth(self):
+        """Returns the number of pages waiting to be handed to the database."""
+        return self.queue.qsize()
+
+    def get_lag(self):
+        """Returns the number of seconds that the oldest write which hasn't reached the database has been waiting."""
+        oldest = self.oldest_unflushed_time
+        if oldest is None:
+            return 0.0
+        return time.time() - oldest
+
+    def status_str(self):
+        """Returns a human readable summary of the writer's state."""
+        return "Database writer: " + str(self.get_queue_depth()) + " queued, {:.2f}".format(self.get_lag()) + " second(s) behind, " + str(self.num_written) + " written."
+
+    def flush(self):
+        """Flushes the database's buffered writes. Only called on the writer thread."""
+        try:
+            if not self.db.flush_page_writes():
+                self.log_error("ERROR: Failed to flush page writes to the database.")
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+
+        # Writes that failed stay in the buffer, to be retried.
+        if len(self.db.pending_writes) == 0:
+            self.oldest_unflushed_time = None
+
+    def run(self):
+        """Thread function."""
+        try:
+            self.db = self.open_db_func()
+        finally:
+            self.connected.set()
+        if self.db is None:
+            self.log_error("ERROR: The database writer could not connect to the database.")
+            return
+
+        while True:
+
+            # Wait for something to write, but not longer than the database's flush window.
+            try:
+                item = self.queue.get(timeout=self.db.write_flush_secs)
+            except queue.Empty:
+                if self.oldest_unflushed_time is not None:
+                    self.flush()
+                continue
+
+            # None means we're shutting down.
+            if item is None:
+                self.flush()
+                return
+
+            # Writes to the same URL are coalesced by the database's write buffer, which also decides when to flush.
+            queued_time, url, last_visit_time, raw_content, extracted_content = item
+            if self.oldest_unflushed_time is None:
+                self.oldest_unflushed_time = queued_time
+            try:
+                if self.db.store_page(url, last_visit_time, raw_content, extracted_content):
+                    self.num_written = self.num_written + 1
+                else:
+                    self.log_error("ERROR: Failed to store " + url + " in the database...")
+
+                # If that triggered a flush then nothing is waiting anymore.
+                if len(self.db.pending_writes) == 0:
+                    self.oldest_unflushed_time = None
+            except:
+                self.log_error(traceback.format_exc())
+                self.log_error(sys.exc_info()[0])
+
+    def close(self):
+        """Writes everything that's queued and stops the thread."""
+        if self.put(None):
+            self.thread.join()
+        return True
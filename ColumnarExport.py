@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Writes and reads sets of tables, each a dictionary of equal length NumPy column arrays, in columnar file formats"""
+
+# Formats:
+#   npy     - A directory with a <table>.<column>.npy file per column. Can be memory mapped.
+#   npz     - A single, uncompressed, .npz file with a <table>.<column> member per column.
+#   arrow   - A directory with a <table>.arrow (Arrow IPC) file per table. Can be memory mapped. Needs pyarrow.
+#   parquet - A directory with a <table>.parquet file per table. Needs pyarrow.
+
+import os
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+FORMAT_NPY = 'npy'
+FORMAT_NPZ = 'npz'
+FORMAT_ARROW = 'arrow'
+FORMAT_PARQUET = 'parquet'
+FORMATS = [FORMAT_NPY, FORMAT_NPZ, FORMAT_ARROW, FORMAT_PARQUET]
+
+def write_tables(tables, path, file_format):
+    """Writes the tables, which map each table name to a dictionary of column name to NumPy array."""
+    if file_format in [FORMAT_ARROW, FORMAT_PARQUET] and not HAVE_PYARROW:
+        raise ValueError("The " + file_format + " format needs pyarrow.")
+
+    if file_format == FORMAT_NPZ:
+        columns = {}
+        for table_name, table in tables.items():
+            for column_name, column in table.items():
+                columns[table_name + "." + column_name] = column
+        with open(path, 'wb') as f:
+            np.savez(f, **columns)
+        return
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for table_name, table in tables.items():
+        if file_format == FORMAT_NPY:
+            for column_name, column in table.items():
+                np.save(os.path.join(path, table_name + "." + column_name + ".npy"), column, allow_pickle=False)
+        elif file_format == FORMAT_ARROW:
+            pyarrow.feather.write_feather(pyarrow.table(table), os.path.join(path, table_name + ".arrow"), compression='uncompressed')
+        elif file_format == FORMAT_PARQUET:
+            pyarrow.parquet.write_table(pyarrow.table(table), os.path.join(path, table_name + ".parquet"))
+        else:
+            raise ValueError("Unknown format: " + file_format)
+
+def read_tables(path, file_format, mmap=True):
+    """Inverse of write_tables. Columns are memory mapped where the format allows it, unless mmap is FALSE."""
+    tables = {}
+    if file_format == FORMAT_NPZ:
+        with np.load(path, allow_pickle=False) as columns:
+            for name in columns.files:
+                table_name, column_name = name.split('.', 1)
+                tables.setdefault(table_name, {})[column_name] = columns[name]
+        return tables
+
+    for file_name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, file_name)
+        if file_format == FORMAT_NPY and file_name.endswith(".npy"):
+            table_name, column_name = file_name[:-len(".npy")].split('.', 1)
+            tables.setdefault(table_name, {})[column_name] = np.load(full_path, mmap_mode='r' if mmap else None, allow_pickle=False)
+        elif file_format == FORMAT_ARROW and file_name.endswith(".arrow"):
+            table = pyarrow.feather.read_table(full_path, memory_map=mmap)
+            tables[file_name[:-len(".arrow")]] = dict((name, table.column(name).to_numpy()) for name in table.column_names)
+        elif file_format == FORMAT_PARQUET and file_name.endswith(".parquet"):
+            table = pyarrow.parquet.read_table(full_path, memory_map=mmap)
+            tables[file_name[:-len(".parquet")]] = dict((name, table.column(name).to_numpy()) for name in table.column_names)
+    return tables
@@ -23,20 +23,34 @@
 # SOFTWARE.
 
 import argparse
+import gzip
+import io
 import logging
 import os
+import re
 import requests
 import signal
 import sys
 import time
 import traceback
 import urllib
-from bs4 import BeautifulSoup
 from url_normalize import url_normalize
-import CrawlerDatabase
+import BackgroundWriter
+import Database
+import DnsCache
+import ExtractionCache
 import Keys
+import ModuleSandbox
+import PageStore
+import StyleCanonicalizer
 
 ERROR_LOG = 'error.log'
+SEED_BATCH_SIZE = 1000 # Number of seed URLs to read from a file before deduplicating them and crawling them
+MAX_VISIT_TIMES = 100000 # Number of recent visits (and failures) to remember, in case they haven't been written to the database yet
+GZIP_MAGIC = b'\x1f\x8b'
+HREF_RE = re.compile(r'href\s*=\s*["\']?([^"\'\s>]+)', re.IGNORECASE)
+LINKS_MODULE_NAME = '_links' # The harvested links are cached as if they came from a module of their own
+LINKS_MODULE_VERSION = 1
 
 g_crawler = None # Allows us to get the main object from the signal handler
 
@@ -63,10 +77,13 @@ def signal_handler(signal, frame):
 def create_website_object(module_name):
     """Load the module that implements website-specific logic and instantiates an object of the class that does the work."""
     if module_name and os.path.isfile(module_name):
+
+        # Each module gets its own name so that loading one doesn't replace the globals of another.
+        name = "website_module_" + os.path.splitext(os.path.basename(module_name))[0]
         if sys.version_info[0] < 3:
-            module = imp.load_source("", module_name)
+            module = imp.load_source(name, module_name)
         else:
-            module = mymodule = SourceFileLoader('modname', module_name).load_module()
+            module = SourceFileLoader(name, module_name).load_module()
         return module.create()
     return None
 
@@ -76,14 +93,61 @@ def get_url_root(url):
         return p.hostname
     return p.path
 
+def canonicalize_url(parent_url, child_url):
+    """Resolves the child URL against its parent and normalizes it so that the same page always has the same URL."""
+    url = urljoin(parent_url, child_url)
+    url = url_normalize(url)
+
+    # Drop any fragment.
+    parts = url.split('#')
+    return parts[0]
+
+def open_seed_file(file_name):
+    """Opens a seed file, which may be gzip compressed, for reading one line at a time."""
+    with open(file_name, 'rb') as f:
+        magic = f.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        raw = gzip.open(file_name, 'rb')
+    else:
+        raw = open(file_name, 'rb')
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+
+def read_seed_urls(file_name):
+    """Generator that streams URLs from either a plain-text list (one URL per line) or an HTML document."""
+    with open_seed_file(file_name) as f:
+        is_html = None
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            # Decide what kind of file this is from the first non-blank line.
+            if is_html is None:
+                is_html = line.startswith('<')
+
+            if is_html:
+                for href in HREF_RE.findall(line):
+                    yield href
+            elif not line.startswith('#'):
+                yield line
+
 class Crawler(object):
     """Class containing the URL handlers."""
 
-    def __init__(self, seed_url, rate_secs, website_objs, db, max_depth, min_revisit_secs, crawl_other_websites, verbose):
+    def __init__(self, seed_url, rate_secs, website_objs, db, max_depth, min_revisit_secs, crawl_other_websites, verbose, dns_cache=None, db_writer=None, module_sandbox=None):
         """Constructor."""
         self.seed_url = seed_url
         self.rate_secs = rate_secs
         self.website_objs = website_objs
+        self.modules_by_host = {} # Hostname -> indexes of the website modules that registered it
+        self.modules_any_host = [] # Indexes of the website modules that didn't register any hosts
+        for i, website_obj in enumerate(website_objs):
+            hosts = website_obj.get_hosts()
+            if hosts is None:
+                self.modules_any_host.append(i)
+            else:
+                for host in hosts:
+                    self.modules_by_host.setdefault(host.lower(), []).append(i)
         self.db = db
         self.max_depth = max_depth
         self.min_revisit_secs = min_revisit_secs
@@ -91,7 +155,15 @@ class Crawler(object):
         self.verbose = verbose
         self.running = True
         self.last_crawl_time = 0 # The timestamp of the last time we visited a URL.
-        self.error_urls = [] # These URLs are giving us problems, skip them.
+        self.error_urls = {} # URL -> time of the failure, for the URLs that are giving us problems, so we skip them. Only the most recent are kept.
+        self.page_fragments = None # The page source to store, when only storing fragments of the page
+        self.visit_times = {} # URL -> time of the pages we've visited during this run, which may not have been written to the database yet
+        self.seed_roots = set() # Roots of the seeds read from a file, links within them are inside the seed location too.
+        self.db_writer = db_writer # Optional, writes pages to the database on a background thread.
+        self.dns_cache = dns_cache # Optional, resolves hostnames ahead of time so that lookups are off the critical path.
+        self.session = requests.Session() # Reuses connections across requests to the same host.
+        self.module_sandbox = module_sandbox # Optional, runs the website modules in a separate process with time and memory limits.
+        self.module_stats = ModuleSandbox.ModuleStats() # How long each website module takes, and why it failed
         super(Crawler, self).__init__()
 
     def verbose_print(self, msg):
@@ -113,40 +185,221 @@ class Crawler(object):
         # Let the user know what's going on.
         self.verbose_print("Storing " + url + " in the database...")
 
-        # Update database.
-        page_from_db = self.db.retrieve_page(url)
+        # Update database. The write is buffered and flushed in bulk with other pages.
         now = time.time()
-        if page_from_db:
-            success = self.db.update_page(url, now, raw_content, extracted_content)
+        self.remember_visit_time(url, now)
+        if self.db_writer is not None:
+            success = self.db_writer.store_page(url, now, raw_content, extracted_content)
+            self.verbose_print(self.db_writer.status_str())
         else:
-            success = self.db.create_page(url, now, raw_content, extracted_content)
+            success = self.db.store_page(url, now, raw_content, extracted_content)
         if not success:
             self.log_error("ERROR: Failed to store " + url + " in the database...")
 
-    def parse_content(self, url, raw_content):
-        """Parses data that was read from either a file or URL."""
+    def remember_visit_time(self, url, visit_time):
+        """Remembers when we visited the URL, until the write has had time to reach the database. Only the most recent visits are kept."""
+        if len(self.visit_times) >= MAX_VISIT_TIMES:
+            recent = sorted(self.visit_times.items(), key=lambda item: item[1])[len(self.visit_times) // 2:]
+            self.visit_times = dict(recent)
+        self.visit_times[url] = visit_time
+
+    def remember_error_url(self, url):
+        """Remembers that the URL gave us problems, so that we don't go there again. Only the most recent failures are kept."""
+        if len(self.error_urls) >= MAX_VISIT_TIMES:
+            recent = sorted(self.error_urls.items(), key=lambda item: item[1])[len(self.error_urls) // 2:]
+            self.error_urls = dict(recent)
+        self.error_urls[url] = time.time()
+
+    def run_modules(self, url, raw_content, module_indexes, need_fragments, need_links):
+        """Parses the page and runs the given website modules on it, in the sandbox if there is one. See ModuleSandbox.run_modules."""
 
         # Let the user know what's going on.
         self.verbose_print("Parsing " + url + "...")
 
-        # Parse the page.
-        soup = BeautifulSoup(raw_content, 'html5lib')
+        if self.module_sandbox is not None:
+            entries, links, timings, failures = self.module_sandbox.run_modules(self.website_objs, url, raw_content, module_indexes, need_fragments, need_links)
+        else:
+            entries, links, timings, failures = ModuleSandbox.run_modules(self.website_objs, url, raw_content, module_indexes, need_fragments, need_links)
+        self.module_stats.record(url, timings, failures)
+        return entries, links
+
+    def route_url(self, url):
+        """Returns the indexes of the website modules that want to parse the URL. Only the modules registered for the URL's host,"""
+        """or one of its parent domains, and those that didn't register any hosts, are asked."""
+        host = Database.get_url_host(url).lower()
+        labels = host.split('.')
+        candidates = set(self.modules_any_host)
+        for i in range(len(labels) - 1):
+            candidates.update(self.modules_by_host.get('.'.join(labels[i:]), []))
+        return [i for i in sorted(candidates) if self.website_objs[i].is_interesting_url(url)]
+
+    def parse_content(self, url, raw_content, module_indexes=None):
+        """Parses data that was read from either a file or URL."""
+        """module_indexes are the website modules that the page was routed to, from route_url. If None then the page is routed here."""
+        if module_indexes is None:
+            module_indexes = self.route_url(url)
+
+        # Look up the results of any earlier parse of identical content, using a single query.
+        cache = self.db.extraction_cache if self.db is not None else None
+        need_fragments = self.db is not None and self.db.page_source_policy == PageStore.POLICY_FRAGMENTS
+        module_keys = {}
+        links_key = None
+        cached = {}
+        if cache is not None:
+            content_hash = PageStore.content_hash(raw_content)
+            for i in module_indexes:
+                module_keys[i] = ExtractionCache.make_key(content_hash, self.website_objs[i].get_name(), self.website_objs[i].get_version())
+            links_key = ExtractionCache.make_key(content_hash, LINKS_MODULE_NAME, LINKS_MODULE_VERSION)
+            cached = cache.get_many(list(module_keys.values()) + [links_key])
+
+        # Work out what wasn't cached.
+        entries = {}
+        for i in module_indexes:
+            entry = cached.get(module_keys[i]) if cache is not None else None
+            if entry is not None and (not need_fragments or entry.get(ModuleSandbox.FRAGMENTS_KEY) is not None):
+                entries[i] = entry
+        missing_indexes = [i for i in module_indexes if i not in entries]
+        need_links = links_key not in cached
+
+        # The page is only parsed if something wasn't cached. Results from modules that failed aren't cached, so they're retried next time.
+        urls_to_crawl = cached.get(links_key)
+        if len(missing_indexes) > 0 or need_links:
+            new_entries, links = self.run_modules(url, raw_content, missing_indexes, need_fragments, need_links)
+            for i, entry in new_entries.items():
+                entries[i] = entry
+                if cache is not None:
+                    website_obj = self.website_objs[i]
+                    cache.put(module_keys[i], website_obj.get_name(), website_obj.get_version(), entry)
+            if need_links:
+                urls_to_crawl = links
+                if links is not None and cache is not None:
+                    cache.put(links_key, LINKS_MODULE_NAME, LINKS_MODULE_VERSION, links)
+        if urls_to_crawl is None:
+            urls_to_crawl = []
+
+        # Merge the results of the website modules. Each module's results go under its namespace, if it has one, so they can't overwrite each other.
+        extracted_content = {}
+        fragments = []
+        for i in module_indexes:
+            entry = entries.get(i)
+            if entry is None:
+                continue
+            content = entry[ModuleSandbox.CONTENT_KEY]
+            if content:
+                namespace = self.website_objs[i].get_namespace()
+                if namespace is None:
+                    extracted_content.update(content)
+                else:
+                    extracted_content[namespace] = content
+
+            # If we're only storing the parts of the page that the modules care about then this is the time to collect them.
+            if need_fragments and len(entry[ModuleSandbox.FRAGMENTS_KEY]) > 0:
+                fragments.append(entry[ModuleSandbox.FRAGMENTS_KEY])
+        if need_fragments:
+            self.page_fragments = "\n".join(fragments)
+        if len(extracted_content) == 0:
+            extracted_content = None
+        return extracted_content, urls_to_crawl
 
-        # Let the website object extract whatever information it wants from the page.
-        extracted_content = None
+    def invalidate_extraction_cache(self):
+        """Discards the cached results of any version of a website module other than the one that is loaded."""
+        if self.db is None or self.db.extraction_cache is None:
+            return
         for website_obj in self.website_objs:
-            extracted_content = website_obj.parse(url, soup)
+            self.db.extraction_cache.invalidate(website_obj.get_name(), website_obj.get_version())
+        self.db.extraction_cache.invalidate(LINKS_MODULE_NAME, LINKS_MODULE_VERSION)
 
-        # Harvest any new URLs.
-        urls_to_crawl = []
-        for a in soup.find_all('a', href=True):
-            urls_to_crawl.append(a['href'])
-        urls_to_crawl = list(dict.fromkeys(urls_to_crawl)) # Remove duplicates
-        return extracted_content, urls_to_crawl
+    def reparse_stored_pages(self):
+        """Runs the website modules over the page source that is in the database, instead of downloading it again."""
+        """Pages whose content and module versions haven't changed come from the extraction cache."""
+        if self.db is None:
+            return
+        fields = [Keys.URL_KEY, Keys.PAGE_SOURCE_KEY, Keys.PAGE_SOURCE_REF_KEY]
+        num_reparsed = 0
+        for page in self.db.query_pages(fields=fields):
+            if not self.running:
+                break
+            url = page[Keys.URL_KEY]
+            module_indexes = self.route_url(url)
+            if len(module_indexes) == 0:
+                continue
+            raw_content = self.db.retrieve_page_source(page)
+            if raw_content is None:
+                continue
+            extracted_content, _ = self.parse_content(url, raw_content, module_indexes)
+            if extracted_content:
+                self.db.queue_page_write(url, extracted_content)
+            num_reparsed = num_reparsed + 1
+        self.db.flush_page_writes()
+        print("Reparsed " + str(num_reparsed) + " page(s).")
+
+    def prefetch_hostnames(self, parent_url, urls_to_crawl):
+        """Starts resolving the hostnames of the URLs we're about to visit."""
+        if self.dns_cache is None:
+            return
+        for new_url in urls_to_crawl:
+            p = urlparse.urlparse(urljoin(parent_url, new_url))
+            if p.scheme == 'https':
+                self.dns_cache.prefetch(p.hostname, 443 if p.port is None else p.port)
+            elif p.scheme == 'http':
+                self.dns_cache.prefetch(p.hostname, 80 if p.port is None else p.port)
+
+    def retrieve_known_metadata(self, urls):
+        """Looks up the metadata for all of the (canonical) URLs in one query, if we're going to need it for the revisit check."""
+        if self.db and self.min_revisit_secs and self.min_revisit_secs > 0 and len(urls) > 0:
+            return self.db.retrieve_pages_metadata(urls)
+        return None
+
+    def get_last_visit_time(self, url, known_metadata):
+        """Returns when we last visited the URL, or None if we never have. The metadata is from retrieve_known_metadata."""
+        """If the URL wasn't part of a batched lookup (known_metadata is None) then the database is queried directly."""
+        if url in self.visit_times:
+            return self.visit_times[url]
+        if known_metadata is None:
+            page_from_db = self.db.retrieve_page_metadata(url)
+        else:
+            page_from_db = known_metadata.get(url)
+        if page_from_db and Keys.LAST_VISIT_TIME_KEY in page_from_db:
+            return page_from_db[Keys.LAST_VISIT_TIME_KEY]
+        return None
+
+    def is_in_seed_location(self, url):
+        """Returns TRUE if the settings allow us to crawl the (canonical) URL."""
+        if self.crawl_other_websites:
+            return True
+        root_url = get_url_root(url)
+        return root_url == self.seed_url or root_url in self.seed_roots
+
+    def throttle(self):
+        """Sleeps, if necessary, to keep us from crawling faster than the configured rate."""
+        if self.rate_secs is not None and time.time() - self.last_crawl_time < self.rate_secs:
+            self.verbose_print("Sleeping for " + str(self.rate_secs) + " second(s).")
+            time.sleep(self.rate_secs)
 
     def visit_new_urls(self, parent_url, urls_to_crawl, current_depth):
         """Visits URLs that we haven't visited yet."""
 
+        # If the links are too deep then none of them will be crawled.
+        if self.max_depth is not None and current_depth + 1 >= self.max_depth:
+            self.verbose_print("Maximum crawl depth exceeded.")
+            return
+
+        # Only the links that are inside the seed location will be crawled.
+        canonical_urls = []
+        for new_url in urls_to_crawl:
+            try:
+                url = canonicalize_url(parent_url, new_url)
+            except:
+                continue
+            if self.is_in_seed_location(url):
+                canonical_urls.append(url)
+
+        # Resolve the hostnames in the background while we work through the list.
+        self.prefetch_hostnames("", canonical_urls)
+
+        # Look up when we last visited each of the URLs with a single query.
+        known_metadata = self.retrieve_known_metadata(canonical_urls)
+
         # Crawl all new URLs.
         for new_url in urls_to_crawl:
 
@@ -155,30 +408,80 @@ class Crawler(object):
                 return
 
             # Do we need to throttle ourselves?
-            if self.rate_secs is not None and time.time() - self.last_crawl_time < self.rate_secs:
-                self.verbose_print("Sleeping for " + str(self.rate_secs) + " second(s).")
-                time.sleep(self.rate_secs)
+            self.throttle()
 
             # Crawl the URL.
-            crawled = self.crawl_url(parent_url, new_url, current_depth + 1)
+            crawled = self.crawl_url(parent_url, new_url, current_depth + 1, known_metadata)
+
+    def filter_seed_batch(self, seed_urls):
+        """Removes seeds that are duplicates or that were visited too recently to revisit."""
+
+        # Canonicalize and remove duplicates, preserving the order from the file. Duplicates in earlier batches were visited
+        # recently, or are caught by the revisit check, so nothing else needs to be remembered between batches.
+        batch = []
+        batch_urls = set()
+        for seed_url in seed_urls:
+            try:
+                url = canonicalize_url("", seed_url)
+            except:
+                self.log_error("ERROR: Invalid seed URL " + seed_url + ".")
+                continue
+            if url not in batch_urls and url not in self.visit_times:
+                batch_urls.add(url)
+                batch.append(url)
+                self.seed_roots.add(get_url_root(url))
+
+        # Check the entire batch against the database in one query.
+        known_metadata = self.retrieve_known_metadata(batch)
+        if known_metadata is not None:
+            now = time.time()
+            fresh = []
+            for url in batch:
+                last_visit_time = self.get_last_visit_time(url, known_metadata)
+                if last_visit_time is not None and now - last_visit_time < self.min_revisit_secs:
+                    self.verbose_print("Skipping " + url + " because we visited it recently.")
+                else:
+                    fresh.append(url)
+            batch = fresh
+        return batch
+
+    def crawl_seed_batch(self, seed_urls):
+        """Deduplicates a batch of seed URLs and crawls whatever remains."""
+        batch = self.filter_seed_batch(seed_urls)
+        self.prefetch_hostnames("", batch)
+        for url in batch:
 
-    def crawl_file(self, file_name):
-        """Starts crawling from a file."""
+            # If the crawling has been cancelled.
+            if self.running is False:
+                return
 
-        # Open the file.
-        with open(file_name, 'r') as f:
+            # Do we need to throttle ourselves?
+            self.throttle()
 
-            # Read the entire contents of the file.
-            content = f.read()
+            # Crawl the URL. The seed is where the crawl starts so it is at depth zero.
+            self.crawl_url("", url, 0)
 
-            # Crawl the content.
-            extracted_content, urls_to_crawl = self.parse_content("", content)
+    def crawl_file(self, file_name):
+        """Starts crawling from a file. The file may be a plain-text list of URLs or an HTML document and may be gzip compressed."""
+        """The file is streamed, so crawling starts as soon as the first batch of URLs is read."""
+        seed_urls = []
+        for seed_url in read_seed_urls(file_name):
 
-            # Visit the fresh URLs.
-            self.visit_new_urls(url, urls_to_crawl, 0)
+            # If the crawling has been cancelled.
+            if self.running is False:
+                return
 
-    def crawl_url(self, parent_url, child_url, current_depth):
+            seed_urls.append(seed_url)
+            if len(seed_urls) >= SEED_BATCH_SIZE:
+                self.crawl_seed_batch(seed_urls)
+                seed_urls = []
+
+        # Crawl whatever is left over.
+        self.crawl_seed_batch(seed_urls)
+
+    def crawl_url(self, parent_url, child_url, current_depth, known_metadata=None):
         """Crawls, starting at the given URL, up to the maximum depth."""
+        """known_metadata is the result of a batched metadata lookup that includes this URL, if one was done."""
 
         # If we've exceeded the maximum depth.
         if self.max_depth is not None and current_depth >= self.max_depth:
@@ -186,19 +489,12 @@ class Crawler(object):
             return False
 
         # Canonicalize the URL.
-        url = urljoin(parent_url, child_url)
-        url = url_normalize(url)
-
-        # Drop any query parameters.
-        parts = url.split('#')
-        url = parts[0]
+        url = canonicalize_url(parent_url, child_url)
 
         # Is this URL from the seed website? Do we care?
-        if not self.crawl_other_websites:
-            root_url = get_url_root(url)
-            if root_url != self.seed_url:
-                self.verbose_print("Skipping " + url + " because the settings do not allow us to crawl links outside of the seed location.")
-                return False
+        if not self.is_in_seed_location(url):
+            self.verbose_print("Skipping " + url + " because the settings do not allow us to crawl links outside of the seed location.")
+            return False
 
         # If this URL has given us problems then skip it.
         if url in self.error_urls:
@@ -208,28 +504,25 @@ class Crawler(object):
         # Only proceed if we have a module that can parse this URL (though proceed if we don't have any modules loaded).
         # Also, if we have a module that can parse it, see if it has any cookies it wants to add to the request.
         cookies = None
+        module_indexes = []
         if len(self.website_objs) > 0:
-            interesting = False
-            for website_obj in self.website_objs:
-                interesting = website_obj.is_interesting_url(url)
-                if interesting:
-                    cookies = website_obj.make_cookies(url)
-                    break
-            if not interesting:
+            module_indexes = self.route_url(url)
+            if len(module_indexes) == 0:
                 self.verbose_print("Skipping " + url + " because there are no modules to parse it.")
                 return False
+            cookies = self.website_objs[module_indexes[0]].make_cookies(url)
 
         # If we've been here before and it was within our revisit window then just skip.
         # Don't bother doing this check for the first URL, since it'll be the one the user told us to crawl.
         if current_depth > 0 and self.db and self.min_revisit_secs and self.min_revisit_secs > 0:
 
-            # Get the database record corresonding to this URL.
-            page_from_db = self.db.retrieve_page(url)
-            if page_from_db and Keys.LAST_VISIT_TIME_KEY in page_from_db:
+            # Find out when we were last here, this only needs the metadata and not the entire page.
+            last_visit_time = self.get_last_visit_time(url, known_metadata)
+            if last_visit_time is not None:
 
                 # How long since we were last here?
                 now = time.time()
-                last_visited_diff = now - page_from_db[Keys.LAST_VISIT_TIME_KEY]
+                last_visited_diff = now - last_visit_time
                 if last_visited_diff < self.min_revisit_secs:
                     last_visited_units = "second"
                     if last_visited_diff >= 86400:
@@ -248,16 +541,19 @@ class Crawler(object):
 
             # Download the page from the URL.
             self.verbose_print("Requesting data from " + url + "...")
-            response = requests.get(url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
+            response = self.session.get(url, cookies=cookies, headers={'User-Agent': 'Mozilla/5.0'})
 
             # If downloaded....
             if response.status_code == 200:
 
                 # Process the content. Anything the parsing module wants stored will be returned in the blob.
-                extracted_content, urls_to_crawl = self.parse_content(url, response.content)
+                extracted_content, urls_to_crawl = self.parse_content(url, response.content, module_indexes)
 
                 # Note that we visited this webpage.
-                self.create_or_update_database(url, response.content, extracted_content)
+                raw_content = response.content
+                if self.db is not None and self.db.page_source_policy == PageStore.POLICY_FRAGMENTS:
+                    raw_content = self.page_fragments
+                self.create_or_update_database(url, raw_content, extracted_content)
 
                 # Make a note of the time.
                 self.last_crawl_time = time.time()
@@ -271,7 +567,11 @@ class Crawler(object):
             else:
 
                 # Make sure we don't go here again.
-                self.error_urls.append(url)
+                self.remember_error_url(url)
+
+                # If the page is gone then it shouldn't be in the database either.
+                if response.status_code in [404, 410] and self.db is not None:
+                    self.db.delete_page(url, time.time())
 
                 # Print an error.
                 self.log_error("ERROR: Received HTTP Code " + str(response.status_code) + ".")
@@ -279,7 +579,7 @@ class Crawler(object):
         except:
 
             # Make sure we don't go here again.
-            self.error_urls.append(url)
+            self.remember_error_url(url)
 
             # Log an error.
             self.log_error(traceback.format_exc())
@@ -296,13 +596,28 @@ def main():
 
     # Parse command line options.
     parser = argparse.ArgumentParser()
-    parser.add_argument("--file", default="", help="File to crawl.", required=False)
+    parser.add_argument("--file", default="", help="File of seed URLs to crawl, either a list of URLs (one per line) or HTML, optionally gzip compressed.", required=False)
     parser.add_argument("--url", default="", help="URL to crawl.", required=False)
     parser.add_argument("--rate", type=int, default=1, help="Rate, in seconds, at which to crawl.", required=False)
     parser.add_argument("--max-depth", type=int, default=None, help="Maximum crawl depth.", required=False)
     parser.add_argument("--min-revisit-secs", type=int, default=86400, help="Minimum number of seconds before allowing a URL to be revisited.", required=False)
     parser.add_argument("--website-modules", default="", help="Python modules that implement website-specific logic.", required=False)
     parser.add_argument("--mongodb-addr", default="localhost:27017", help="Address of the mongo database.", required=False)
+    parser.add_argument("--db", default=None, help="URI of the database (mongodb://host:port or sqlite:///path/to/file.db). Overrides --mongodb-addr.", required=False)
+    parser.add_argument("--db-batch-size", type=int, default=Database.DEFAULT_WRITE_BATCH_SIZE, help="Number of page writes to buffer before flushing them to the database.", required=False)
+    parser.add_argument("--db-flush-secs", type=float, default=Database.DEFAULT_WRITE_FLUSH_SECS, help="Maximum number of seconds to buffer page writes before flushing them to the database.", required=False)
+    parser.add_argument("--db-queue-size", type=int, default=BackgroundWriter.DEFAULT_QUEUE_SIZE, help="Number of pages that can be waiting for the background database writer, zero writes pages synchronously.", required=False)
+    parser.add_argument("--page-source", default=PageStore.POLICY_STORE, choices=PageStore.POLICIES, help="How to store page source: inline in the page document, compressed in the page store, only the fragments the modules care about, or not at all.", required=False)
+    parser.add_argument("--page-store-dir", default=None, help="Directory in which to store compressed page source. If not set, page source is stored in the database.", required=False)
+    parser.add_argument("--keep-history", action="store_true", default=False, help="Keeps the previous versions of each page, stored as compressed deltas.", required=False)
+    parser.add_argument("--keep-versions", type=int, default=None, help="With --keep-history, the number of versions of each page to keep.", required=False)
+    parser.add_argument("--max-version-age-secs", type=int, default=None, help="With --keep-history, the maximum age, in seconds, of the versions to keep.", required=False)
+    parser.add_argument("--dns-cache-ttl", type=int, default=DnsCache.DEFAULT_TTL_SECS, help="Maximum number of seconds to cache DNS lookups, zero disables the cache.", required=False)
+    parser.add_argument("--isolate-modules", action="store_true", default=False, help="Runs the website modules in a separate process, which is killed when a page exceeds the time or memory limit.", required=False)
+    parser.add_argument("--module-timeout-secs", type=float, default=ModuleSandbox.DEFAULT_TIMEOUT_SECS, help="With --isolate-modules, the maximum number of seconds to spend extracting data from a page.", required=False)
+    parser.add_argument("--module-memory-mb", type=int, default=ModuleSandbox.DEFAULT_MEMORY_LIMIT_MB, help="With --isolate-modules, the maximum amount of memory, in megabytes, that the modules can use.", required=False)
+    parser.add_argument("--reparse", action="store_true", default=False, help="Runs the website modules over the page source that is stored in the database instead of crawling.", required=False)
+    parser.add_argument("--style-stats", action="store_true", default=False, help="Keeps the per style recipe statistics (see RecipeWriter) up to date as recipes are stored.", required=False)
     parser.add_argument("--crawl-other-websites", action="store_true", default=False, help="If not set will stay on links that belong to the seed URL.", required=False)
     parser.add_argument("--verbose", action="store_true", default=False, help="Enables verbose output.", required=False)
 
@@ -320,16 +635,31 @@ def main():
     print("")
 
     # Sanity check.
-    if len(args.file) == 0 and len(args.url) == 0:
+    if len(args.file) == 0 and len(args.url) == 0 and not args.reparse:
         print("Neither a file nor a URL to crawl was specified.")
         parser.print_help(sys.stderr)
         sys.exit(1)
 
     # Instantiate the object that connects to the database.
-    db = None
-    if args.mongodb_addr is not None:
-        db = CrawlerDatabase.MongoDatabase()
-        db.connect(args.mongodb_addr)
+    db_uri = args.db if args.db else args.mongodb_addr
+    style_canonicalizer = StyleCanonicalizer.load_canonicalizer(StyleCanonicalizer.DEFAULT_STYLE_RULES_FILE)
+    def open_db():
+        if db_uri is None:
+            return None
+        db = Database.open_database(db_uri)
+        if db is not None:
+            db.set_write_batching(args.db_batch_size, args.db_flush_secs)
+            page_store = None
+            if args.page_store_dir is not None:
+                page_store = PageStore.FilePageStore(args.page_store_dir)
+            db.set_page_source_policy(args.page_source, page_store)
+            db.set_keep_history(args.keep_history)
+            db.set_style_canonicalizer(style_canonicalizer)
+            if args.style_stats and db.style_stats is not None:
+                import RecipeWriter
+                db.add_page_observer(RecipeWriter.StyleStatsObserver(RecipeWriter.RecipeWriter(), db.style_stats))
+        return db
+    db = open_db()
 
     # Instantiate the object that implements website-specific logic.
     website_objs = []
@@ -339,12 +669,33 @@ def main():
             website_obj = create_website_object(website_module_name)
             website_objs.append(website_obj)
 
+    # Instantiate the process that runs the website modules, if they are to be isolated. It's started now so that loading the modules isn't counted against the first page.
+    module_sandbox = None
+    if args.isolate_modules and len(website_objs) > 0:
+        module_sandbox = ModuleSandbox.ModuleSandbox(website_module_names, args.module_timeout_secs, args.module_memory_mb)
+        if not module_sandbox.start():
+            print("Failed to start the process that runs the website modules.")
+            sys.exit(1)
+
+    # Instantiate the object that writes to the database in the background. It has its own connection.
+    db_writer = None
+    if db is not None and args.db_queue_size > 0:
+        db_writer = BackgroundWriter.BackgroundWriter(open_db, args.db_queue_size)
+        if db_writer.db is None:
+            db_writer = None
+
+    # Instantiate the DNS cache.
+    dns_cache = None
+    if args.dns_cache_ttl > 0:
+        dns_cache = DnsCache.DnsCache(args.dns_cache_ttl)
+        dns_cache.install()
+
     seed_url = ""
     if len(args.url) > 0:
         seed_url = get_url_root(args.url)
 
     # Instantiate the object that does the crawling.
-    g_crawler = Crawler(seed_url, args.rate, website_objs, db, args.max_depth, args.min_revisit_secs, args.crawl_other_websites, args.verbose)
+    g_crawler = Crawler(seed_url, args.rate, website_objs, db, args.max_depth, args.min_revisit_secs, args.crawl_other_websites, args.verbose, dns_cache, db_writer, module_sandbox)
 
     # Register the signal handler.
     signal.signal(signal.SIGINT, signal_handler)
@@ -352,6 +703,13 @@ def main():
     # Configure the error logger.
     logging.basicConfig(filename=ERROR_LOG, filemode='w', level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
 
+    # Cached results from older versions of the website modules are no longer any use.
+    g_crawler.invalidate_extraction_cache()
+
+    # Reparse the pages that we already have.
+    if args.reparse:
+        g_crawler.reparse_stored_pages()
+
     # Crawl a file.
     if len(args.file) > 0:
         g_crawler.crawl_file(args.file)
@@ -360,5 +718,23 @@ def main():
     if len(args.url) > 0:
         g_crawler.crawl_url("", args.url, 0)
 
+    # Report how the website modules did.
+    if module_sandbox is not None:
+        module_sandbox.close()
+    if len(website_objs) > 0:
+        print("Website modules:")
+        print(g_crawler.module_stats.report_str())
+
+    # Write anything that is still queued or buffered. This also happens after an interrupt.
+    if db_writer is not None:
+        print("Waiting for " + str(db_writer.get_queue_depth()) + " page(s) to be written...")
+        db_writer.close()
+    if db is not None:
+        db.close()
+
+        # Apply the version retention policy.
+        if args.keep_history and (args.keep_versions is not None or args.max_version_age_secs is not None):
+            db.page_history.compact(args.keep_versions, args.max_version_age_secs)
+
 if __name__ == "__main__":
     main()
@@ -23,13 +23,206 @@
 # SOFTWARE.
 """Database implementation"""
 
+import re
 import sys
+import time
 import traceback
 import uuid
 from bson.objectid import ObjectId
 import pymongo
+import pymongo.errors
 import Database
+import ExtractionCache
 import Keys
+import PageHistory
+import PageStore
+import StyleStats
+
+SCHEMA_VERSION = 4 # Increment this, and add a migration, whenever the layout of the pages collection changes
+SCHEMA_DOC_ID = 'pages'
+RETRYABLE_WRITE_ERROR_CODES = [11000] # Duplicate key, when two upserts of the same new page race, other write errors are in the page itself
+METADATA_PROJECTION = { '_id': False, Keys.URL_KEY: True, Keys.HOST_KEY: True, Keys.LAST_VISIT_TIME_KEY: True, Keys.PAGE_SOURCE_REF_KEY: True }
+
+class MongoPageStore(PageStore.PageStore):
+    """Stores each page source as a compressed document in its own collection, keyed by its hash."""
+    """Writes are buffered and flushed in bulk along with the page writes."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.pending = {}
+        PageStore.PageStore.__init__(self)
+
+    def put(self, raw_content):
+        ref = PageStore.content_hash(raw_content)
+        if ref not in self.pending:
+            self.pending[ref] = PageStore.compress(raw_content)
+        return ref
+
+    def get(self, ref):
+        if ref in self.pending:
+            codec, data = self.pending[ref]
+            return PageStore.decompress(codec, data)
+        try:
+            doc = self.collection.find_one({'_id': ref})
+            if doc is not None:
+                return PageStore.decompress(doc['codec'], doc['data'])
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return True
+        try:
+            # Identical content is only ever inserted once.
+            operations = [pymongo.UpdateOne({'_id': ref}, {'$setOnInsert': {'codec': codec, 'data': data}}, upsert=True) for ref, (codec, data) in self.pending.items()]
+            self.collection.bulk_write(operations, ordered=False)
+            self.pending = {}
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class MongoPageHistory(PageHistory.PageHistory):
+    """Stores page versions as documents in their own collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        PageHistory.PageHistory.__init__(self)
+
+    def load_latest_versions(self, urls):
+        latest = {}
+        for doc in self.collection.find({Keys.URL_KEY: {'$in': urls}, PageHistory.IS_FULL_KEY: True}):
+            latest[doc[Keys.URL_KEY]] = (doc['_id'], doc[PageHistory.DATA_KEY])
+        return latest
+
+    def load_versions(self, url):
+        versions = []
+        for doc in self.collection.find({Keys.URL_KEY: url}).sort(PageHistory.VERSION_TIME_KEY, pymongo.DESCENDING):
+            versions.append((doc[PageHistory.VERSION_TIME_KEY], doc[PageHistory.IS_FULL_KEY], doc[PageHistory.DATA_KEY]))
+        return versions
+
+    def save_versions(self, new_versions, replaced_versions):
+        try:
+            # Replace the old full versions first so that there's never more than one full version of a page.
+            operations = [pymongo.UpdateOne({'_id': version_id}, {'$set': {PageHistory.IS_FULL_KEY: False, PageHistory.DATA_KEY: delta}}) for version_id, delta in replaced_versions]
+            operations.extend([pymongo.InsertOne({Keys.URL_KEY: url, PageHistory.VERSION_TIME_KEY: version_time, PageHistory.IS_FULL_KEY: True, PageHistory.DATA_KEY: data}) for url, version_time, data in new_versions])
+            if len(operations) > 0:
+                self.collection.bulk_write(operations, ordered=True)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def compact(self, max_versions, max_age_secs):
+        try:
+            # Old versions (but never the newest, which is the full version).
+            if max_age_secs is not None:
+                cutoff = time.time() - max_age_secs
+                self.collection.delete_many({PageHistory.VERSION_TIME_KEY: {'$lt': cutoff}, PageHistory.IS_FULL_KEY: False})
+
+            # Pages with too many versions.
+            if max_versions is not None:
+                pipeline = [
+                    { '$sort': { PageHistory.VERSION_TIME_KEY: -1 } },
+                    { '$group': { '_id': '$' + Keys.URL_KEY, 'ids': { '$push': '$_id' }, 'count': { '$sum': 1 } } },
+                    { '$match': { 'count': { '$gt': max(max_versions, 1) } } }
+                ]
+                operations = []
+                for group in self.collection.aggregate(pipeline, allowDiskUse=True):
+                    operations.append(pymongo.DeleteMany({'_id': {'$in': group['ids'][max(max_versions, 1):]}}))
+                if len(operations) > 0:
+                    self.collection.bulk_write(operations, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class MongoExtractionCache(ExtractionCache.ExtractionCache):
+    """Stores extraction results as documents in their own collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        ExtractionCache.ExtractionCache.__init__(self)
+
+    def load(self, keys):
+        values = {}
+        try:
+            for doc in self.collection.find({'_id': {'$in': keys}}, {ExtractionCache.RESULT_KEY: True}):
+                values[doc['_id']] = doc[ExtractionCache.RESULT_KEY]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return values
+
+    def save(self, entries):
+        try:
+            operations = [pymongo.ReplaceOne({'_id': key}, {ExtractionCache.MODULE_KEY: module_name, ExtractionCache.VERSION_KEY: module_version, ExtractionCache.RESULT_KEY: value}, upsert=True) for key, module_name, module_version, value in entries]
+            self.collection.bulk_write(operations, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def invalidate(self, module_name, current_version):
+        try:
+            self.collection.delete_many({ExtractionCache.MODULE_KEY: module_name, ExtractionCache.VERSION_KEY: {'$ne': current_version}})
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class MongoStyleStats(StyleStats.StyleStats):
+    """Stores the per style ingredient statistics as documents, one per style, kind and name, in their own collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        StyleStats.StyleStats.__init__(self)
+
+    def load_style(self, style):
+        try:
+            return [(doc[StyleStats.KIND_KEY], doc[StyleStats.NAME_KEY], [doc.get(key, 0) for key in StyleStats.SUM_KEYS]) for doc in self.collection.find({StyleStats.STYLE_KEY: style}, {'_id': False})]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def load_styles(self):
+        try:
+            query = {StyleStats.KIND_KEY: StyleStats.RECIPES_KIND, StyleStats.NAME_KEY: StyleStats.RECIPES_KIND, StyleStats.COUNT_KEY: {'$gt': 0}}
+            return dict((doc[StyleStats.STYLE_KEY], doc[StyleStats.COUNT_KEY]) for doc in self.collection.find(query, {'_id': False}))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return {}
+
+    def save_deltas(self, deltas):
+        try:
+            operations = []
+            for style, kind, name, sums in deltas:
+                query = {StyleStats.STYLE_KEY: style, StyleStats.KIND_KEY: kind, StyleStats.NAME_KEY: name}
+                operations.append(pymongo.UpdateOne(query, {'$inc': dict(zip(StyleStats.SUM_KEYS, sums))}, upsert=True))
+            self.collection.bulk_write(operations, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def clear(self):
+        try:
+            self.collection.delete_many({})
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
 
 class MongoDatabase(Database.Database):
 
@@ -42,18 +235,113 @@ class MongoDatabase(Database.Database):
             self.conn = pymongo.MongoClient(db_addr)
             self.database = self.conn['crawlerdb']
             self.pages_collection = self.database['pages']
-            return True
+            self.schema_collection = self.database['schema']
+            self.tombstones_collection = self.database['tombstones']
+            if self.page_store is None:
+                self.page_store = MongoPageStore(self.database['page_sources'])
+            self.page_history = MongoPageHistory(self.database['page_versions'])
+            self.extraction_cache = MongoExtractionCache(self.database['extractions'])
+            self.style_stats = MongoStyleStats(self.database['style_stats'])
+            self.server_version = tuple(self.conn.server_info()['versionArray'])
+            return self.ensure_schema()
         except pymongo.errors.ConnectionFailure as e:
             self.log_error("Could not connect to MongoDB: %s" % e)
         return False
 
-    def create_page(self, url, last_visit_time, raw_content, extracted_content):
-        """Create method for a webpage."""
+    def migrate_add_host(self):
+        """Schema version 1: adds the host field to pages that were stored without one."""
+        operations = []
+        for page in self.pages_collection.find({Keys.HOST_KEY: {'$exists': False}}, {Keys.URL_KEY: True}):
+            if Keys.URL_KEY in page:
+                operations.append(pymongo.UpdateOne({'_id': page['_id']}, {'$set': {Keys.HOST_KEY: Database.get_url_host(page[Keys.URL_KEY])}}))
+            if len(operations) >= self.write_batch_size:
+                self.pages_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if len(operations) > 0:
+            self.pages_collection.bulk_write(operations, ordered=False)
+
+    def migrate_remove_duplicate_urls(self):
+        """Schema version 2: removes all but the most recently visited copy of each URL so that the URL index can be unique."""
+        pipeline = [
+            { '$sort': { Keys.LAST_VISIT_TIME_KEY: -1 } },
+            { '$group': { '_id': '$' + Keys.URL_KEY, 'ids': { '$push': '$_id' }, 'count': { '$sum': 1 } } },
+            { '$match': { 'count': { '$gt': 1 } } }
+        ]
+        for group in self.pages_collection.aggregate(pipeline, allowDiskUse=True):
+            self.pages_collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+
+    def migrate_add_search_fields(self):
+        """Schema version 3: adds the host domains and style words, which host and style queries use instead of regular expressions."""
+        operations = []
+        for page in self.pages_collection.find({Keys.HOST_DOMAINS_KEY: {'$exists': False}}, {Keys.HOST_KEY: True, Keys.STYLE_KEY: True}):
+            search_fields = self.make_search_fields(page)
+            if len(search_fields) > 0:
+                operations.append(pymongo.UpdateOne({'_id': page['_id']}, {'$set': search_fields}))
+            if len(operations) >= self.write_batch_size:
+                self.pages_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if len(operations) > 0:
+            self.pages_collection.bulk_write(operations, ordered=False)
+
+    def migrate_move_page_sources(self):
+        """Schema version 4: moves the page sources that were stored in the page documents into the page store, leaving a reference to each."""
+        operations = []
+        for page in self.pages_collection.find({Keys.PAGE_SOURCE_KEY: {'$ne': None}}, {Keys.PAGE_SOURCE_KEY: True}):
+            ref = self.page_store.put(page[Keys.PAGE_SOURCE_KEY])
+            if ref is not None:
+                operations.append(pymongo.UpdateOne({'_id': page['_id']}, {'$set': {Keys.PAGE_SOURCE_REF_KEY: ref}, '$unset': {Keys.PAGE_SOURCE_KEY: ''}}))
+            if len(operations) >= self.write_batch_size:
+                self.write_moved_page_sources(operations)
+                operations = []
+        if len(operations) > 0:
+            self.write_moved_page_sources(operations)
+
+    def write_moved_page_sources(self, operations):
+        """The page sources have to be in the page store before the page documents stop holding them."""
+        if not self.page_store.flush():
+            raise Exception("Failed to write the page sources to the page store.")
+        self.pages_collection.bulk_write(operations, ordered=False)
+
+    def make_search_fields(self, fields):
+        """Returns the fields that are derived from the host and the style, so that queries on them can use an index."""
+        search_fields = {}
+        if fields.get(Keys.HOST_KEY) is not None:
+            search_fields[Keys.HOST_DOMAINS_KEY] = Database.get_host_domains(fields[Keys.HOST_KEY])
+        if fields.get(Keys.STYLE_KEY) is not None:
+            search_fields[Keys.STYLE_WORDS_KEY] = Database.get_style_words(str(fields[Keys.STYLE_KEY]))
+        return search_fields
+
+    def ensure_schema(self):
+        """Brings the pages collection up to the current schema version and makes sure the indexes exist."""
         try:
-            post = { Keys.URL_KEY: url, Keys.LAST_VISIT_TIME_KEY: last_visit_time, Keys.PAGE_SOURCE_KEY: raw_content }
-            if extracted_content is not None:
-                post.update(extracted_content)
-            self.pages_collection.insert(post)
+            migrations = [ (1, self.migrate_add_host), (2, self.migrate_remove_duplicate_urls), (3, self.migrate_add_search_fields), (4, self.migrate_move_page_sources) ]
+
+            # Which version is the database at?
+            schema_doc = self.schema_collection.find_one({'_id': SCHEMA_DOC_ID})
+            version = 0
+            if schema_doc is not None and Keys.SCHEMA_VERSION_KEY in schema_doc:
+                version = schema_doc[Keys.SCHEMA_VERSION_KEY]
+
+            # Apply any migrations it hasn't had, recording progress after each one.
+            for migration_version, migration in migrations:
+                if migration_version > version:
+                    migration()
+                    version = migration_version
+                    self.schema_collection.update_one({'_id': SCHEMA_DOC_ID}, {'$set': {Keys.SCHEMA_VERSION_KEY: version}}, upsert=True)
+
+            # Creating an index that already exists is a no-op.
+            self.pages_collection.create_index(Keys.URL_KEY, unique=True)
+            self.pages_collection.create_index(Keys.LAST_VISIT_TIME_KEY)
+            self.pages_collection.create_index(Keys.HOST_KEY)
+            self.pages_collection.create_index(Keys.STYLE_KEY, sparse=True)
+            self.pages_collection.create_index(Keys.CANONICAL_STYLE_KEY, sparse=True)
+            self.pages_collection.create_index(Keys.HOST_DOMAINS_KEY)
+            self.pages_collection.create_index(Keys.STYLE_WORDS_KEY, sparse=True)
+            self.tombstones_collection.create_index(Keys.DELETED_TIME_KEY)
+            self.database['page_versions'].create_index([(Keys.URL_KEY, pymongo.ASCENDING), (PageHistory.VERSION_TIME_KEY, pymongo.DESCENDING)])
+            self.database['page_versions'].create_index(PageHistory.VERSION_TIME_KEY)
+            self.database['extractions'].create_index([(ExtractionCache.MODULE_KEY, pymongo.ASCENDING), (ExtractionCache.VERSION_KEY, pymongo.ASCENDING)])
+            self.database['style_stats'].create_index([(StyleStats.STYLE_KEY, pymongo.ASCENDING), (StyleStats.KIND_KEY, pymongo.ASCENDING), (StyleStats.NAME_KEY, pymongo.ASCENDING)], unique=True)
             return True
         except:
             self.log_error(traceback.format_exc())
@@ -69,6 +357,42 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return None
 
+    def retrieve_page_metadata(self, url):
+        """Retrieve method for a webpage that only returns the metadata fields (no page source or extracted content)."""
+        try:
+            return self.pages_collection.find_one({Keys.URL_KEY: url}, METADATA_PROJECTION)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_pages_metadata(self, urls):
+        """Batched version of retrieve_page_metadata. Returns a dictionary that maps each of the given URLs that is in the database to its metadata, using a single query."""
+        try:
+            pages = {}
+            for page in self.pages_collection.find({Keys.URL_KEY: {'$in': list(urls)}}, METADATA_PROJECTION):
+                pages[page[Keys.URL_KEY]] = page
+            return pages
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return {}
+
+    def retrieve_pages(self, urls, fields):
+        """Returns a dictionary that maps each of the given URLs that is in the database to its page, with only the given fields, using a single query."""
+        try:
+            projection = { '_id': False, Keys.URL_KEY: True }
+            for field in fields:
+                projection[field] = True
+            pages = {}
+            for page in self.pages_collection.find({Keys.URL_KEY: {'$in': list(urls)}}, projection):
+                pages[page[Keys.URL_KEY]] = page
+            return pages
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
     def retrieve_all_pages(self):
         """Retrieve method for a webpage."""
         try:
@@ -78,18 +402,117 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return None
 
-    def update_page(self, url, last_visit_time, raw_content, extracted_content):
-        """Update method for a webpage."""
+    def query_pages(self, host=None, style=None, style_is_regex=False, has_fields=None, fields=None, batch_size=Database.DEFAULT_QUERY_BATCH_SIZE, visited_since=None, canonical_style=None, missing_fields=None):
+        """Returns a cursor over the pages that match all of the given criteria. See Database.query_pages."""
+        try:
+            query = {}
+            if host is not None:
+                query[Keys.HOST_DOMAINS_KEY] = host.lower()
+            if style is not None:
+                query.update(self.make_style_query(style, style_is_regex))
+            if canonical_style is not None:
+                query[Keys.CANONICAL_STYLE_KEY] = canonical_style
+            if has_fields is not None:
+                for field in has_fields:
+                    if field not in query:
+                        query[field] = {'$exists': True}
+            if missing_fields is not None:
+                for field in missing_fields:
+                    query[field] = {'$exists': False}
+            if visited_since is not None:
+                query[Keys.LAST_VISIT_TIME_KEY] = {'$gt': visited_since}
+            projection = None
+            if fields is not None:
+                projection = { '_id': False }
+                for field in fields:
+                    projection[field] = True
+            return self.pages_collection.find(query, projection).batch_size(batch_size)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def make_style_query(self, style, style_is_regex=False):
+        """Returns the query clauses that match the style. Plain text is looked up by its words, with the style words index, and only"""
+        """then checked against the whole text. A regular expression can't use an index and is matched against every page."""
+        query = {Keys.STYLE_KEY: {'$regex': style if style_is_regex else re.escape(style), '$options': 'i'}}
+        if not style_is_regex:
+            words = Database.get_style_words(style)
+            if len(words) > 0:
+                query[Keys.STYLE_WORDS_KEY] = {'$all': words}
+        return query
+
+    def distinct_values(self, field):
+        """Returns the list of the distinct values of the field across all pages. Uses the field's index, if it has one."""
         try:
-            post = self.pages_collection.find_one({Keys.URL_KEY: url})
-            if post is not None:
-                post[Keys.LAST_VISIT_TIME_KEY] = last_visit_time
-                post[Keys.PAGE_SOURCE_KEY] = raw_content
-                if extracted_content is not None:
-                    post.update(extracted_content)
-                self.pages_collection.save(post)
-                return True
+            return self.pages_collection.distinct(field)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
+        return None
+
+    def aggregate_pages(self, pipeline):
+        """Runs a MongoDB aggregation pipeline over the pages, inside the database, and returns the list of results."""
+        try:
+            return list(self.pages_collection.aggregate(pipeline, allowDiskUse=True))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def delete_page(self, url, deleted_time):
+        """Deletes the page, if it exists, and leaves a tombstone so that incremental exports know it is gone."""
+        try:
+            self.discard_pending_write(url)
+            if not self.notify_page_observers([(url, None)]):
+                return False
+            result = self.pages_collection.delete_one({Keys.URL_KEY: url})
+            if result.deleted_count > 0:
+                self.tombstones_collection.update_one({Keys.URL_KEY: url}, {'$set': {Keys.DELETED_TIME_KEY: deleted_time}}, upsert=True)
+            return self.finish_page_observers(True)
+        except:
+            self.finish_page_observers(False)
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
         return False
+
+    def retrieve_tombstones(self, since):
+        """Returns a cursor over the tombstones of the pages deleted after the given time."""
+        try:
+            return self.tombstones_collection.find({Keys.DELETED_TIME_KEY: {'$gt': since}}, {'_id': False})
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def make_page_update(self, fields):
+        """Returns the update that writes the fields to a page. Page source fields that are None are removed (see Database.make_page_source_fields)."""
+        set_fields = dict(fields, **self.make_search_fields(fields))
+        unset_fields = {}
+        for key in [Keys.PAGE_SOURCE_KEY, Keys.PAGE_SOURCE_REF_KEY]:
+            if key in set_fields and set_fields[key] is None:
+                del set_fields[key]
+                unset_fields[key] = ''
+        update = {'$set': set_fields}
+        if len(unset_fields) > 0:
+            update['$unset'] = unset_fields
+        return update
+
+    def bulk_upsert_pages(self, writes):
+        """Writes a list of (url, fields) tuples as a single unordered bulk operation. See Database.bulk_upsert_pages."""
+        try:
+            operations = [pymongo.UpdateOne({Keys.URL_KEY: url}, self.make_page_update(fields), upsert=True) for url, fields in writes]
+            self.pages_collection.bulk_write(operations, ordered=False)
+            return []
+        except pymongo.errors.BulkWriteError as e:
+            # The other operations were written, only the ones with errors failed.
+            failures = []
+            for error in e.details.get('writeErrors', []):
+                url, fields = writes[error['index']]
+                self.log_error("ERROR: Failed to write " + url + ": " + str(error.get('errmsg')))
+                failures.append((url, fields, error.get('code') not in RETRYABLE_WRITE_ERROR_CODES))
+            return failures
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return [(url, fields, False) for url, fields in writes]
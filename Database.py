@@ -25,14 +25,338 @@
 
 import logging
 import os
+import re
+import sys
+import time
+import Keys
+import PageStore
+
+# Import things so that they have the same name regardless of whether we are using python2 or python3.
+if sys.version_info[0] < 3:
+    import urlparse
+else:
+    import urllib.parse as urlparse
+
+DEFAULT_WRITE_BATCH_SIZE = 100
+DEFAULT_WRITE_FLUSH_SECS = 5.0
+DEFAULT_QUERY_BATCH_SIZE = 500
+MAX_WRITE_RETRIES = 3 # Number of times a page write that failed is retried before it is dropped
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def get_url_host(url):
+    """Returns the hostname portion of the URL, which is stored with each page so that pages can be looked up by site."""
+    host = urlparse.urlparse(url).hostname
+    if host is None:
+        return ""
+    return host
+
+def get_host_domains(host):
+    """Returns the host and each of its parent domains, e.g. www.foo.com, foo.com and com."""
+    parts = host.split('.')
+    return ['.'.join(parts[i:]) for i in range(len(parts)) if len(parts[i]) > 0]
+
+def get_style_words(style):
+    """Returns the lowercase words of a style, e.g. american and ipa for "American IPA", without duplicates."""
+    words = []
+    for word in WORD_PATTERN.findall(style.lower()):
+        if word not in words:
+            words.append(word)
+    return words
+
+def open_database(db_uri):
+    """Instantiates and connects to the database described by the URI."""
+    """mongodb://host:port selects MongoDB, sqlite:///path/to/file.db (or a path ending in .db or .sqlite) selects an embedded SQLite file."""
+    if db_uri.startswith('sqlite:') or db_uri.endswith('.db') or db_uri.endswith('.sqlite'):
+        import SqliteDatabase
+        db_file = db_uri
+        if db_file.startswith('sqlite:'):
+            db_file = db_file[len('sqlite:'):]
+            if db_file.startswith('///'):
+                db_file = db_file[2:]
+            elif db_file.startswith('//'):
+                db_file = db_file[2:]
+        db = SqliteDatabase.SqliteDatabase()
+    else:
+        import CrawlerDatabase
+        db_file = db_uri
+        db = CrawlerDatabase.MongoDatabase()
+    if not db.connect(db_file):
+        return None
+    return db
+
+class PageObserver(object):
+    """Base class for something that keeps data derived from the pages, and so needs to know when they change."""
+
+    def __init__(self):
+        super(PageObserver, self).__init__()
+
+    def get_fields(self):
+        """Returns the fields of the stored pages that pages_changed needs to see."""
+        return []
+
+    def pages_changed(self, changes):
+        """Called with a list of (url, old page, new fields) tuples before the changes are written. The old page is None if the page is new,"""
+        """and only has the fields from get_fields. The new fields are None if the page is being deleted, otherwise more can be added to them."""
+        """To be overridden in the child class."""
+        pass
+
+    def flush(self):
+        """Called once the changes have been written."""
+        return True
+
+    def discard(self):
+        """Called instead of flush if the changes couldn't be written."""
+        pass
 
 class Database(object):
     """Base class for a database. Encapsulates common functionality."""
     db_file = ""
 
     def __init__(self):
+        self.write_batch_size = DEFAULT_WRITE_BATCH_SIZE
+        self.write_flush_secs = DEFAULT_WRITE_FLUSH_SECS
+        self.pending_writes = {} # URL -> fields to set, in the order they were first queued
+        self.pending_writes_order = []
+        self.write_retries = {} # URL -> number of times its buffered write has failed
+        self.last_flush_time = time.time()
+        self.page_source_policy = PageStore.POLICY_STORE
+        self.page_store = None # Where page source lives when it isn't stored inline, the subclass provides a default
+        self.default_page_store = None # The subclass's page store, when another one was configured, since schema migrations move page source into it
+        self.page_history = None # Where previous versions of pages live, the subclass provides it
+        self.keep_history = False
+        self.extraction_cache = None # Results of the website modules, keyed by page content, the subclass provides it
+        self.server_version = None # Version of the database server, as a tuple of numbers, if there is a server
+        self.style_stats = None # Per style ingredient statistics, the subclass provides it
+        self.page_observers = [] # PageObservers to tell about page writes and deletions
+        self.style_canonicalizer = None # Optional, canonicalizes the style of each page that is written with one
         super(Database, self).__init__()
 
+    def set_page_source_policy(self, policy, page_store=None):
+        """Configures how page source is stored (see PageStore.POLICIES) and, optionally, where."""
+        self.page_source_policy = policy
+        if page_store is not None:
+            if self.default_page_store is None:
+                self.default_page_store = self.page_store
+            self.page_store = page_store
+
+    def set_keep_history(self, keep_history):
+        """Enables or disables keeping the previous versions of each page (see PageHistory)."""
+        self.keep_history = keep_history
+
+    def set_write_batching(self, batch_size, flush_secs):
+        """Configures how many page writes to buffer, and for how long, before they are flushed to the database."""
+        self.write_batch_size = batch_size
+        self.write_flush_secs = flush_secs
+
+    def set_style_canonicalizer(self, style_canonicalizer):
+        """Sets the StyleCanonicalizer used to store the canonical style alongside the style whenever a page's style is written."""
+        self.style_canonicalizer = style_canonicalizer
+
+    def add_page_observer(self, observer):
+        """Registers a PageObserver, which is told about each page write and deletion before it reaches the database."""
+        self.page_observers.append(observer)
+
+    def retrieve_observed_pages(self, urls):
+        """Returns a dictionary of URL to the stored page, with the fields that the observers need, or None on error."""
+        if len(self.page_observers) == 0:
+            return {}
+        fields = set([Keys.URL_KEY])
+        for observer in self.page_observers:
+            fields.update(observer.get_fields())
+        return self.retrieve_pages(urls, list(fields))
+
+    def notify_page_observers(self, changes, old_pages=None):
+        """Tells the observers about a list of (url, new fields) changes, where the new fields are None for a deleted page."""
+        """old_pages is the result of retrieve_observed_pages for the changes, which is called if it isn't given."""
+        if len(self.page_observers) == 0:
+            return True
+        if old_pages is None:
+            old_pages = self.retrieve_observed_pages([url for url, _ in changes])
+        if old_pages is None:
+            return False
+        for observer in self.page_observers:
+            observer.pages_changed([(url, old_pages.get(url), new_fields) for url, new_fields in changes])
+        return True
+
+    def finish_page_observers(self, written):
+        """Lets the observers write, or discard, what they derived from the changes, depending on whether the changes were written."""
+        result = True
+        for observer in self.page_observers:
+            if written:
+                result = observer.flush() and result
+            else:
+                observer.discard()
+        return result
+
+    def queue_page_write(self, url, fields):
+        """Buffers a write of the given fields to the page with the given URL, creating the page if it doesn't exist."""
+        """Repeated writes to the same URL are coalesced. Returns the result of the flush, if one was triggered."""
+        if self.style_canonicalizer is not None and Keys.STYLE_KEY in fields:
+            fields = dict(fields)
+            fields[Keys.CANONICAL_STYLE_KEY] = self.style_canonicalizer.canonicalize(fields[Keys.STYLE_KEY])
+        if url in self.pending_writes:
+            self.pending_writes[url].update(fields)
+        else:
+            self.pending_writes[url] = dict(fields)
+            self.pending_writes_order.append(url)
+        if len(self.pending_writes) >= self.write_batch_size or time.time() - self.last_flush_time >= self.write_flush_secs:
+            return self.flush_page_writes()
+        return True
+
+    def discard_pending_write(self, url):
+        """Forgets a buffered write, so that a page that is being deleted doesn't reappear when the buffer is flushed."""
+        if url in self.pending_writes:
+            del self.pending_writes[url]
+            self.pending_writes_order.remove(url)
+
+    def store_page(self, url, last_visit_time, raw_content, extracted_content):
+        """Creates or updates a webpage. The write is buffered and sent to the database in bulk."""
+        post = { Keys.HOST_KEY: get_url_host(url), Keys.LAST_VISIT_TIME_KEY: last_visit_time }
+        post.update(self.make_page_source_fields(raw_content))
+        if extracted_content is not None:
+            post.update(extracted_content)
+        if self.keep_history and self.page_history is not None:
+            history_content = raw_content
+            if self.page_source_policy == PageStore.POLICY_NONE:
+                history_content = None
+            self.page_history.add_version(url, last_visit_time, history_content, extracted_content)
+        return self.queue_page_write(url, post)
+
+    def make_page_source_fields(self, raw_content):
+        """Returns the fields that record the page source in the page document, according to the page source policy."""
+        """A field that is None is removed from the page, so that it doesn't keep the source from an earlier visit."""
+        if raw_content is None:
+            return {}
+        if self.page_source_policy == PageStore.POLICY_NONE:
+            return { Keys.PAGE_SOURCE_KEY: None, Keys.PAGE_SOURCE_REF_KEY: None }
+        if self.page_source_policy == PageStore.POLICY_INLINE or self.page_store is None:
+            return { Keys.PAGE_SOURCE_KEY: raw_content, Keys.PAGE_SOURCE_REF_KEY: None }
+        ref = self.page_store.put(raw_content)
+        if ref is None:
+            return { Keys.PAGE_SOURCE_KEY: raw_content, Keys.PAGE_SOURCE_REF_KEY: None }
+        return { Keys.PAGE_SOURCE_KEY: None, Keys.PAGE_SOURCE_REF_KEY: ref }
+
+    def retrieve_page_source(self, page):
+        """Returns the source of the given page document, wherever it is stored, or None if it wasn't stored."""
+        if page.get(Keys.PAGE_SOURCE_KEY) is not None:
+            return page[Keys.PAGE_SOURCE_KEY]
+        if page.get(Keys.PAGE_SOURCE_REF_KEY) is None:
+            return None
+        raw_content = None
+        if self.page_store is not None:
+            raw_content = self.page_store.get(page[Keys.PAGE_SOURCE_REF_KEY])
+        if raw_content is None and self.default_page_store is not None:
+            raw_content = self.default_page_store.get(page[Keys.PAGE_SOURCE_REF_KEY])
+        return raw_content
+
+    def flush_page_writes(self):
+        """Writes everything that has been buffered by queue_page_write."""
+        self.last_flush_time = time.time()
+
+        # Page source has to be stored before the pages that refer to it.
+        if self.page_store is not None and not self.page_store.flush():
+            return False
+        if self.page_history is not None and not self.page_history.flush():
+            return False
+        if self.extraction_cache is not None and not self.extraction_cache.flush():
+            return False
+        if len(self.pending_writes) == 0:
+            return True
+        writes = [(url, self.pending_writes[url]) for url in self.pending_writes_order]
+        old_pages = self.retrieve_observed_pages([url for url, _ in writes])
+        if old_pages is None or not self.notify_page_observers(writes, old_pages):
+            return False
+        self.pending_writes = {}
+        self.pending_writes_order = []
+        failures = self.bulk_upsert_pages(writes)
+        if len(failures) == 0:
+            self.write_retries = {}
+            return self.finish_page_observers(True)
+
+        # Only some of the writes were made, so the observers are told again about just those.
+        self.finish_page_observers(False)
+        failed_urls = set([url for url, _, _ in failures])
+        written = [(url, fields) for url, fields in writes if url not in failed_urls]
+        if len(written) > 0 and self.notify_page_observers(written, old_pages):
+            self.finish_page_observers(True)
+        for url, _ in written:
+            self.write_retries.pop(url, None)
+        self.requeue_page_writes(failures)
+        return False
+
+    def requeue_page_writes(self, failures):
+        """Puts the (url, fields, permanent) writes that failed back in the buffer, ahead of anything queued since, so that the next"""
+        """flush retries them. Newer writes to the same URL take precedence over the failed ones. Writes that can never succeed, and"""
+        """writes that have failed MAX_WRITE_RETRIES times, are dropped."""
+        writes = []
+        for url, fields, permanent in failures:
+            num_retries = self.write_retries.pop(url, 0) + 1
+            if permanent or num_retries > MAX_WRITE_RETRIES:
+                self.log_error("ERROR: Dropping the write to " + url + " after " + str(num_retries) + " failure(s).")
+                continue
+            self.write_retries[url] = num_retries
+            writes.append((url, fields))
+        pending_writes = self.pending_writes
+        pending_writes_order = self.pending_writes_order
+        self.pending_writes = {}
+        self.pending_writes_order = []
+        for url, fields in writes:
+            self.pending_writes[url] = dict(fields)
+            self.pending_writes_order.append(url)
+        for url in pending_writes_order:
+            if url in self.pending_writes:
+                self.pending_writes[url].update(pending_writes[url])
+            else:
+                self.pending_writes[url] = pending_writes[url]
+                self.pending_writes_order.append(url)
+
+    def bulk_upsert_pages(self, writes):
+        """Writes a list of (url, fields) tuples, setting only the given fields and creating pages that don't exist. Returns the"""
+        """list of (url, fields, permanent) tuples of the writes that failed, where permanent is TRUE if retrying can't help."""
+        """To be overridden in the child class."""
+        return [(url, fields, False) for url, fields in writes]
+
+    def query_pages(self, host=None, style=None, style_is_regex=False, has_fields=None, fields=None, batch_size=DEFAULT_QUERY_BATCH_SIZE, visited_since=None, canonical_style=None, missing_fields=None):
+        """Returns an iterator over the pages that match all of the given criteria, with the filtering done by the database."""
+        """host matches the host and any of its subdomains. style is a case-insensitive substring (or regular expression, if style_is_regex is set)."""
+        """Databases that index the words of the style may only match a plain style made of whole words, e.g. "IPA" matches "American IPA" but not "NEIPA"."""
+        """has_fields lists fields that must be present and missing_fields lists fields that must not be. fields lists the only fields to return (None returns everything)."""
+        """Results are fetched from the database batch_size pages at a time. visited_since, if set, only matches pages visited after that time."""
+        """canonical_style, if set, is matched exactly, using an index, against the canonical style that RecipeWriter stores with each recipe."""
+        """To be overridden in the child class."""
+        return None
+
+    def distinct_values(self, field):
+        """Returns the list of the distinct values of the field across all pages, computed by the database, or None on error."""
+        """To be overridden in the child class."""
+        return None
+
+    def retrieve_pages(self, urls, fields):
+        """Returns a dictionary that maps each of the given URLs that is in the database to its page, with only the given fields, or None on error."""
+        """To be overridden in the child class."""
+        return None
+
+    def aggregate_pages(self, pipeline):
+        """Runs a MongoDB aggregation pipeline over the pages, inside the database, and returns the list of results."""
+        """Returns None if the database can't run aggregation pipelines, in which case the caller should do the work itself."""
+        """To be overridden in the child class."""
+        return None
+
+    def delete_page(self, url, deleted_time):
+        """Deletes the page, if it exists, and leaves a tombstone so that incremental exports know it is gone. The child class should"""
+        """call notify_page_observers before deleting and finish_page_observers afterwards."""
+        """To be overridden in the child class."""
+        return False
+
+    def retrieve_tombstones(self, since):
+        """Returns an iterator over the tombstones (URL and deleted time) of the pages deleted after the given time."""
+        """To be overridden in the child class."""
+        return None
+
+    def close(self):
+        """Flushes any buffered writes. Should be called before exiting."""
+        return self.flush_page_writes()
+
     def log_error(self, log_str):
         """Writes an error message to the log file."""
         logger = logging.getLogger()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""In-process DNS cache with background prefetching"""
+
+import logging
+import socket
+import sys
+import threading
+import time
+
+# Import things so that they have the same name regardless of whether we are using python2 or python3.
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
+
+# dnspython is optional. When it is available we can honor the TTL of the actual DNS record,
+# otherwise every entry lives for the default TTL.
+try:
+    import dns.resolver
+    HAVE_DNSPYTHON = True
+except ImportError:
+    HAVE_DNSPYTHON = False
+
+DEFAULT_TTL_SECS = 300
+NEGATIVE_TTL_SECS = 30
+MAX_PREFETCH_QUEUE = 4096
+MAX_ENTRIES = 65536
+
+class DnsCache(object):
+    """Caches getaddrinfo results, keyed by the lookup arguments, until their TTL expires."""
+
+    def __init__(self, default_ttl_secs=DEFAULT_TTL_SECS, num_prefetch_threads=4):
+        """Constructor."""
+        self.default_ttl_secs = default_ttl_secs
+        self.entries = {} # (host, port, family, type, proto, flags) -> (expiry time, result or exception)
+        self.max_entries = MAX_ENTRIES
+        self.lock = threading.Lock()
+        self.original_getaddrinfo = socket.getaddrinfo
+        self.installed = False
+        self.prefetch_queue = queue.Queue(MAX_PREFETCH_QUEUE)
+        self.prefetch_pending = set()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.prefetch_threads = []
+        for _ in range(num_prefetch_threads):
+            thread = threading.Thread(target=self.prefetch_worker)
+            thread.daemon = True
+            thread.start()
+            self.prefetch_threads.append(thread)
+        super(DnsCache, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def install(self):
+        """Routes all name resolution in this process (including the HTTP session's connection pool) through the cache."""
+        if not self.installed:
+            socket.getaddrinfo = self.getaddrinfo
+            self.installed = True
+
+    def uninstall(self):
+        """Restores the system resolver."""
+        if self.installed:
+            socket.getaddrinfo = self.original_getaddrinfo
+            self.installed = False
+
+    def lookup_ttl(self, host):
+        """Returns the TTL of the host's address record, or the default TTL if it cannot be determined."""
+        if HAVE_DNSPYTHON:
+            try:
+                answer = dns.resolver.resolve(host, 'A') if hasattr(dns.resolver, 'resolve') else dns.resolver.query(host, 'A')
+                return min(answer.rrset.ttl, self.default_ttl_secs)
+            except Exception:
+                pass
+        return self.default_ttl_secs
+
+    def store(self, key, ttl, result):
+        """Caches the result. When the cache is full, the expired entries are dropped and, if that isn't enough, the half that"""
+        """expires soonest."""
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                now = time.time()
+                self.entries = dict((k, v) for k, v in self.entries.items() if v[0] > now)
+                if len(self.entries) >= self.max_entries // 2:
+                    keep = sorted(self.entries.items(), key=lambda item: item[1][0])[len(self.entries) // 2:]
+                    self.entries = dict(keep)
+            self.entries[key] = (time.time() + ttl, result)
+
+    def resolve(self, key, lookup_ttl=True):
+        """Performs the actual (uncached) resolution and stores the result. Only "no such name" failures are cached, other"""
+        """failures (e.g. a temporary failure of the name server) are raised so that the next lookup tries again."""
+        try:
+            result = self.original_getaddrinfo(*key)
+        except socket.gaierror as e:
+            if e.args[0] != socket.EAI_NONAME:
+                raise
+            self.store(key, NEGATIVE_TTL_SECS, e)
+            return e
+        self.store(key, self.lookup_ttl(key[0]) if lookup_ttl else self.default_ttl_secs, result)
+        return result
+
+    def refine_ttl(self, key):
+        """Shortens the lifetime of a cached entry to the TTL of the host's address record."""
+        ttl = self.lookup_ttl(key[0])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (min(entry[0], time.time() + ttl), entry[1])
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """Drop-in replacement for socket.getaddrinfo."""
+        key = (host, port, family, type, proto, flags)
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] > time.time()
+            if hit:
+                self.num_hits = self.num_hits + 1
+            else:
+                self.num_misses = self.num_misses + 1
+        if hit:
+            result = entry[1]
+        else:
+            # Resolve now, with the default TTL, and look up the record's actual TTL in the background so that this lookup
+            # only waits for one query.
+            result = self.resolve(key, lookup_ttl=False)
+            if HAVE_DNSPYTHON and not isinstance(result, Exception):
+                try:
+                    self.prefetch_queue.put_nowait((key, True))
+                except queue.Full:
+                    pass
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def prefetch(self, host, port=443):
+        """Queues the host for resolution in the background, if it is not already cached."""
+        if not host:
+            return
+        key = (host, port, 0, socket.SOCK_STREAM, 0, 0)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return
+            if key in self.prefetch_pending:
+                return
+            self.prefetch_pending.add(key)
+        try:
+            self.prefetch_queue.put_nowait((key, False))
+        except queue.Full:
+            with self.lock:
+                self.prefetch_pending.discard(key)
+
+    def prefetch_worker(self):
+        """Background thread that resolves queued hostnames, or looks up the TTL of hostnames that were resolved on demand."""
+        while True:
+            key, ttl_only = self.prefetch_queue.get()
+            try:
+                if ttl_only:
+                    self.refine_ttl(key)
+                else:
+                    self.resolve(key)
+            except Exception:
+                self.log_error("ERROR: Failed to prefetch " + str(key[0]) + ".")
+            if not ttl_only:
+                with self.lock:
+                    self.prefetch_pending.discard(key)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Cache of extraction results, keyed by page content hash, module name and module version"""
+
+import logging
+
+DEFAULT_BATCH_SIZE = 100
+MODULE_KEY = 'module'
+VERSION_KEY = 'version'
+RESULT_KEY = 'result'
+
+def make_key(content_hash, module_name, module_version):
+    """Returns the key under which a module's result for a page's content is cached."""
+    return content_hash + ":" + module_name + ":" + str(module_version)
+
+class ExtractionCache(object):
+    """Base class for the extraction cache. The child class provides the storage primitives."""
+
+    def __init__(self):
+        self.pending = {} # key -> (module name, module version, value)
+        self.batch_size = DEFAULT_BATCH_SIZE
+        super(ExtractionCache, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def get_many(self, keys):
+        """Returns a dictionary that maps each of the given keys that is in the cache to its value, using a single query."""
+        values = {}
+        missing = []
+        for key in keys:
+            if key in self.pending:
+                values[key] = self.pending[key][2]
+            else:
+                missing.append(key)
+        if len(missing) > 0:
+            values.update(self.load(missing))
+        return values
+
+    def put(self, key, module_name, module_version, value):
+        """Buffers a result. The buffer is flushed once it's big enough."""
+        self.pending[key] = (module_name, module_version, value)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """Writes the buffered results."""
+        if len(self.pending) == 0:
+            return True
+        entries = [(key, module_name, module_version, value) for key, (module_name, module_version, value) in self.pending.items()]
+        self.pending = {}
+        return self.save(entries)
+
+    def load(self, keys):
+        """Returns a dictionary that maps each of the given keys that is stored to its value."""
+        """To be overridden in the child class."""
+        return {}
+
+    def save(self, entries):
+        """Stores a list of (key, module name, module version, value) tuples, in bulk."""
+        """To be overridden in the child class."""
+        return False
+
+    def invalidate(self, module_name, current_version):
+        """Deletes the results of every version of the module other than the current one."""
+        """To be overridden in the child class."""
+        return False
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Declarative extraction of fields from a parsed page"""
+
+# A spec is a list of fields, each with a CSS-style selector. The supported selector syntax is a space separated
+# list of steps (descendant combinator), where each step is a tag name optionally followed by #id, .class and
+# [attribute=value] qualifiers, e.g. "div#fermentables table" or "span[itemprop=recipeYield]".
+#
+# The spec is compiled once. Extracting from a page walks the document once to find the element that each selector's
+# first step matches, and the remaining steps are only searched for within those elements.
+
+import re
+import bs4
+
+STEP_RE = re.compile(r'([A-Za-z0-9_-]+|\*)?((?:#[A-Za-z0-9_-]+|\.[A-Za-z0-9_-]+|\[[^\]]+\])*)$')
+QUALIFIER_RE = re.compile(r'#([A-Za-z0-9_-]+)|\.([A-Za-z0-9_-]+)|\[([^=\]]+)(?:=([^\]]*))?\]')
+
+class SelectorStep(object):
+    """One step of a selector, i.e. the test for a single element."""
+
+    def __init__(self, step_str):
+        """Constructor. Compiles the step."""
+        match = STEP_RE.match(step_str)
+        if match is None:
+            raise ValueError("Invalid selector step: " + step_str)
+        self.name = match.group(1)
+        if self.name == '*':
+            self.name = None
+        self.attrs = {}
+        self.classes = []
+        for element_id, class_name, attr_name, attr_value in QUALIFIER_RE.findall(match.group(2)):
+            if element_id:
+                self.attrs['id'] = element_id
+            elif class_name:
+                self.classes.append(class_name)
+            else:
+                self.attrs[attr_name.strip()] = attr_value.strip().strip('"\'') if attr_value else None
+        super(SelectorStep, self).__init__()
+
+    def matches(self, tag):
+        """Returns TRUE if the element satisfies this step."""
+        if self.name is not None and tag.name != self.name:
+            return False
+        for attr_name, attr_value in self.attrs.items():
+            value = tag.get(attr_name)
+            if value is None:
+                return False
+            if attr_value is not None:
+                if isinstance(value, list):
+                    value = " ".join(value)
+                if value != attr_value:
+                    return False
+        if len(self.classes) > 0:
+            tag_classes = tag.get('class') or []
+            for class_name in self.classes:
+                if class_name not in tag_classes:
+                    return False
+        return True
+
+class Selector(object):
+    """A compiled selector."""
+
+    def __init__(self, selector_str):
+        """Constructor. Compiles the selector."""
+        self.selector_str = selector_str
+        self.steps = [SelectorStep(step_str) for step_str in selector_str.split()]
+        super(Selector, self).__init__()
+
+    def select(self, roots, first_only):
+        """Returns the elements that the selector matches, given the elements that matched its first step."""
+        matches = roots
+        for step in self.steps[1:]:
+            next_matches = []
+            for element in matches:
+                if first_only and step is self.steps[-1]:
+                    found = element.find(step.matches)
+                    if found is not None:
+                        return [found]
+                else:
+                    next_matches.extend(element.find_all(step.matches))
+            matches = next_matches
+        if first_only:
+            return matches[0:1]
+        return matches
+
+class Field(object):
+    """Base class for a field in an extraction spec."""
+
+    # Set by the child class. TRUE if only the first element matching the selector is needed.
+    first_only = True
+
+    def __init__(self, key, selector_str, required=True):
+        """Constructor."""
+        self.key = key
+        self.selector = Selector(selector_str)
+        self.required = required
+        super(Field, self).__init__()
+
+    def extract(self, elements):
+        """Returns the field's value, given the elements that the selector matched, or None if it isn't there."""
+        """To be overridden in the child class."""
+        return None
+
+    def fragments(self, elements):
+        """Returns the elements that the field's value came from."""
+        return elements
+
+class Text(Field):
+    """The stripped text of the first matching element."""
+
+    def extract(self, elements):
+        if len(elements) == 0:
+            return None
+        return elements[0].get_text().strip()
+
+class TextList(Field):
+    """The stripped text of every matching element. If an item selector is given then the selector matches the container and"""
+    """the value is the text of the container's elements that match the item selector, which is an empty list if there are none."""
+    first_only = False
+
+    def __init__(self, key, selector_str, item_selector_str=None, required=True):
+        """Constructor."""
+        self.item_selector = None
+        if item_selector_str is not None:
+            self.item_selector = Selector(item_selector_str)
+        Field.__init__(self, key, selector_str, required)
+
+    def extract(self, elements):
+        if self.item_selector is not None:
+            if len(elements) == 0:
+                return None
+            roots = elements[0].find_all(self.item_selector.steps[0].matches)
+            elements = self.item_selector.select(roots, False)
+        elif self.required and len(elements) == 0:
+            return None
+        return [element.get_text().strip() for element in elements]
+
+class TextAfter(Field):
+    """The text following a marker, up to the end of the line, in the last matching element that contains the marker."""
+    first_only = False
+
+    def __init__(self, key, selector_str, marker, required=True):
+        """Constructor."""
+        self.marker = marker
+        Field.__init__(self, key, selector_str, required)
+
+    def extract(self, elements):
+        value = None
+        for element in elements:
+            text = element.get_text()
+            offset = text.find(self.marker)
+            if offset > 0:
+                newline_offset = text.find("\n", offset)
+                value = text[offset + len(self.marker):newline_offset].strip()
+        return value
+
+    def fragments(self, elements):
+        return [element for element in elements if element.get_text().find(self.marker) > 0]
+
+class Table(Field):
+    """A table whose first row holds the column titles. The value is a list with a dictionary, keyed by column title, per body row."""
+
+    def __init__(self, key, selector_str, prefer_link_text=False, required=True):
+        """Constructor. If prefer_link_text is set then cells containing a link use the text of the link."""
+        self.prefer_link_text = prefer_link_text
+        Field.__init__(self, key, selector_str, required)
+
+    def extract(self, elements):
+        if len(elements) == 0:
+            return None
+        table = elements[0]
+
+        # Find the column titles.
+        title_row = table.find("tr")
+        if title_row is None:
+            return None
+        titles = [column.get_text().strip() for column in title_row if isinstance(column, bs4.element.Tag)]
+        if len(titles) == 0:
+            return None
+
+        # Find the body.
+        body = table.find("tbody")
+        if body is None:
+            return None
+
+        # Parse the rows.
+        rows = []
+        for row in body.find_all("tr"):
+            item = {}
+            for title, column in zip(titles, row.find_all("td")):
+                link = column.find("a") if self.prefer_link_text else None
+                if link:
+                    item[title] = link.get_text().strip()
+                else:
+                    item[title] = column.get_text().strip()
+            rows.append(item)
+        return rows
+
+class ExtractionSpec(object):
+    """A compiled list of fields to extract from a page."""
+
+    def __init__(self, fields):
+        """Constructor."""
+        self.fields = fields
+
+        # Index the fields by the tag name of their selector's first step so that each element is only tested against the fields that could match it.
+        self.fields_by_name = {}
+        self.fields_any_name = []
+        for field in fields:
+            name = field.selector.steps[0].name
+            if name is None:
+                self.fields_any_name.append(field)
+            else:
+                self.fields_by_name.setdefault(name, []).append(field)
+        super(ExtractionSpec, self).__init__()
+
+    def find_roots(self, soup):
+        """Walks the document once and returns, for each field, the elements that match its selector's first step."""
+        roots = [[] for _ in self.fields]
+        index = dict((id(field), i) for i, field in enumerate(self.fields))
+        for element in soup.descendants:
+            if not isinstance(element, bs4.element.Tag):
+                continue
+            candidates = self.fields_by_name.get(element.name, [])
+            if len(self.fields_any_name) > 0:
+                candidates = candidates + self.fields_any_name
+            for field in candidates:
+                if field.selector.steps[0].matches(element):
+                    roots[index[id(field)]].append(element)
+        return roots
+
+    def find_elements(self, soup):
+        """Returns a list, with an entry per field, of the elements that the field's selector matches."""
+        roots = self.find_roots(soup)
+        return [field.selector.select(field_roots, field.first_only) for field, field_roots in zip(self.fields, roots)]
+
+    def extract(self, soup):
+        """Returns a dictionary of the extracted fields, or None if a required field is missing."""
+        result = {}
+        for field, elements in zip(self.fields, self.find_elements(soup)):
+            value = field.extract(elements)
+            if value is None:
+                if field.required:
+                    print("Failed to find the " + field.key + ".")
+                    return None
+                continue
+            result[field.key] = value
+        return result
+
+    def fragments(self, soup):
+        """Returns the elements that the fields were extracted from, e.g. for storing only the relevant parts of a page."""
+        fragments = []
+        for field, elements in zip(self.fields, self.find_elements(soup)):
+            fragments.extend(field.fragments(elements))
+        return fragments
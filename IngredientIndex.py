@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Inverted index from ingredient (and style) to the recipes that use it, for boolean recipe queries"""
+
+# Each recipe is given a dense integer ID. For each term, i.e. a kind and ingredient name or a style, the index keeps
+# the sorted IDs of the recipes that have it and, for the grist kind, the ingredient's share of each recipe's grist.
+# Queries are answered with set operations on those arrays. A recipe that changes is given a new ID, and the old one
+# is marked as deleted, so the index can be brought up to date without rebuilding it. On disk the ID arrays are delta
+# encoded, which makes them compress well, and stored in a compressed .npz file.
+#
+# Query syntax:
+#   Terms are an ingredient name, or part of one, e.g. citra or "flaked oats". They can be limited to one kind, e.g.
+#   hops:citra, or can be a style, e.g. style:"American IPA", which is matched exactly (once canonicalized by the caller).
+#   A grist term can be followed by a minimum share of the grist, e.g. "flaked oats" > 10%.
+#   Adjacent words that aren't operators are one term. Terms are combined with AND (which is implied between quoted or
+#   parenthesized terms), OR, NOT and parentheses, e.g. citra AND mosaic AND NOT crystal.
+
+import re
+import numpy as np
+
+STYLE_KIND = 'style'
+TERM_SEPARATOR = '\t'
+TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|(>)|"([^"]*)"|([^\s()">]+))')
+OPERATORS = ['and', 'or', 'not']
+
+def make_term(kind, name):
+    """Returns the term under which a kind and name (or a style) is indexed."""
+    return kind + TERM_SEPARATOR + name.lower()
+
+def encode_ids(ids):
+    """Delta encodes a sorted array of IDs."""
+    return np.diff(ids, prepend=np.uint32(0)).astype(np.uint32)
+
+def decode_ids(deltas):
+    """Inverse of encode_ids."""
+    return np.cumsum(deltas, dtype=np.uint32)
+
+class IngredientIndex(object):
+    """The index, and the query engine."""
+
+    def __init__(self):
+        self.urls = [] # Recipe ID -> URL
+        self.styles = [] # Recipe ID -> style
+        self.deleted = np.zeros(0, dtype=bool) # Recipe ID -> TRUE if the recipe has been replaced or deleted
+        self.ids_by_url = {} # URL -> current recipe ID
+        self.postings = {} # Term -> (sorted array of recipe IDs, array of grist shares)
+        self.pending = {} # Term -> (list of recipe IDs, list of grist shares), that haven't been merged into the postings yet
+        self.grist_kind = None
+        self.version = "" # Version of the normalization that the index was built from
+        self.watermark = 0.0 # Time up to which the index has seen all of the changes to the recipes
+        self.names_by_kind = None # Kind -> list of (lower case name, term), built when needed to resolve query terms
+        super(IngredientIndex, self).__init__()
+
+    def num_recipes(self):
+        """Returns the number of recipes in the index, not counting the deleted ones."""
+        return len(self.ids_by_url)
+
+    def num_deleted(self):
+        """Returns the number of IDs that belong to recipes that have been replaced or deleted."""
+        return len(self.urls) - len(self.ids_by_url)
+
+    def remove_recipe(self, url):
+        """Marks the recipe as deleted."""
+        recipe_id = self.ids_by_url.pop(url, None)
+        if recipe_id is not None:
+            self.deleted[recipe_id] = True
+
+    def add_recipe(self, url, style, ingredients, grist_kind=None):
+        """Adds, or replaces, a recipe. ingredients maps each kind to a list of (name, amount) tuples, where the amount may be None."""
+        """The amounts of the grist kind are used to compute each ingredient's share of the grist."""
+        self.remove_recipe(url)
+        self.grist_kind = grist_kind
+        recipe_id = len(self.urls)
+        self.urls.append(url)
+        self.styles.append(style)
+        if len(self.deleted) < len(self.urls):
+            self.reserve(len(self.urls))
+        self.ids_by_url[url] = recipe_id
+
+        grist_total = 0.0
+        if grist_kind is not None:
+            grist_total = sum([amount for _, amount in ingredients.get(grist_kind, []) if amount is not None])
+
+        # A recipe can list an ingredient more than once. It only needs one posting, with the shares added together.
+        shares = {}
+        for kind, items in ingredients.items():
+            for name, amount in items:
+                term = make_term(kind, name)
+                share = np.nan
+                if kind == grist_kind and amount is not None and grist_total > 0:
+                    share = amount / grist_total
+                if term in shares and not np.isnan(shares[term]):
+                    share = shares[term] + (0.0 if np.isnan(share) else share)
+                shares[term] = share
+        if style:
+            shares[make_term(STYLE_KIND, style)] = np.nan
+        for term, share in shares.items():
+            ids, term_shares = self.pending.setdefault(term, ([], []))
+            ids.append(recipe_id)
+            term_shares.append(share)
+        self.names_by_kind = None
+
+    def reserve(self, num_recipes):
+        """Grows the deleted flags ahead of adding recipes, so that they don't have to be grown one recipe at a time."""
+        if len(self.deleted) < len(self.urls) + num_recipes:
+            self.deleted = np.concatenate((self.deleted, np.zeros(len(self.urls) + num_recipes - len(self.deleted), dtype=bool)))
+
+    def merge_pending(self):
+        """Merges the recipes that have been added into the postings. New IDs are always larger, so the postings stay sorted."""
+        for term, (ids, shares) in self.pending.items():
+            new_ids = np.asarray(ids, dtype=np.uint32)
+            new_shares = np.asarray(shares, dtype=np.float32)
+            if term in self.postings:
+                old_ids, old_shares = self.postings[term]
+                new_ids = np.concatenate((old_ids, new_ids))
+                new_shares = np.concatenate((old_shares, new_shares))
+            self.postings[term] = (new_ids, new_shares)
+        self.pending = {}
+        self.deleted = self.deleted[:len(self.urls)]
+
+    def save(self, file_name):
+        """Writes the index to a compressed .npz file."""
+        self.merge_pending()
+        terms = sorted(self.postings.keys())
+        lengths = np.asarray([len(self.postings[term][0]) for term in terms], dtype=np.int64)
+        arrays = {}
+        arrays['urls'] = np.asarray(self.urls, dtype=str)
+        arrays['styles'] = np.asarray(self.styles, dtype=str)
+        arrays['deleted'] = self.deleted
+        arrays['terms'] = np.asarray(terms, dtype=str)
+        arrays['lengths'] = lengths
+        arrays['ids'] = np.concatenate([encode_ids(self.postings[term][0]) for term in terms]) if len(terms) > 0 else np.zeros(0, dtype=np.uint32)
+        arrays['shares'] = np.concatenate([self.postings[term][1] for term in terms]) if len(terms) > 0 else np.zeros(0, dtype=np.float32)
+        arrays['meta'] = np.asarray([self.version, repr(self.watermark), self.grist_kind or ""], dtype=str)
+        with open(file_name, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def load(self, file_name):
+        """Reads an index that was written by save."""
+        with np.load(file_name, allow_pickle=False) as arrays:
+            self.urls = arrays['urls'].tolist()
+            self.styles = arrays['styles'].tolist()
+            self.deleted = arrays['deleted'].copy()
+            self.version, watermark, grist_kind = arrays['meta'].tolist()
+            self.watermark = float(watermark)
+            self.grist_kind = grist_kind or None
+            ids = arrays['ids']
+            shares = arrays['shares']
+            start = 0
+            self.postings = {}
+            for term, length in zip(arrays['terms'].tolist(), arrays['lengths'].tolist()):
+                self.postings[term] = (decode_ids(ids[start:start + length]), shares[start:start + length])
+                start = start + length
+        self.ids_by_url = dict((url, recipe_id) for recipe_id, url in enumerate(self.urls) if not self.deleted[recipe_id])
+        self.pending = {}
+        self.names_by_kind = None
+
+    def live_ids(self):
+        """Returns the sorted IDs of the recipes that haven't been deleted."""
+        return np.flatnonzero(~self.deleted[:len(self.urls)]).astype(np.uint32)
+
+    def match_term(self, kind, text, min_share=None):
+        """Returns the sorted IDs of the recipes with an ingredient, of the given kind (or any kind, if None), whose name contains the text."""
+        """A style is matched exactly. min_share, if set, only matches recipes where the ingredient is more than that share of the grist."""
+        self.merge_pending()
+        if kind == STYLE_KIND:
+            terms = [make_term(STYLE_KIND, text)]
+        else:
+            if self.names_by_kind is None:
+                self.names_by_kind = {}
+                for term in self.postings:
+                    term_kind, name = term.split(TERM_SEPARATOR, 1)
+                    if term_kind != STYLE_KIND:
+                        self.names_by_kind.setdefault(term_kind, []).append((name, term))
+            text = text.lower()
+            terms = []
+            for term_kind, names in self.names_by_kind.items():
+                if kind is None or kind == term_kind:
+                    terms.extend([term for name, term in names if name.find(text) >= 0])
+
+        matches = []
+        for term in terms:
+            if term not in self.postings:
+                continue
+            ids, shares = self.postings[term]
+            if min_share is not None:
+                ids = ids[shares > min_share]
+            matches.append(ids)
+        if len(matches) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        if len(matches) == 1:
+            return matches[0]
+        return np.unique(np.concatenate(matches))
+
+    def query(self, query_str, term_func=None):
+        """Returns the sorted IDs of the (non-deleted) recipes that match the query. term_func, if given, is called with each term's kind and"""
+        """text and returns the text to look up, e.g. to canonicalize styles."""
+        tokens = self.tokenize(query_str)
+        ids, pos = self.parse_or(tokens, 0, term_func)
+        if pos != len(tokens):
+            raise ValueError("Unexpected " + str(tokens[pos][1]) + " in the query.")
+        return np.setdiff1d(ids, np.flatnonzero(self.deleted[:len(self.urls)]), assume_unique=True)
+
+    def tokenize(self, query_str):
+        """Splits the query into (type, value) tokens, where the type is one of '(', ')', '>', 'op' and 'term'."""
+        tokens = []
+        pos = 0
+        query_str = query_str.strip()
+        while pos < len(query_str):
+            match = TOKEN_PATTERN.match(query_str, pos)
+            if match is None or match.end() == pos:
+                raise ValueError("Can't parse the query at: " + query_str[pos:])
+            pos = match.end()
+            if match.group(1):
+                tokens.append(('(', '('))
+            elif match.group(2):
+                tokens.append((')', ')'))
+            elif match.group(3):
+                tokens.append(('>', '>'))
+            elif match.group(4) is not None:
+                tokens.append(('term', match.group(4)))
+            elif match.group(5).lower() in OPERATORS:
+                tokens.append(('op', match.group(5).lower()))
+            elif len(tokens) > 0 and tokens[-1][0] == 'term' and not tokens[-1][1].endswith(':'):
+                # Adjacent bare words are one term, e.g. flaked oats.
+                tokens[-1] = ('term', tokens[-1][1] + " " + match.group(5))
+            else:
+                tokens.append(('term', match.group(5)))
+        return tokens
+
+    def parse_or(self, tokens, pos, term_func):
+        """Parses and evaluates a list of AND expressions separated by OR."""
+        ids, pos = self.parse_and(tokens, pos, term_func)
+        while pos < len(tokens) and tokens[pos] == ('op', 'or'):
+            other_ids, pos = self.parse_and(tokens, pos + 1, term_func)
+            ids = np.union1d(ids, other_ids)
+        return ids, pos
+
+    def parse_and(self, tokens, pos, term_func):
+        """Parses and evaluates a list of NOT expressions separated by AND, or nothing at all."""
+        ids, pos = self.parse_not(tokens, pos, term_func)
+        while pos < len(tokens) and tokens[pos] != ('op', 'or') and tokens[pos][0] != ')':
+            if tokens[pos] == ('op', 'and'):
+                pos = pos + 1
+            other_ids, pos = self.parse_not(tokens, pos, term_func)
+            ids = np.intersect1d(ids, other_ids, assume_unique=True)
+        return ids, pos
+
+    def parse_not(self, tokens, pos, term_func):
+        """Parses and evaluates a term, a parenthesized expression, or NOT followed by either."""
+        if pos >= len(tokens):
+            raise ValueError("The query ended unexpectedly.")
+        token_type, value = tokens[pos]
+        if (token_type, value) == ('op', 'not'):
+            ids, pos = self.parse_not(tokens, pos + 1, term_func)
+            return np.setdiff1d(self.live_ids(), ids, assume_unique=True), pos
+        if token_type == '(':
+            ids, pos = self.parse_or(tokens, pos + 1, term_func)
+            if pos >= len(tokens) or tokens[pos][0] != ')':
+                raise ValueError("Missing ) in the query.")
+            return ids, pos + 1
+        if token_type != 'term':
+            raise ValueError("Unexpected " + value + " in the query.")
+
+        # Split off the kind, e.g. hops:citra.
+        kind = None
+        text = value
+        if text.endswith(':') and pos + 1 < len(tokens) and tokens[pos + 1][0] == 'term':
+            text = text + tokens[pos + 1][1]
+            pos = pos + 1
+        if text.find(':') > 0:
+            kind, text = text.split(':', 1)
+            kind = kind.lower()
+        if term_func is not None:
+            text = term_func(kind, text)
+        pos = pos + 1
+
+        # Minimum share of the grist, e.g. > 10%.
+        min_share = None
+        if pos < len(tokens) and tokens[pos][0] == '>':
+            if pos + 1 >= len(tokens) or tokens[pos + 1][0] != 'term':
+                raise ValueError("Expected a share after >.")
+            share_str = tokens[pos + 1][1]
+            if share_str.endswith('%'):
+                min_share = float(share_str[:-1]) / 100.0
+            else:
+                min_share = float(share_str)
+            pos = pos + 2
+        return self.match_term(kind, text, min_share), pos
+
+    def count_by_style(self, ids):
+        """Returns a list of (style, number of the given recipes of that style) tuples, most common first."""
+        counts = {}
+        for recipe_id in ids.tolist():
+            style = self.styles[recipe_id]
+            counts[style] = counts.get(style, 0) + 1
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
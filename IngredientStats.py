@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Per style ingredient statistics, aggregated in columns"""
+
+# Each ingredient use is appended, as a row, to a set of columns: the ID of its (style, kind, ingredient) group, the
+# recipe it came from, and its amount. The statistics for every group are then computed in one go from those columns.
+
+import numpy as np
+
+NAME_KEY = 'name'
+COUNT_KEY = 'count'
+MEAN_KEY = 'mean'
+MEDIAN_KEY = 'median'
+P10_KEY = 'p10'
+P90_KEY = 'p90'
+SHARE_KEY = 'share' # Average fraction of the recipe's grain bill, by weight, only for the grist kind
+RECIPES_KEY = 'recipes'
+
+def to_optional_float(value):
+    """Converts a NumPy number to a float, or None if it's not a number."""
+    if np.isnan(value):
+        return None
+    return float(value)
+
+class IngredientStats(object):
+    """Accumulates ingredient uses and computes the statistics for each ingredient of each style."""
+
+    def __init__(self, kinds, grist_kind=None):
+        """Constructor. kinds are the names of the kinds of ingredients, e.g. grains, hops and yeasts. The amounts of the"""
+        """grist kind are used to compute each ingredient's share of the grist."""
+        self.kinds = kinds
+        self.grist_kind = grist_kind
+        self.group_ids = {} # (style, kind, name) -> group ID, assigned in the order in which they are first seen
+        self.groups = [] # Group ID -> (style, kind, name)
+        self.recipe_counts = {} # Style -> number of recipes
+        self.group_column = []
+        self.recipe_column = []
+        self.amount_column = []
+        self.num_recipes = 0
+        super(IngredientStats, self).__init__()
+
+    def add_recipe(self, style, ingredients):
+        """Adds a recipe. ingredients maps each kind to a list of (name, amount) tuples, where the amount is a number or None."""
+        recipe_id = self.num_recipes
+        self.num_recipes = self.num_recipes + 1
+        self.recipe_counts[style] = self.recipe_counts.get(style, 0) + 1
+        for kind in self.kinds:
+            for name, amount in ingredients.get(kind, []):
+                key = (style, kind, name)
+                group_id = self.group_ids.get(key)
+                if group_id is None:
+                    group_id = len(self.groups)
+                    self.group_ids[key] = group_id
+                    self.groups.append(key)
+                self.group_column.append(group_id)
+                self.recipe_column.append(recipe_id)
+                self.amount_column.append(np.nan if amount is None else amount)
+
+    def compute(self):
+        """Returns a dictionary that maps each style to a dictionary with the number of recipes and, for each kind, a list of"""
+        """the statistics for each ingredient, most used first. Statistics that can't be computed are None."""
+        num_groups = len(self.groups)
+        group = np.asarray(self.group_column, dtype=np.int64)
+        recipe = np.asarray(self.recipe_column, dtype=np.int64)
+        amount = np.asarray(self.amount_column, dtype=np.float64)
+        has_amount = ~np.isnan(amount)
+
+        # Counts and means.
+        counts = np.bincount(group, minlength=num_groups)
+        num_amounts = np.bincount(group, weights=has_amount, minlength=num_groups)
+        sums = np.bincount(group, weights=np.where(has_amount, amount, 0.0), minlength=num_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / num_amounts
+
+        # Percentiles. Sorting by group, then amount, puts each group's amounts in a contiguous, ordered slice.
+        amount_groups = group[has_amount]
+        amounts = amount[has_amount]
+        sorted_amounts = amounts[np.lexsort((amounts, amount_groups))]
+        starts = np.concatenate(([0], np.cumsum(num_amounts)[:-1])).astype(np.int64)
+        def percentile(q):
+            if len(sorted_amounts) == 0:
+                return np.full(num_groups, np.nan)
+            pos = starts + q * np.maximum(num_amounts - 1, 0)
+            lo = np.clip(np.floor(pos).astype(np.int64), 0, len(sorted_amounts) - 1)
+            hi = np.clip(lo + 1, 0, len(sorted_amounts) - 1)
+            hi = np.where(lo + 1 < starts + num_amounts, hi, lo)
+            frac = pos - np.floor(pos)
+            values = sorted_amounts[lo] * (1.0 - frac) + sorted_amounts[hi] * frac
+            return np.where(num_amounts > 0, values, np.nan)
+        medians = percentile(0.5)
+        p10s = percentile(0.1)
+        p90s = percentile(0.9)
+
+        # Share of the grist, averaged over the recipes that have an amount for the ingredient.
+        is_grist_group = np.asarray([kind == self.grist_kind for _, kind, _ in self.groups], dtype=bool)
+        shares = np.full(num_groups, np.nan)
+        if self.grist_kind is not None and len(group) > 0:
+            is_grist = is_grist_group[group] & has_amount
+            recipe_totals = np.bincount(recipe, weights=np.where(is_grist, amount, 0.0), minlength=self.num_recipes)
+            totals = recipe_totals[recipe]
+            has_share = is_grist & (totals > 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                row_shares = np.where(has_share, amount / totals, 0.0)
+                shares = np.bincount(group, weights=row_shares, minlength=num_groups) / np.bincount(group, weights=has_share, minlength=num_groups)
+
+        # Assemble the results, most used first and then in the order the ingredients were first seen.
+        results = {}
+        for style, num_recipes in self.recipe_counts.items():
+            results[style] = { RECIPES_KEY: num_recipes }
+            for kind in self.kinds:
+                results[style][kind] = []
+        for group_id in np.lexsort((np.arange(num_groups), -counts)):
+            style, kind, name = self.groups[group_id]
+            stats = {}
+            stats[NAME_KEY] = name
+            stats[COUNT_KEY] = int(counts[group_id])
+            stats[MEAN_KEY] = to_optional_float(means[group_id])
+            stats[MEDIAN_KEY] = to_optional_float(medians[group_id])
+            stats[P10_KEY] = to_optional_float(p10s[group_id])
+            stats[P90_KEY] = to_optional_float(p90s[group_id])
+            if kind == self.grist_kind:
+                stats[SHARE_KEY] = to_optional_float(shares[group_id])
+            results[style][kind].append(stats)
+        return results
@@ -26,3 +26,11 @@
 URL_KEY = 'url'
 LAST_VISIT_TIME_KEY = 'last visit time'
 PAGE_SOURCE_KEY = 'page source'
+PAGE_SOURCE_REF_KEY = 'page source ref'
+HOST_KEY = 'host'
+HOST_DOMAINS_KEY = 'host domains' # The host and its parent domains, so that a site and its subdomains can be looked up with an index
+STYLE_KEY = 'style'
+STYLE_WORDS_KEY = 'style words' # The lowercase words of the style, so that styles can be searched with an index
+CANONICAL_STYLE_KEY = 'canonical style' # The style, canonicalized by RecipeWriter, so that it can be looked up exactly
+SCHEMA_VERSION_KEY = 'schema version'
+DELETED_TIME_KEY = 'deleted time'
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Runs the website modules on a page, optionally in a separate process with time and memory limits"""
+
+import logging
+import multiprocessing
+import time
+import traceback
+from bs4 import BeautifulSoup
+
+try:
+    import resource
+    HAVE_RESOURCE = True
+except ImportError:
+    HAVE_RESOURCE = False
+
+# A forked worker inherits the parent's memory and the locks held by its other threads, which can deadlock it.
+# Where possible, the worker is spawned as a fresh interpreter instead.
+try:
+    MP_CONTEXT = multiprocessing.get_context('spawn')
+except AttributeError:
+    MP_CONTEXT = multiprocessing
+
+DEFAULT_TIMEOUT_SECS = 30.0
+STARTUP_TIMEOUT_SECS = 60.0 # Maximum time for the worker to load the website modules, which isn't counted against any page
+WORKER_READY = 'ready' # Sent by the worker once it has loaded the website modules
+DEFAULT_MEMORY_LIMIT_MB = 1024
+CONTENT_KEY = 'content' # Result of a website module's parse
+FRAGMENTS_KEY = 'fragments' # Fragments of the page that a website module cares about
+PARSE_NAME = '(parse)' # Name under which the time spent building the parse tree is reported
+REASON_EXCEPTION = 'exception'
+REASON_MEMORY = 'memory'
+REASON_TIMEOUT = 'timeout'
+REASON_CRASHED = 'crashed'
+
+def run_modules(website_objs, url, raw_content, module_indexes, need_fragments, need_links):
+    """Parses the page and runs the website modules with the given indexes on it."""
+    """Returns a tuple of: a dictionary that maps each index to the module's result, the harvested links (or None if they weren't"""
+    """needed), a dictionary of the seconds spent in each module, and a list of (module name, reason, details) failures."""
+    entries = {}
+    links = None
+    timings = {}
+    failures = []
+
+    # Parse the page.
+    start_time = time.time()
+    soup = BeautifulSoup(raw_content, 'html5lib')
+    timings[PARSE_NAME] = time.time() - start_time
+
+    # Let each website object extract whatever information it wants from the page. A failure only affects that module.
+    for i in module_indexes:
+        website_obj = website_objs[i]
+        start_time = time.time()
+        try:
+            entry = { CONTENT_KEY: website_obj.parse(url, soup) }
+            if need_fragments:
+                entry[FRAGMENTS_KEY] = "\n".join([str(fragment) for fragment in website_obj.relevant_fragments(url, soup)])
+            entries[i] = entry
+        except MemoryError:
+            failures.append((website_obj.get_name(), REASON_MEMORY, "Ran out of memory."))
+        except:
+            failures.append((website_obj.get_name(), REASON_EXCEPTION, traceback.format_exc()))
+        timings[website_obj.get_name()] = time.time() - start_time
+
+    # Harvest any new URLs.
+    if need_links:
+        links = []
+        for a in soup.find_all('a', href=True):
+            links.append(a['href'])
+        links = list(dict.fromkeys(links)) # Remove duplicates
+    return entries, links, timings, failures
+
+def worker_main(conn, module_names, memory_limit_bytes):
+    """Entry point for the worker process. Loads its own copy of the website modules and runs them on the pages it is sent."""
+    if memory_limit_bytes is not None and HAVE_RESOURCE:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit_bytes, memory_limit_bytes))
+
+    import Crawler
+    website_objs = [Crawler.create_website_object(module_name) for module_name in module_names]
+    conn.send(WORKER_READY)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+
+        # None means we're shutting down.
+        if request is None:
+            return
+
+        url, raw_content, module_indexes, need_fragments, need_links = request
+        try:
+            result = run_modules(website_objs, url, raw_content, module_indexes, need_fragments, need_links)
+        except MemoryError:
+            result = ({}, None, {}, [(PARSE_NAME, REASON_MEMORY, "Ran out of memory.")])
+        except:
+            result = ({}, None, {}, [(PARSE_NAME, REASON_EXCEPTION, traceback.format_exc())])
+        conn.send(result)
+
+class ModuleStats(object):
+    """Keeps track of how long each module takes and why it failed."""
+
+    def __init__(self):
+        self.latencies = {} # Module name -> [number of pages, total seconds, maximum seconds]
+        self.failures = {} # Module name -> reason -> count
+        super(ModuleStats, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def record(self, url, timings, failures):
+        """Adds the timings and failures from running the modules on a page."""
+        for name, secs in timings.items():
+            latency = self.latencies.setdefault(name, [0, 0.0, 0.0])
+            latency[0] = latency[0] + 1
+            latency[1] = latency[1] + secs
+            latency[2] = max(latency[2], secs)
+        for name, reason, details in failures:
+            reasons = self.failures.setdefault(name, {})
+            reasons[reason] = reasons.get(reason, 0) + 1
+            self.log_error("ERROR: " + name + " failed on " + url + " (" + reason + "): " + details)
+
+    def report_str(self):
+        """Returns a human readable summary of the timings and failures."""
+        lines = []
+        for name in sorted(set(self.latencies.keys()) | set(self.failures.keys())):
+            count, total_secs, max_secs = self.latencies.get(name, [0, 0.0, 0.0])
+            line = name + ": " + str(count) + " page(s)"
+            if count > 0:
+                line = line + ", {:.3f}".format(total_secs / count) + " second(s) average, {:.3f}".format(max_secs) + " second(s) maximum"
+            for reason, reason_count in sorted(self.failures.get(name, {}).items()):
+                line = line + ", " + str(reason_count) + " " + reason
+            lines.append(line)
+        return "\n".join(lines)
+
+class ModuleSandbox(object):
+    """Runs the website modules in a worker process, which is killed and replaced when a page exceeds the limits."""
+
+    def __init__(self, module_names, timeout_secs=DEFAULT_TIMEOUT_SECS, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+        """Constructor. The module names are the file names that the worker loads the website modules from."""
+        self.module_names = module_names
+        self.timeout_secs = timeout_secs
+        self.memory_limit_bytes = None
+        if memory_limit_mb is not None and memory_limit_mb > 0:
+            self.memory_limit_bytes = memory_limit_mb * 1024 * 1024
+        self.process = None
+        self.conn = None
+        super(ModuleSandbox, self).__init__()
+
+    def start(self):
+        """Starts the worker process and waits for it to load the website modules. Returns False if it didn't."""
+        self.conn, child_conn = MP_CONTEXT.Pipe()
+        self.process = MP_CONTEXT.Process(target=worker_main, args=(child_conn, self.module_names, self.memory_limit_bytes))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        try:
+            if self.conn.poll(STARTUP_TIMEOUT_SECS) and self.conn.recv() == WORKER_READY:
+                return True
+        except EOFError:
+            pass
+        self.stop()
+        return False
+
+    def stop(self):
+        """Kills the worker process. A new one is started when it's next needed."""
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def run_modules(self, website_objs, url, raw_content, module_indexes, need_fragments, need_links):
+        """Same as the module level run_modules, but in the worker process. A page that exceeds the limits is reported as a failure of each of the modules."""
+        names = [website_objs[i].get_name() for i in module_indexes]
+        if len(names) == 0:
+            names = [PARSE_NAME]
+
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            if not self.start():
+                return {}, None, {}, [(name, REASON_CRASHED, "The worker process didn't start.") for name in names]
+
+        self.conn.send((url, raw_content, module_indexes, need_fragments, need_links))
+        if not self.conn.poll(self.timeout_secs):
+            self.stop()
+            details = "Took longer than " + str(self.timeout_secs) + " second(s)."
+            return {}, None, {}, [(name, REASON_TIMEOUT, details) for name in names]
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.stop()
+            return {}, None, {}, [(name, REASON_CRASHED, "The worker process exited.") for name in names]
+
+    def close(self):
+        """Stops the worker process."""
+        if self.process is not None and self.process.is_alive():
+            try:
+                self.conn.send(None)
+                self.process.join(1.0)
+            except:
+                pass
+        self.stop()
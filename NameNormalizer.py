@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Normalizes ingredient names according to a table of rules loaded from a data file"""
+
+# The rules file is JSON with the following (all optional) items:
+#   "substitutions": list of [pattern, replacement] pairs. The patterns are case insensitive regular expressions. They're
+#                    compiled into one expression and applied in a single pass; where more than one could match at the
+#                    same position, the earliest in the list wins.
+#   "ignored_words": words (compared case insensitively) that are dropped from the name, e.g. "malt".
+#   "stop_chars": the rest of the name is dropped from the first word that starts with one of these characters.
+#   "aliases": maps a whole normalized name to the name to use instead.
+#
+# The number of distinct names is tiny compared with the number of times they occur, so results are memoized.
+
+import hashlib
+import json
+import os
+import re
+
+DEFAULT_GRAIN_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GrainNames.json')
+
+class NameNormalizer(object):
+    """Compiled set of normalization rules."""
+
+    def __init__(self, rules):
+        """Constructor. Compiles the rules, which are a dictionary in the format described above."""
+        substitutions = rules.get('substitutions', [])
+        self.pattern = None
+        if len(substitutions) > 0:
+            self.pattern = re.compile("|".join(["(" + pattern + ")" for pattern, _ in substitutions]), re.IGNORECASE)
+
+        # Find the group that each substitution's pattern starts at, since patterns may contain groups of their own.
+        self.group_replacements = {}
+        group_index = 1
+        for pattern, replacement in substitutions:
+            self.group_replacements[group_index] = replacement
+            group_index = group_index + 1 + re.compile(pattern).groups
+
+        self.ignored_words = set([word.lower() for word in rules.get('ignored_words', [])])
+        self.stop_chars = tuple(rules.get('stop_chars', ''))
+        self.aliases = rules.get('aliases', {})
+        self.memo = {}
+        self.digest = hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest() # Changes whenever the rules do
+        super(NameNormalizer, self).__init__()
+
+    def substitute(self, match):
+        """Returns the replacement for whichever substitution matched. The group that wraps it is always the last one to close."""
+        return self.group_replacements[match.lastindex]
+
+    def normalize_uncached(self, name):
+        """Applies the rules to the name."""
+        if self.pattern is not None:
+            name = self.pattern.sub(self.substitute, name)
+
+        words = []
+        for word in name.split(' '):
+            if len(word) == 0:
+                continue
+            if word.startswith(self.stop_chars):
+                break
+            if word.lower() not in self.ignored_words:
+                words.append(word[0].upper() + word[1:]) # Make sure the first letter is capitalized.
+
+        norm_name = " ".join(words)
+        return self.aliases.get(norm_name, norm_name)
+
+    def normalize(self, name):
+        """Returns the normalized version of the name."""
+        norm_name = self.memo.get(name)
+        if norm_name is None:
+            norm_name = self.normalize_uncached(name)
+            self.memo[name] = norm_name
+        return norm_name
+
+def load_normalizer(file_name):
+    """Creates a normalizer from a JSON rules file."""
+    with open(file_name, 'r') as f:
+        return NameNormalizer(json.load(f))
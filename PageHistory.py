@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Version history of pages, stored as compressed reverse deltas"""
+
+# The newest version of each page is stored in full. Each older version is stored as a delta that rebuilds it from
+# the version after it. Reading the newest version is cheap, and pruning only ever removes the oldest versions, which
+# nothing else depends on.
+
+import argparse
+import difflib
+import json
+import logging
+import time
+import zlib
+import Database
+import Keys
+import PageStore
+
+VERSION_TIME_KEY = 'version time'
+IS_FULL_KEY = 'full'
+DATA_KEY = 'data'
+
+def encode_version(raw_content, extracted_content):
+    """Serializes the parts of a page that we keep history for. The extracted content comes first, one field per line, so that deltas are small."""
+    fields = json.dumps(extracted_content, sort_keys=True, indent=1, default=str).encode('utf-8')
+    if raw_content is None:
+        return fields
+    return fields + b'\n\x00\n' + PageStore.to_bytes(raw_content)
+
+def decode_version(data):
+    """Inverse of encode_version. Returns the raw content (or None) and the extracted content."""
+    parts = data.split(b'\n\x00\n', 1)
+    extracted_content = json.loads(parts[0].decode('utf-8'))
+    if len(parts) == 1:
+        return None, extracted_content
+    return parts[1], extracted_content
+
+def make_delta(new_data, old_data):
+    """Returns a compressed delta that rebuilds old_data from new_data."""
+    new_lines = new_data.split(b'\n')
+    old_lines = old_data.split(b'\n')
+    ops = []
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append([line.decode('latin-1') for line in old_lines[j1:j2]])
+    return zlib.compress(json.dumps(ops).encode('utf-8'), 6)
+
+def apply_delta(new_data, delta):
+    """Inverse of make_delta."""
+    new_lines = new_data.split(b'\n')
+    old_lines = []
+    for op in json.loads(zlib.decompress(delta).decode('utf-8')):
+        if len(op) == 2 and isinstance(op[0], int):
+            old_lines.extend(new_lines[op[0]:op[1]])
+        else:
+            old_lines.extend([line.encode('latin-1') for line in op])
+    return b'\n'.join(old_lines)
+
+class PageHistory(object):
+    """Base class for page version storage. The child class provides the storage primitives."""
+
+    def __init__(self):
+        self.pending = {} # URL -> (version time, encoded version), flushed along with the page writes
+        super(PageHistory, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def add_version(self, url, version_time, raw_content, extracted_content):
+        """Buffers a new version of the page. Repeated versions of the same page before a flush are coalesced."""
+        self.pending[url] = (version_time, encode_version(raw_content, extracted_content))
+
+    def flush(self):
+        """Writes the buffered versions. Each one turns the page's current full version into a delta and becomes the new full version."""
+        if len(self.pending) == 0:
+            return True
+        latest = self.load_latest_versions(list(self.pending.keys()))
+        new_versions = []
+        replaced_versions = []
+        for url in self.pending:
+            version_time, data = self.pending[url]
+            if url in latest:
+                latest_id, latest_stored = latest[url]
+                latest_data = zlib.decompress(latest_stored)
+
+                # Unchanged pages don't need a new version.
+                if latest_data == data:
+                    continue
+                replaced_versions.append((latest_id, make_delta(data, latest_data)))
+            new_versions.append((url, version_time, zlib.compress(data, 6)))
+        self.pending = {}
+        return self.save_versions(new_versions, replaced_versions)
+
+    def retrieve_versions(self, url):
+        """Returns a list of (version time, raw content, extracted content) tuples for the page, newest first."""
+        versions = []
+        data = None
+        for version_time, is_full, stored in self.load_versions(url):
+            if is_full:
+                data = zlib.decompress(stored)
+            elif data is not None:
+                data = apply_delta(data, stored)
+            else:
+                break
+            raw_content, extracted_content = decode_version(data)
+            versions.append((version_time, raw_content, extracted_content))
+        return versions
+
+    def load_latest_versions(self, urls):
+        """Returns a dictionary that maps each URL to the ID and stored (compressed) data of its full version."""
+        """To be overridden in the child class."""
+        return {}
+
+    def load_versions(self, url):
+        """Returns a list of (version time, is full, stored data) tuples for the page, newest first."""
+        """To be overridden in the child class."""
+        return []
+
+    def save_versions(self, new_versions, replaced_versions):
+        """Inserts the new full versions, given as (url, version time, compressed data) tuples, and replaces the previous full versions,"""
+        """given as (ID, delta) tuples, with their deltas. All in bulk."""
+        """To be overridden in the child class."""
+        return False
+
+    def compact(self, max_versions, max_age_secs):
+        """Deletes, in bulk, all but the newest max_versions versions of each page and any versions older than max_age_secs."""
+        """Either limit can be None. The newest version of a page is always kept."""
+        """To be overridden in the child class."""
+        return False
+
+def main():
+    """Entry point for maintaining the page history."""
+
+    # Command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", default="localhost:27017", help="URI of the database (mongodb://host:port or sqlite:///path/to/file.db).", required=False)
+    parser.add_argument("--compact", action="store_true", default=False, help="Prunes old versions according to --keep-versions and --max-age-secs.", required=False)
+    parser.add_argument("--keep-versions", type=int, default=None, help="Number of versions of each page to keep.", required=False)
+    parser.add_argument("--max-age-secs", type=int, default=None, help="Maximum age, in seconds, of the versions to keep.", required=False)
+    parser.add_argument("--url", default=None, help="Prints the versions of this page.", required=False)
+    args = parser.parse_args()
+
+    db = Database.open_database(args.db)
+    if db is None or db.page_history is None:
+        print("ERROR: No database.")
+        return
+
+    if args.compact:
+        if not db.page_history.compact(args.keep_versions, args.max_age_secs):
+            print("ERROR: Compaction failed.")
+
+    if args.url:
+        for version_time, raw_content, extracted_content in db.page_history.retrieve_versions(args.url):
+            print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(version_time)) + " " + str(extracted_content))
+
+if __name__ == "__main__":
+    main()
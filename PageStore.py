@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Compressed, content-addressed storage for raw page source"""
+
+import hashlib
+import logging
+import os
+import sys
+import traceback
+import zlib
+
+# zstandard is optional. It compresses HTML better and faster than zlib, but zlib is always available.
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+# What to do with the source of each page.
+POLICY_INLINE = 'inline' # Store the uncompressed source in the page document (the original behavior).
+POLICY_STORE = 'store' # Store the compressed source in the page store and keep a reference to it in the page document.
+POLICY_FRAGMENTS = 'fragments' # Same as POLICY_STORE, but only the fragments of the page that the website modules care about.
+POLICY_NONE = 'none' # Don't store the source at all.
+POLICIES = [POLICY_INLINE, POLICY_STORE, POLICY_FRAGMENTS, POLICY_NONE]
+
+def to_bytes(raw_content):
+    """Page source may arrive as either bytes or text."""
+    if isinstance(raw_content, bytes):
+        return raw_content
+    return raw_content.encode('utf-8')
+
+def content_hash(raw_content):
+    """Returns the address under which the given content is stored."""
+    return hashlib.sha256(to_bytes(raw_content)).hexdigest()
+
+def compress(raw_content):
+    """Returns a (codec, compressed bytes) tuple."""
+    if HAVE_ZSTD:
+        return CODEC_ZSTD, zstandard.ZstdCompressor().compress(to_bytes(raw_content))
+    return CODEC_ZLIB, zlib.compress(to_bytes(raw_content), 6)
+
+def decompress(codec, data):
+    """Inverse of compress."""
+    if codec == CODEC_ZSTD:
+        if not HAVE_ZSTD:
+            raise Exception("The zstandard module is required to read this page source.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class PageStore(object):
+    """Base class for a page store. Identical pages are only stored once."""
+
+    def __init__(self):
+        super(PageStore, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def put(self, raw_content):
+        """Stores the content, if it isn't already stored, and returns the reference to it."""
+        """To be overridden in the child class."""
+        return None
+
+    def get(self, ref):
+        """Returns the content with the given reference, or None if it isn't found."""
+        """To be overridden in the child class."""
+        return None
+
+    def flush(self):
+        """Writes anything that put has buffered."""
+        return True
+
+class FilePageStore(PageStore):
+    """Stores each page source as a compressed file on the local disk, named by its hash."""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        PageStore.__init__(self)
+
+    def make_path(self, ref, codec):
+        """Pages are spread across subdirectories so that no one directory gets too big."""
+        return os.path.join(self.root_dir, ref[0:2], ref + "." + codec)
+
+    def put(self, raw_content):
+        ref = content_hash(raw_content)
+        for codec in [CODEC_ZSTD, CODEC_ZLIB]:
+            if os.path.isfile(self.make_path(ref, codec)):
+                return ref
+        try:
+            codec, data = compress(raw_content)
+            path = self.make_path(ref, codec)
+            dir_name = os.path.dirname(path)
+            if not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+
+            # Write to a temporary file and rename so that readers never see a partial file.
+            temp_path = path + ".tmp" + str(os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+            return ref
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def get(self, ref):
+        for codec in [CODEC_ZSTD, CODEC_ZLIB]:
+            path = self.make_path(ref, codec)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    return decompress(codec, f.read())
+        return None
@@ -27,9 +27,29 @@ import bs4
 class ParseModule(object):
     """Base class for describing a parse module."""
 
+    # Increment this in the child class whenever a change would alter what parse returns, so that cached results are discarded.
+    VERSION = 1
+
     def __init__(self):
         super(ParseModule, self).__init__()
 
+    def get_name(self):
+        """Returns the name under which the module's results are cached."""
+        return self.__class__.__name__
+
+    def get_version(self):
+        """Returns the version under which the module's results are cached."""
+        return self.VERSION
+
+    def get_hosts(self):
+        """Returns the hostnames whose pages (including those of their subdomains) the module parses, so that pages are only routed"""
+        """to the modules that are likely to want them. None means that is_interesting_url is asked about every page."""
+        return None
+
+    def get_namespace(self):
+        """Returns the field under which the module's results are stored in the page document, or None to merge them into the top level."""
+        return self.get_name()
+
     def find_html_tag(self, soup):
         for child_item in list(soup.children):
             if type(child_item) == bs4.element.Tag:
@@ -49,6 +69,11 @@ class ParseModule(object):
         """To be overridden in the child class."""
         return False
 
+    def relevant_fragments(self, url, soup):
+        """Returns the list of tags, from the page, that are worth keeping when only storing fragments of the page source."""
+        """To be overridden in the child class."""
+        return []
+
     def parse(self, url, soup):
         """Parses the contents downloaded from the URL, extracts the recipe, and stores it in the database."""
         """To be overridden in the child class."""
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Parses amounts, e.g. "1 1/2 lbs", "1½ lb", "2-3 oz", "28g" and "5 gallons (19 L)", into numbers in canonical units"""
+
+# An amount is a number, optionally followed by a unit. The number can be a whole or decimal number, a fraction, a
+# mixed fraction ("1 1/2", "1-1/2", "1½") or a range ("2-3", "2 to 3"), which is taken to mean its midpoint. Units are
+# matched as whole words, so that "g" doesn't match the "g" in "kg", and are converted to the canonical unit for their
+# dimension: pounds for weights, gallons for volumes, and packages for counts.
+#
+# The same few amount strings appear over and over again, so results are cached by the input string.
+
+import collections
+import re
+
+UNIT_POUNDS = 'lb'
+UNIT_GALLONS = 'gal'
+UNIT_PACKAGES = 'pkg'
+
+# Unit name -> (canonical unit, number of canonical units in one of it).
+UNITS = {
+    'lb': (UNIT_POUNDS, 1.0), 'lbs': (UNIT_POUNDS, 1.0), 'pound': (UNIT_POUNDS, 1.0), 'pounds': (UNIT_POUNDS, 1.0), '#': (UNIT_POUNDS, 1.0),
+    'oz': (UNIT_POUNDS, 0.0625), 'ounce': (UNIT_POUNDS, 0.0625), 'ounces': (UNIT_POUNDS, 0.0625),
+    'kg': (UNIT_POUNDS, 2.20462262), 'kgs': (UNIT_POUNDS, 2.20462262), 'kilo': (UNIT_POUNDS, 2.20462262), 'kilos': (UNIT_POUNDS, 2.20462262), 'kilogram': (UNIT_POUNDS, 2.20462262), 'kilograms': (UNIT_POUNDS, 2.20462262),
+    'g': (UNIT_POUNDS, 0.00220462262), 'gr': (UNIT_POUNDS, 0.00220462262), 'gram': (UNIT_POUNDS, 0.00220462262), 'grams': (UNIT_POUNDS, 0.00220462262),
+    'mg': (UNIT_POUNDS, 0.00000220462262),
+    'gal': (UNIT_GALLONS, 1.0), 'gals': (UNIT_GALLONS, 1.0), 'gallon': (UNIT_GALLONS, 1.0), 'gallons': (UNIT_GALLONS, 1.0), 'us gal': (UNIT_GALLONS, 1.0), 'us gallon': (UNIT_GALLONS, 1.0), 'us gallons': (UNIT_GALLONS, 1.0),
+    'l': (UNIT_GALLONS, 0.264172052), 'liter': (UNIT_GALLONS, 0.264172052), 'liters': (UNIT_GALLONS, 0.264172052), 'litre': (UNIT_GALLONS, 0.264172052), 'litres': (UNIT_GALLONS, 0.264172052),
+    'ml': (UNIT_GALLONS, 0.000264172052), 'milliliter': (UNIT_GALLONS, 0.000264172052), 'milliliters': (UNIT_GALLONS, 0.000264172052), 'millilitre': (UNIT_GALLONS, 0.000264172052), 'millilitres': (UNIT_GALLONS, 0.000264172052),
+    'qt': (UNIT_GALLONS, 0.25), 'quart': (UNIT_GALLONS, 0.25), 'quarts': (UNIT_GALLONS, 0.25),
+    'pt': (UNIT_GALLONS, 0.125), 'pint': (UNIT_GALLONS, 0.125), 'pints': (UNIT_GALLONS, 0.125),
+    'cup': (UNIT_GALLONS, 0.0625), 'cups': (UNIT_GALLONS, 0.0625),
+    'fl oz': (UNIT_GALLONS, 0.0078125), 'fluid ounce': (UNIT_GALLONS, 0.0078125), 'fluid ounces': (UNIT_GALLONS, 0.0078125),
+    'tbsp': (UNIT_GALLONS, 0.00390625), 'tablespoon': (UNIT_GALLONS, 0.00390625), 'tablespoons': (UNIT_GALLONS, 0.00390625),
+    'tsp': (UNIT_GALLONS, 0.00130208333), 'teaspoon': (UNIT_GALLONS, 0.00130208333), 'teaspoons': (UNIT_GALLONS, 0.00130208333),
+    'pkg': (UNIT_PACKAGES, 1.0), 'pkgs': (UNIT_PACKAGES, 1.0), 'package': (UNIT_PACKAGES, 1.0), 'packages': (UNIT_PACKAGES, 1.0), 'packet': (UNIT_PACKAGES, 1.0), 'packets': (UNIT_PACKAGES, 1.0), 'each': (UNIT_PACKAGES, 1.0), 'ea': (UNIT_PACKAGES, 1.0),
+}
+
+VULGAR_FRACTIONS = { u'½': 0.5, u'⅓': 1.0 / 3.0, u'⅔': 2.0 / 3.0, u'¼': 0.25, u'¾': 0.75, u'⅕': 0.2, u'⅖': 0.4, u'⅗': 0.6, u'⅘': 0.8,
+    u'⅙': 1.0 / 6.0, u'⅚': 5.0 / 6.0, u'⅛': 0.125, u'⅜': 0.375, u'⅝': 0.625, u'⅞': 0.875 }
+VULGAR = u"[" + u"".join(VULGAR_FRACTIONS.keys()) + u"]"
+
+# A number: a fraction, a vulgar fraction, or a whole or decimal number optionally followed by a fraction (a mixed fraction).
+FRACTION = r"(\d+)\s*/\s*(\d+)"
+DECIMAL = r"(\d+(?:[.,]\d+)?)"
+NUMBER = u"(?:" + FRACTION + u"|(" + VULGAR + u")|" + DECIMAL + u"(?:(?:\\s+|\\s*-{1,2}\\s*|\\s+and\\s+)" + FRACTION + u"|\\s*-?\\s*(" + VULGAR + u"))?)"
+UNIT = u"(" + u"|".join([re.escape(name) for name in sorted(UNITS.keys(), key=len, reverse=True)]) + u")(?![a-z])"
+QUANTITY_PATTERN = re.compile(u"\\s*" + NUMBER + u"(?:\\s*(?:-{1,2}|–|—|to)\\s*" + NUMBER + u")?\\s*(?:" + UNIT + u")?\\.?", re.IGNORECASE | re.UNICODE)
+START_PATTERN = re.compile(u"\\d|" + VULGAR, re.UNICODE)
+UNIT_PATTERN = re.compile(u"\\s*" + UNIT + u"\\.?\\s*$", re.IGNORECASE | re.UNICODE)
+
+Quantity = collections.namedtuple('Quantity', ['value', 'unit']) # The unit is one of the canonical units, or None if there wasn't a known one
+
+def to_float(decimal_str):
+    """Converts a decimal number, where the decimal separator may be a comma, to a float. A comma followed by exactly three digits is a thousands separator."""
+    if decimal_str.find(',') >= 0:
+        whole, fraction = decimal_str.split(',', 1)
+        if len(fraction) == 3:
+            return float(whole + fraction)
+        return float(whole + '.' + fraction)
+    return float(decimal_str)
+
+def number_value(groups):
+    """Returns the value of a match of NUMBER, given its seven groups."""
+    numerator, denominator, vulgar, decimal, mixed_numerator, mixed_denominator, mixed_vulgar = groups
+    if numerator is not None:
+        return float(numerator) / float(denominator) if float(denominator) != 0 else None
+    if vulgar is not None:
+        return VULGAR_FRACTIONS[vulgar]
+    value = to_float(decimal)
+    if mixed_numerator is not None:
+        if float(mixed_denominator) == 0:
+            return None
+        value = value + float(mixed_numerator) / float(mixed_denominator)
+    elif mixed_vulgar is not None:
+        value = value + VULGAR_FRACTIONS[mixed_vulgar]
+    return value
+
+class QuantityParser(object):
+    """Parses amounts, remembering the results."""
+
+    def __init__(self):
+        self.memo = {}
+        super(QuantityParser, self).__init__()
+
+    def match(self, text, pos):
+        """Matches a quantity at the given position. Returns the match and the Quantity, or None, None."""
+        match = QUANTITY_PATTERN.match(text, pos)
+        if match is None:
+            return None, None
+        groups = match.groups()
+        value = number_value(groups[0:7])
+        if value is None:
+            return None, None
+        if groups[10] is not None or groups[9] is not None or groups[7] is not None:
+            high = number_value(groups[7:14])
+            if high is None:
+                return None, None
+            value = (value + high) / 2.0
+        unit = None
+        if groups[14] is not None:
+            unit, factor = UNITS[groups[14].lower()]
+            value = value * factor
+        return match, Quantity(value, unit)
+
+    def parse_uncached(self, text):
+        """Returns the first Quantity in the text, or None if there isn't one."""
+        start = START_PATTERN.search(text)
+        if start is None:
+            return None
+        _, quantity = self.match(text, start.start())
+        return quantity
+
+    def parse(self, text):
+        """Returns the first Quantity in the text, or None if there isn't one."""
+        if text is None:
+            return None
+        if text in self.memo:
+            return self.memo[text]
+        quantity = self.parse_uncached(text)
+        self.memo[text] = quantity
+        return quantity
+
+    def parse_many(self, texts):
+        """Batch version of parse. Each distinct string is only parsed once."""
+        return [self.parse(text) for text in texts]
+
+    def split_quantity(self, text):
+        """Splits text that starts with an amount, e.g. "1 1/2 lb Pale Malt", into the amount, its Quantity and the rest."""
+        """Returns None, None and the text if it doesn't start with one."""
+        match, quantity = self.match(text, 0)
+        if match is None:
+            return None, None, text
+
+        # The amount has to be a word of its own, e.g. "2-Row" is a name, not an amount.
+        end = len(text[:match.end()].rstrip())
+        if end < len(text) and (text[end].isalnum() or text[end] == '-'):
+            return None, None, text
+        return text[:end].strip(), quantity, text[end:].strip()
+
+    def is_unit(self, text):
+        """Returns TRUE if the text is a unit."""
+        return UNIT_PATTERN.match(text) is not None
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Recipe vectors, for finding similar recipes and clusters of duplicate recipes"""
+
+# Each recipe is a sparse vector with one dimension per (kind, ingredient). Within each kind, the values are the
+# ingredient's share of that kind's total amount (or an equal share, if the amounts are missing), times the kind's
+# weight, so that e.g. the grist counts for more than the single yeast. These are the recipe's proportions. The vector
+# is also scaled to unit length, so the dot product of two vectors is their cosine similarity. The vectors are kept as
+# compressed sparse rows in NumPy arrays, so scoring every recipe against a query is one pass over the non-zero values.
+#
+# Duplicates are found with MinHash signatures of each recipe's set of ingredients and locality sensitive hashing: the
+# signatures are cut into bands and recipes that agree on all of a band's values become candidates. Two recipes are
+# duplicates if their cosine similarity is high enough and their proportions are close. A cluster of duplicates starts
+# at its first recipe, and every other recipe in it is a duplicate of that first recipe, so clusters can't grow by
+# chaining recipes that are each only a little different from the last.
+
+import numpy as np
+
+DEFAULT_NUM_HASHES = 64
+DEFAULT_NUM_BANDS = 16 # Each band has DEFAULT_NUM_HASHES / DEFAULT_NUM_BANDS hashes
+DEFAULT_DUPLICATE_THRESHOLD = 0.95 # Minimum cosine similarity of two recipes that are considered duplicates
+DEFAULT_MAX_DUPLICATE_DISTANCE = 0.05 # Maximum sum of the differences in the (weighted) proportions of two duplicate recipes, between 0 and 2
+HASH_PRIME = (1 << 31) - 1
+SIGNATURE_BLOCK_SIZE = 4096 # Number of recipes whose MinHash signatures are computed at a time
+MAX_BUCKET_NEIGHBORS = 32 # Number of earlier recipes in the same bucket that each recipe becomes a candidate pair with
+
+class RecipeVectors(object):
+    """The vectors of a set of recipes."""
+
+    def __init__(self, kind_weights=None):
+        """Constructor. kind_weights maps each kind of ingredient to its share of the recipe, kinds that aren't in it have a weight of one."""
+        self.kind_weights = kind_weights or {}
+        self.terms = {} # (kind, name) -> dimension
+        self.indptr = [0] # Recipe -> start of its values in indices, data and proportions
+        self.indices = []
+        self.data = []
+        self.proportions = []
+        super(RecipeVectors, self).__init__()
+
+    def num_recipes(self):
+        """Returns the number of recipes."""
+        return len(self.indptr) - 1
+
+    def add_recipe(self, ingredients):
+        """Adds a recipe and returns its row. ingredients maps each kind to a list of (name, amount) tuples, where the amount may be None."""
+        values = {}
+        for kind, items in ingredients.items():
+            if len(items) == 0:
+                continue
+            weight = self.kind_weights.get(kind, 1.0)
+            total = sum([amount for _, amount in items if amount is not None and amount > 0])
+            for name, amount in items:
+                if total > 0:
+                    value = weight * amount / total if amount is not None and amount > 0 else 0.0
+                else:
+                    value = weight / len(items)
+                dimension = self.terms.setdefault((kind, name), len(self.terms))
+                values[dimension] = values.get(dimension, 0.0) + value
+
+        # Scale to unit length.
+        norm = np.sqrt(sum([value * value for value in values.values()]))
+        for dimension in sorted(values.keys()):
+            if values[dimension] > 0:
+                self.indices.append(dimension)
+                self.data.append(values[dimension] / norm)
+                self.proportions.append(values[dimension])
+        self.indptr.append(len(self.indices))
+        return self.num_recipes() - 1
+
+    def finish(self):
+        """Converts the rows to NumPy arrays. Must be called after the last recipe is added and before any queries."""
+        self.indptr = np.asarray(self.indptr, dtype=np.int64)
+        self.indices = np.asarray(self.indices, dtype=np.int64)
+        self.data = np.asarray(self.data, dtype=np.float32)
+        self.proportions = np.asarray(self.proportions, dtype=np.float32)
+        self.row_of_value = np.repeat(np.arange(self.num_recipes()), np.diff(self.indptr))
+
+    def get_vector(self, row):
+        """Returns the dense vector of the recipe in the given row."""
+        vector = np.zeros(len(self.terms), dtype=np.float32)
+        start, end = self.indptr[row], self.indptr[row + 1]
+        vector[self.indices[start:end]] = self.data[start:end]
+        return vector
+
+    def similarities(self, vector):
+        """Returns the cosine similarity of every recipe to the given dense vector."""
+        return np.bincount(self.row_of_value, weights=self.data * vector[self.indices], minlength=self.num_recipes())
+
+    def top_k(self, row, k):
+        """Returns a list of (row, similarity) tuples for the k recipes most similar to the one in the given row, most similar first."""
+        scores = self.similarities(self.get_vector(row))
+        scores[row] = -np.inf
+        k = min(k, len(scores) - 1)
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(int(other_row), float(scores[other_row])) for other_row in best]
+
+    def minhash_signatures(self, num_hashes=DEFAULT_NUM_HASHES, seed=1):
+        """Returns a (recipes x num_hashes) array of the MinHash signatures of each recipe's set of ingredients."""
+        random_state = np.random.RandomState(seed)
+        a = random_state.randint(1, HASH_PRIME, size=num_hashes).astype(np.int64)
+        b = random_state.randint(0, HASH_PRIME, size=num_hashes).astype(np.int64)
+        signatures = np.full((self.num_recipes(), num_hashes), HASH_PRIME, dtype=np.int64)
+
+        # Hash every (recipe, ingredient) value with every hash function, then take the minimum over each recipe's values.
+        # A block of recipes at a time, to bound the memory used by the hashes.
+        for first_row in range(0, self.num_recipes(), SIGNATURE_BLOCK_SIZE):
+            rows = np.arange(first_row, min(first_row + SIGNATURE_BLOCK_SIZE, self.num_recipes()))
+            starts = self.indptr[rows]
+            has_values = self.indptr[rows + 1] > starts
+            if not np.any(has_values):
+                continue
+            indices = self.indices[starts[0]:self.indptr[rows[-1] + 1]]
+            hashes = (indices[:, None] * a[None, :] + b[None, :]) % HASH_PRIME
+            signatures[rows[has_values]] = np.minimum.reduceat(hashes, starts[has_values] - starts[0], axis=0)
+        return signatures
+
+    def candidate_pairs(self, signatures, num_bands=DEFAULT_NUM_BANDS):
+        """Returns the set of (row, row) pairs of recipes whose signatures are the same in at least one band. Each recipe in a"""
+        """band's bucket is only paired with the MAX_BUCKET_NEIGHBORS recipes before it, so a large bucket (e.g. of clones) is"""
+        """linear, not quadratic. Clusters grow through their members' pairs, so the clones still end up in one cluster."""
+        pairs = set()
+        rows_per_band = signatures.shape[1] // num_bands
+        has_values = np.diff(self.indptr) > 0
+        for band in range(num_bands):
+            band_signatures = np.ascontiguousarray(signatures[:, band * rows_per_band:(band + 1) * rows_per_band])
+            buckets = {}
+            for row in np.flatnonzero(has_values).tolist():
+                bucket = buckets.setdefault(band_signatures[row].tobytes(), [])
+                for other in bucket[-MAX_BUCKET_NEIGHBORS:]:
+                    pairs.add((other, row))
+                bucket.append(row)
+        return pairs
+
+    def duplicate_clusters(self, threshold=DEFAULT_DUPLICATE_THRESHOLD, max_distance=DEFAULT_MAX_DUPLICATE_DISTANCE, num_hashes=DEFAULT_NUM_HASHES, num_bands=DEFAULT_NUM_BANDS):
+        """Returns an array that maps each recipe's row to the row of the first recipe in its cluster of duplicates (itself, if it doesn't have any)."""
+        """Every recipe in a cluster is a duplicate (see is_duplicate) of the cluster's first recipe."""
+        neighbors = {}
+        for row, other in self.candidate_pairs(self.minhash_signatures(num_hashes), num_bands):
+            neighbors.setdefault(row, []).append(other)
+            neighbors.setdefault(other, []).append(row)
+
+        # Grow a cluster from each recipe that isn't in one yet, in order. The candidates are the neighbors of the cluster's
+        # members, since two duplicates of the first recipe may only have been paired with each other.
+        roots = np.full(self.num_recipes(), -1, dtype=np.int64)
+        for row in range(self.num_recipes()):
+            if roots[row] >= 0:
+                continue
+            roots[row] = row
+            members = [row]
+            rejected = set()
+            while len(members) > 0:
+                for other in neighbors.get(members.pop(), []):
+                    if roots[other] >= 0 or other in rejected:
+                        continue
+                    if self.is_duplicate(row, other, threshold, max_distance):
+                        roots[other] = row
+                        members.append(other)
+                    else:
+                        rejected.add(other)
+        return roots
+
+    def is_duplicate(self, row, other, threshold=DEFAULT_DUPLICATE_THRESHOLD, max_distance=DEFAULT_MAX_DUPLICATE_DISTANCE):
+        """Returns TRUE if the cosine similarity of two recipes is at least the threshold and the sum of the differences in their"""
+        """proportions is at most the maximum distance."""
+        if self.similarity(row, other) < threshold:
+            return False
+        start, end = self.indptr[row], self.indptr[row + 1]
+        other_start, other_end = self.indptr[other], self.indptr[other + 1]
+        positions, other_positions = self.shared_positions(row, other)
+
+        # The ingredients that only one of them has count in full, and the shared ones count by how much they differ.
+        proportions = self.proportions[start:end]
+        other_proportions = self.proportions[other_start:other_end]
+        shared = proportions[positions]
+        other_shared = other_proportions[other_positions]
+        distance = np.sum(proportions) + np.sum(other_proportions) - np.sum(shared + other_shared - np.abs(shared - other_shared))
+        return float(distance) <= max_distance
+
+    def shared_positions(self, row, other):
+        """Returns the positions, within each of the two recipes' values, of the ingredients that they have in common."""
+        start, end = self.indptr[row], self.indptr[row + 1]
+        other_start, other_end = self.indptr[other], self.indptr[other + 1]
+        _, positions, other_positions = np.intersect1d(self.indices[start:end], self.indices[other_start:other_end], assume_unique=True, return_indices=True)
+        return positions, other_positions
+
+    def similarity(self, row, other):
+        """Returns the cosine similarity of two recipes."""
+        start, end = self.indptr[row], self.indptr[row + 1]
+        other_start, other_end = self.indptr[other], self.indptr[other + 1]
+        positions, other_positions = self.shared_positions(row, other)
+        return float(np.dot(self.data[start:end][positions], self.data[other_start:other_end][other_positions]))
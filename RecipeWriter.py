@@ -22,13 +22,37 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import CrawlerDatabase
+import ColumnarExport
+import Database
+import IngredientIndex
+import IngredientStats
+import Keys
+import NameNormalizer
+import Quantity
+import RecipeSimilarity
+import StyleCanonicalizer
+import StyleStats
 import argparse
 import collections
+import gzip
+import io
+import itertools
 import json
+import multiprocessing
+import numpy as np
+import os
 import re
+import sys
+import time
+
+# Import things so that they have the same name regardless of whether we are using python2 or python3.
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
 
 ID_KEY = '_id'
+TITLE_KEY = 'title'
 STYLE_KEY = 'style'
 YIELD_SIZE_KEY = 'yield size'
 GRAINS_KEY = 'grains'
@@ -39,140 +63,94 @@ AMOUNT_KEY = 'Amount'
 VARIETY_KEY = 'Variety'
 BOIL_KEY = 'Boil'
 COMMMON_HOPS = ['amarillo', 'cascade', 'centennial', 'citra', 'chinook', 'columbus', 'equinox', 'fuggles', 'kent goldings', 'golding', 'magnum', 'mosaic', 'victory', 'warrior']
-UNITS = ['lb', 'oz', 'g', 'tsp', 'tbsp', 'pkg', 'ounce', 'teaspoon', 'cup', 'pound', 'gal']
 
 SEARCH_LIST_FUNC = lambda x,y : x.find(y) >= 0
 
+NORMALIZED_KEY = 'normalized' # Normalized copy of a recipe's ingredients, so that the database can compute statistics
+NORMALIZED_VERSION_KEY = 'version'
+NORMALIZED_TIME_KEY = 'time' # The last visit time of the recipe that was normalized
+NORMALIZED_YIELD_KEY = 'yield'
+NORMALIZED_AMOUNT_KEY = 'amount'
+NORMALIZED_STYLE_KEY = 'style' # Canonical style, under which the recipe is counted in the style statistics (see StyleStats)
+NORMALIZATION_VERSION = 5 # Increment whenever a change to the code would change the normalized ingredients
+
+WATERMARK_SAFETY_SECS = 300 # How far behind the present an incremental export's watermark stays
+EXPORT_BATCH_SIZE = 500 # Number of recipes that a streaming export hands to a worker process at a time
+DEFAULT_INDEX_FILE = 'ingredient_index.npz'
+SIMILARITY_KIND_WEIGHTS = { GRAINS_KEY: 0.7, HOPS_KEY: 0.2, YEASTS_KEY: 0.1 } # How much each kind of ingredient counts for when comparing recipes
+
+# The only fields we need from the database, so that page source and everything else stays in the database.
+RECIPE_FIELDS = [Keys.URL_KEY, Keys.HOST_KEY, Keys.LAST_VISIT_TIME_KEY, TITLE_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+
+g_export_writer = None # The RecipeWriter used by a streaming export's worker process
+
+def init_export_worker(grain_rules_file):
+    """Initializes a streaming export's worker process."""
+    global g_export_writer
+    g_export_writer = RecipeWriter(grain_rules_file)
+
+def normalize_export_batch(pages):
+    """Normalizes a batch of recipes in a streaming export's worker process and returns them as newline delimited JSON."""
+    return "".join([json.dumps(g_export_writer.normalize_recipe(page)) + "\n" for page in pages])
+
 class RecipeWriter(object):
     """Reads beer recipes from the database and generates a new recipe."""
 
-    def __init__(self):
+    def __init__(self, grain_rules_file=NameNormalizer.DEFAULT_GRAIN_RULES_FILE, style_rules_file=StyleCanonicalizer.DEFAULT_STYLE_RULES_FILE):
+        """Constructor. The grain rules file holds the rules for normalizing grain names, see NameNormalizer. The style rules file"""
+        """holds the rules for canonicalizing style names, see StyleCanonicalizer."""
+        self.grain_rules_file = grain_rules_file
+        self.grain_normalizer = NameNormalizer.load_normalizer(grain_rules_file)
+        self.style_canonicalizer = StyleCanonicalizer.load_canonicalizer(style_rules_file)
+        self.quantity_parser = Quantity.QuantityParser()
         super(RecipeWriter, self).__init__()
 
     def capitalize(self, input):
         """Utility function for capitalizing the first letter in a string."""
-        input_parts = list(input)
-        input_parts[0] = input_parts[0].upper()
-        return "".join(input_parts)
-
-    def remove_letters(self, input):
-        """Utility function for removing all letters from a string."""
-        new = ""
-        for letter in input:
-            if not(letter.isalpha()):
-                new += letter
-        return new
+        return input[0].upper() + input[1:]
 
     def normalize_grain_name(self, grain_name):
         """Tries to cleanup the various names that people use for the same grain."""
-        pattern = re.compile("Caramel.*/.*Crystal", re.IGNORECASE)
-        grain_name = pattern.sub("Crystal", grain_name)
-
-        pattern = re.compile("American 2-row", re.IGNORECASE)
-        grain_name = pattern.sub("Pale 2-Row", grain_name)
-
-        pattern = re.compile("Pale Ale 2-Row", re.IGNORECASE)
-        grain_name = pattern.sub("Pale 2-Row", grain_name)
-
-        pattern = re.compile("2-row", re.IGNORECASE)
-        grain_name = pattern.sub("2-Row", grain_name)
-
-        pattern = re.compile("Barley, Flaked", re.IGNORECASE)
-        grain_name = pattern.sub("Flaked Barley", grain_name)
-
-        pattern = re.compile("Oats, Flaked", re.IGNORECASE)
-        grain_name = pattern.sub("Flaked Oats", grain_name)
-
-        pattern = re.compile("Crystal.*-", re.IGNORECASE)
-        grain_name = pattern.sub("Crystal", grain_name)
-
-        pattern = re.compile("Caramel", re.IGNORECASE)
-        grain_name = pattern.sub("Crystal", grain_name)
-
-        pattern = re.compile("Cara-Pils/Dextrine", re.IGNORECASE)
-        grain_name = pattern.sub("Carapils", grain_name)
+        return self.grain_normalizer.normalize(grain_name)
 
-        pattern = re.compile("Cara-Pils", re.IGNORECASE)
-        grain_name = pattern.sub("Carapils", grain_name)
-
-        norm_name = ""
-        parts = grain_name.split(' ')
-        for part in parts:
-
-            part_lower = part.lower()
-            if len(part_lower) == 0:
-                continue
-            if part_lower[0] in ['(', '[']:
-                break
-
-            # The world 'malt' is redundant so ignore it.
-            if part_lower != 'malt':
-
-                # Make sure the first letter is capitalized.
-                part = self.capitalize(part)
-                norm_name += part
-                norm_name += " "
-
-        norm_name = norm_name.strip()
-        if norm_name == "Pale":
-            norm_name = "Pale 2-Row"
-        return norm_name
-
-    def to_number(self, num_str):
-        """Utility method for string to number conversion and cleanup."""
-        new_str = self.remove_letters(num_str)
-        if new_str == "1--1/2": # Filty hack to handle an annoying case
-            return float(1.5)
-        fraction_parts = new_str.split('/')
-        if len(fraction_parts) == 1:
-            return float(new_str)
-        return float(fraction_parts[0]) / float(fraction_parts[1])
-
-    def normalize_amount_str(self, amount, scale):
-        """Tries to cleanup the various ways people express amounts."""
-        parts = amount.split(' ')
-        if len(parts) < 2: # Sanity check
+    def normalize_amount_str(self, amount, quantity, scale):
+        """Tries to cleanup the various ways people express amounts, given the amount and its Quantity. Weights become pounds and volumes become gallons."""
+        if quantity is None:
             return amount
-
-        if any([SEARCH_LIST_FUNC(amount.lower(), i) for i in ['lb', 'pound']]):
-            parts[0] = str(self.to_number(parts[0]) * scale)
-            parts[1] = "lbs"
-        if any([SEARCH_LIST_FUNC(amount.lower(), i) for i in ['kg', 'kilogram']]):
-            parts[0] = str(self.to_number(parts[0]) * scale * 2.2)
-            parts[1] = "lbs"
-        if any([SEARCH_LIST_FUNC(amount.lower(), i) for i in ['oz', 'ounce']]):
-            parts[0] = str(self.to_number(parts[0]) * scale * 0.0625)
-            parts[1] = "lbs"
-        if any([SEARCH_LIST_FUNC(amount.lower(), i) for i in ['gal', 'gallon', 'us gallon']]):
-            parts[0] = str(self.to_number(parts[0]) * scale)
-            parts[1] = "gallons"
-        if any([SEARCH_LIST_FUNC(amount.lower(), i) for i in ['liter', 'litre']]):
-            parts[0] = str(self.to_number(parts[0]) * scale * 0.264172)
-            parts[1] = "gallons"
-
-        amount = parts[0] + " " + parts[1]
+        if quantity.unit == Quantity.UNIT_POUNDS:
+            return str(quantity.value * scale) + " lbs"
+        if quantity.unit == Quantity.UNIT_GALLONS:
+            return str(quantity.value * scale) + " gallons"
         return amount
 
     def normalize_grains_and_hops(self, grains, hops, scale):
         """Since the recipes were collected from multiple sites, this attempts to normalize their structure."""
         """Some recipe writers put the grains and the hops together, so we have to deal with that."""
+        """The given grains and hops are left as they are, the normalized ones are copies."""
         if grains is None:
             return grains, hops
+        parsed_grains, parsed_hops = self.parse_grains_and_hops(grains, hops, scale)
+        return [grain for grain, _ in parsed_grains], [hop for hop, _ in parsed_hops]
 
+    def parse_grains_and_hops(self, grains, hops, scale):
+        """Does the work of normalize_grains_and_hops. Returns lists of (normalized grain, Quantity) and (normalized hop, Quantity)"""
+        """tuples, where the Quantity is the parsed amount, before scaling, or None if it doesn't have one."""
         new_grains = []
         new_hops = []
 
         ignore_strs = ['[', '#', 'dme', 'extract', 'gypsum', 'honey', 'moss', 'sugar', 'syrup', 'total', 'water', 'whirlfloc', 'yeast']
 
         # Normalize grains, some websites lump the hops in with the grains for whatever reason.
-        for grain in grains:
+        for grain in grains or []:
 
             # Was this formatted in a nice is python dictionary for us?
             if isinstance(grain, dict):
 
                 # Do we have a dictionary with valid items?
                 if AMOUNT_KEY in grain and FERMENTABLES_KEY in grain:
-                    
+
+                    # Work on a copy, the caller's recipe may be about to be stored as it is.
+                    grain = dict(grain)
                     amount = grain[AMOUNT_KEY]
                     fermentables = grain[FERMENTABLES_KEY]
 
@@ -187,14 +165,14 @@ class RecipeWriter(object):
                         continue
 
                     # Normalize the amount.
-                    amount = self.normalize_amount_str(amount, scale)
-                    grain[AMOUNT_KEY] = amount
+                    quantity = self.quantity_parser.parse(amount)
+                    grain[AMOUNT_KEY] = self.normalize_amount_str(amount, quantity, scale)
 
                     # Normalize the grain name.
                     norm_name = self.normalize_grain_name(grain[FERMENTABLES_KEY])
                     if len(norm_name) > 1:
                         grain[FERMENTABLES_KEY] = norm_name
-                        new_grains.append(grain)
+                        new_grains.append((grain, quantity))
 
             else:
                 # Does the string contain junk?
@@ -207,22 +185,15 @@ class RecipeWriter(object):
                 desc = ""
                 boil = ""
 
-                # Should start with an amount.
-                parts = grain.split(' ')
-                amount = parts[0]
-                del parts[0]
-
-                # Sanity check.
-                if len(parts) == 0:
-                    continue
-
-                # Is the second part the units?
-                matched_units = [SEARCH_LIST_FUNC(parts[0].lower(), i) for i in UNITS]
-                if any(matched_units):
-                    amount += " "
-                    amount += parts[0]
-                    amount = self.normalize_amount_str(amount, scale)
+                # Should start with an amount, which may or may not have units.
+                amount, quantity, rest = self.quantity_parser.split_quantity(grain)
+                if amount is None:
+                    parts = grain.split(' ')
+                    amount = parts[0]
                     del parts[0]
+                else:
+                    parts = rest.split(' ') if len(rest) > 0 else []
+                    amount = self.normalize_amount_str(amount, quantity, scale)
                 if '-' in parts:
                     parts.remove('-')
 
@@ -266,72 +237,272 @@ class RecipeWriter(object):
                     grain[FERMENTABLES_KEY] = desc
                     if len(amount) > 0:
                         grain[AMOUNT_KEY] = amount
-                    new_grains.append(grain)
+                    new_grains.append((grain, quantity))
 
                 # Did we find any hops?
                 elif is_hop and len(desc) > 0:
-                    hops = {}
-                    hops[VARIETY_KEY] = desc.strip()
+                    hop = {}
+                    hop[VARIETY_KEY] = desc.strip()
                     if len(amount) > 0:
-                        hops[AMOUNT_KEY] = amount
+                        hop[AMOUNT_KEY] = amount
                     if len(boil) > 0:
-                        hops[BOIL_KEY] = boil
-                    new_hops.append(hops)
+                        hop[BOIL_KEY] = boil
+                    new_hops.append((hop, quantity))
 
-        # Normalize hops.
-        for hop in hops:
-            if isinstance(hop, dict):
-                new_hops.append(hop)
+        # Normalize hops, parsing their amounts in one batch.
+        if hops is not None:
+            hops = [dict(hop) for hop in hops if isinstance(hop, dict)]
+            new_hops.extend(zip(hops, self.quantity_parser.parse_many([hop.get(AMOUNT_KEY) for hop in hops])))
 
         return new_grains, new_hops
 
-    def compute_avg_amount(self, grains, grain_name):
-        """Looks through the (normalized) grains list for the specified grain and compute the average amount used."""
-        avg_amount = 0.0
-        count = 0.0
-        for grain in grains:
-            if grain[FERMENTABLES_KEY] == grain_name:
-                if AMOUNT_KEY in grain:
-                    amount_str_parts = grain[AMOUNT_KEY].split(' ')
-                    temp_amount = float(amount_str_parts[0])
-                    avg_amount = avg_amount + temp_amount
-                    count = count + 1.0
-        return avg_amount / count
-
-    def generate_avg_recipe(self, db, style, desired_yield):
+    def amount_to_number(self, quantity, unit, scale=1.0):
+        """Returns the value of a parsed amount, times the scale, or None if there isn't one or it isn't in the given canonical unit."""
+        if quantity is None or quantity.unit != unit:
+            return None
+        return quantity.value * scale
+
+    def normalize_ingredients(self, page):
+        """Normalizes the recipe's yield and ingredients, without scaling them. Returns the yield, in gallons (or None), and a"""
+        """dictionary that maps each of grains, hops and yeasts to a list of (name, amount) tuples, where the amount may be None."""
+        yield_gallons = None
+        if YIELD_SIZE_KEY in page:
+            yield_gallons = self.amount_to_number(self.quantity_parser.parse(page[YIELD_SIZE_KEY]), Quantity.UNIT_GALLONS)
+
+        # The amounts are used as they were parsed, rather than parsing the normalized amount strings again. Grains are weighed in
+        # pounds and hops in ounces.
+        parsed_grains, parsed_hops = self.parse_grains_and_hops(page.get(GRAINS_KEY), page.get(HOPS_KEY), 1.0)
+
+        ingredients = {}
+        ingredients[GRAINS_KEY] = [(grain[FERMENTABLES_KEY], self.amount_to_number(quantity, Quantity.UNIT_POUNDS)) for grain, quantity in parsed_grains]
+        ingredients[HOPS_KEY] = [(hop[VARIETY_KEY], self.amount_to_number(quantity, Quantity.UNIT_POUNDS, 16.0)) for hop, quantity in parsed_hops if VARIETY_KEY in hop]
+        ingredients[YEASTS_KEY] = [(yeast, None) for yeast in page.get(YEASTS_KEY, [])]
+        return yield_gallons, ingredients
+
+    def compute_ingredient_stats(self, pages, desired_yield, by_style=True):
+        """Normalizes the recipes, scaling the grains and hops to the desired yield, and computes the statistics for each ingredient in a single pass."""
+        """Returns a dictionary that maps each style (or just None, if by_style is FALSE) to the number of recipes and, for each of"""
+        """grains, hops and yeasts, a list of the statistics for each ingredient, most used first. See IngredientStats."""
+        stats = IngredientStats.IngredientStats([GRAINS_KEY, HOPS_KEY, YEASTS_KEY], GRAINS_KEY)
+
+        # The recipes were collected from various sites and will need normalizing.
+        for page in pages:
+            yield_gallons, ingredients = self.normalize_ingredients(page)
+
+            # Scale the recipe; will try to nomalize on the desired yield.
+            if yield_gallons:
+                scale = desired_yield / yield_gallons
+                for kind in [GRAINS_KEY, HOPS_KEY]:
+                    ingredients[kind] = [(name, None if amount is None else amount * scale) for name, amount in ingredients[kind]]
+
+            stats.add_recipe(self.normalize_style(page.get(STYLE_KEY)) if by_style else None, ingredients)
+
+        return stats.compute()
+
+    def normalize_style(self, style):
+        """Returns the canonical name of the style, under which recipes of that style are grouped."""
+        return self.style_canonicalizer.canonicalize(style)
+
+    def get_normalization_version(self):
+        """Returns the version of the normalization, which changes whenever the code or the grain rules do."""
+        return str(NORMALIZATION_VERSION) + ":" + self.grain_normalizer.digest + ":" + self.style_canonicalizer.digest
+
+    def make_normalized_field(self, page):
+        """Returns the normalized copy of the recipe's ingredients that is stored with the recipe for the database to compute statistics from."""
+        yield_gallons, ingredients = self.normalize_ingredients(page)
+        normalized = {}
+        normalized[NORMALIZED_VERSION_KEY] = self.get_normalization_version()
+        normalized[NORMALIZED_TIME_KEY] = page.get(Keys.LAST_VISIT_TIME_KEY, 0)
+        normalized[NORMALIZED_YIELD_KEY] = yield_gallons
+        normalized[NORMALIZED_STYLE_KEY] = self.normalize_style(page.get(STYLE_KEY))
+        for kind in [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]:
+            items = []
+            for name, amount in ingredients[kind]:
+                item = { IngredientStats.NAME_KEY: name }
+                if amount is not None:
+                    item[NORMALIZED_AMOUNT_KEY] = amount
+                items.append(item)
+            normalized[kind] = items
+        return normalized
+
+    def make_normalized_fields(self, page):
+        """Returns the fields that normalization adds to a recipe: the normalized copy of its ingredients and its canonical style."""
+        normalized = self.make_normalized_field(page)
+        return { NORMALIZED_KEY: normalized, Keys.CANONICAL_STYLE_KEY: normalized[NORMALIZED_STYLE_KEY] }
+
+    def normalize_stored_recipes(self, db):
+        """Stores a normalized copy of the ingredients with each recipe that doesn't have an up to date one. Returns the number of recipes updated."""
+        version = self.get_normalization_version()
+        num_updated = 0
+        fields = [Keys.URL_KEY, Keys.LAST_VISIT_TIME_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY, NORMALIZED_KEY]
+        for page in db.query_pages(has_fields=[GRAINS_KEY], fields=fields):
+            normalized = page.get(NORMALIZED_KEY)
+            if normalized and normalized.get(NORMALIZED_VERSION_KEY) == version and normalized.get(NORMALIZED_TIME_KEY, 0) >= page.get(Keys.LAST_VISIT_TIME_KEY, 0):
+                continue
+            db.queue_page_write(page[Keys.URL_KEY], self.make_normalized_fields(page))
+            num_updated = num_updated + 1
+        db.flush_page_writes()
+        return num_updated
+
+    def update_style_stats(self, style_stats, normalized, sign=1):
+        """Adds the recipe with the given normalized copy of the ingredients to the style statistics, or subtracts it if sign is -1."""
+        """Normalized copies from before the style was part of them were never counted, so they are ignored."""
+        if not normalized or NORMALIZED_STYLE_KEY not in normalized:
+            return
+        ingredients = {}
+        for kind in [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]:
+            ingredients[kind] = [(item[IngredientStats.NAME_KEY], item.get(NORMALIZED_AMOUNT_KEY)) for item in normalized.get(kind, [])]
+        style_stats.add_recipe(normalized[NORMALIZED_STYLE_KEY], normalized.get(NORMALIZED_YIELD_KEY), ingredients, GRAINS_KEY, sign)
+
+    def rebuild_style_stats(self, db):
+        """Brings the normalized copies of the ingredients up to date and then recomputes the style statistics from them."""
+        """Returns the number of recipes counted, or None on error."""
+        self.normalize_stored_recipes(db)
+        if not db.style_stats.clear():
+            return None
+        num_recipes = 0
+        for page in db.query_pages(has_fields=[NORMALIZED_KEY], fields=[NORMALIZED_KEY]):
+            normalized = page[NORMALIZED_KEY]
+            if NORMALIZED_STYLE_KEY in normalized:
+                self.update_style_stats(db.style_stats, normalized)
+                num_recipes = num_recipes + 1
+            if len(db.style_stats.pending) >= Database.DEFAULT_QUERY_BATCH_SIZE and not db.style_stats.flush():
+                return None
+        if not db.style_stats.flush():
+            return None
+        return num_recipes
+
+    def lookup_ingredient_stats(self, db, style, desired_yield, by_style=True):
+        """Same as compute_ingredient_stats, for the recipes of the given (normalized) style, or all styles if it's None, but looked up in"""
+        """the style statistics that are kept up to date as recipes are written. Returns None if there aren't any statistics for the style."""
+        if db.style_stats is None:
+            return None
+        kinds = [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+        if style is not None:
+            style_stats = db.style_stats.retrieve_style(self.normalize_style(style), kinds, GRAINS_KEY, desired_yield)
+            if style_stats is None:
+                return None
+            return { self.normalize_style(style) if by_style else None: style_stats }
+        if not by_style:
+            return None
+        stats = {}
+        for style_name in db.style_stats.retrieve_styles():
+            style_stats = db.style_stats.retrieve_style(style_name, kinds, GRAINS_KEY, desired_yield)
+            if style_stats is not None:
+                stats[style_name] = style_stats
+        return stats
+
+    def aggregate_ingredient_stats(self, db, style, desired_yield, by_style=True, exact_style=False):
+        """Same as compute_ingredient_stats, for the recipes whose style contains the given one (or all recipes, if style is None), but"""
+        """computed by the database with an aggregation pipeline over the normalized copies of the ingredients. Returns None if the"""
+        """database can't do it, or if any of the recipes doesn't have an up to date normalized copy (see normalize_stored_recipes)."""
+        normalized_path = '$' + NORMALIZED_KEY + '.'
+        is_normalized = { '$and': [
+            { '$eq': [normalized_path + NORMALIZED_VERSION_KEY, self.get_normalization_version()] },
+            { '$gte': [normalized_path + NORMALIZED_TIME_KEY, '$' + Keys.LAST_VISIT_TIME_KEY] } ] }
+        scale = { '$cond': [{ '$gt': [normalized_path + NORMALIZED_YIELD_KEY, 0] }, { '$divide': [desired_yield, normalized_path + NORMALIZED_YIELD_KEY] }, 1.0] }
+        style_id = '$' + Keys.CANONICAL_STYLE_KEY if by_style else None
+
+        # Select the recipes and find out if any of them haven't been normalized.
+        match = { GRAINS_KEY: { '$exists': True } }
+        if style is not None and exact_style:
+            match[Keys.CANONICAL_STYLE_KEY] = self.normalize_style(style)
+        elif style is not None:
+            # The words use the style words index, the whole text is then checked as before.
+            match[STYLE_KEY] = { '$regex': re.escape(style), '$options': 'i' }
+            words = Database.get_style_words(style)
+            if len(words) > 0:
+                match[Keys.STYLE_WORDS_KEY] = { '$all': words }
+        facets = {}
+        facets['unnormalized'] = [{ '$match': { '_normalized': False } }, { '$count': 'count' }]
+        facets[IngredientStats.RECIPES_KEY] = [{ '$match': { '_normalized': True } }, { '$group': { '_id': style_id, 'count': { '$sum': 1 } } }]
+
+        # Group each kind of ingredient by style and name.
+        for kind in [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]:
+            amount = '$item.' + NORMALIZED_AMOUNT_KEY
+            if kind != YEASTS_KEY:
+                amount = { '$multiply': [amount, '$scale'] }
+            group = { '_id': { 'style': style_id, 'name': '$item.' + IngredientStats.NAME_KEY }, 'count': { '$sum': 1 }, 'mean': { '$avg': amount } }
+            if kind == GRAINS_KEY:
+                group['share'] = { '$avg': { '$cond': [{ '$gt': ['$total', 0] }, { '$divide': ['$item.' + NORMALIZED_AMOUNT_KEY, '$total'] }, None] } }
+            if db.server_version is not None and db.server_version >= (7, 0):
+                group['percentiles'] = { '$percentile': { 'input': amount, 'p': [0.1, 0.5, 0.9], 'method': 'approximate' } }
+            facets[kind] = [
+                { '$match': { '_normalized': True } },
+                { '$project': { Keys.CANONICAL_STYLE_KEY: True, 'scale': scale, 'total': { '$sum': normalized_path + GRAINS_KEY + '.' + NORMALIZED_AMOUNT_KEY }, 'item': normalized_path + kind } },
+                { '$unwind': '$item' },
+                { '$group': group },
+                { '$sort': { 'count': -1, '_id.name': 1 } }]
+
+        pipeline = [{ '$match': match }, { '$addFields': { '_normalized': is_normalized } }, { '$facet': facets }]
+        results = db.aggregate_pages(pipeline)
+        if results is None or len(results) == 0:
+            return None
+        results = results[0]
+        if len(results['unnormalized']) > 0:
+            return None
+
+        # Reshape into the same form as compute_ingredient_stats.
+        stats = {}
+        for recipes in results[IngredientStats.RECIPES_KEY]:
+            stats[recipes['_id']] = { IngredientStats.RECIPES_KEY: recipes['count'], GRAINS_KEY: [], HOPS_KEY: [], YEASTS_KEY: [] }
+        for kind in [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]:
+            for group in results[kind]:
+                percentiles = group.get('percentiles') or [None, None, None]
+                item_stats = {}
+                item_stats[IngredientStats.NAME_KEY] = group['_id']['name']
+                item_stats[IngredientStats.COUNT_KEY] = group['count']
+                item_stats[IngredientStats.MEAN_KEY] = group['mean']
+                item_stats[IngredientStats.MEDIAN_KEY] = percentiles[1]
+                item_stats[IngredientStats.P10_KEY] = percentiles[0]
+                item_stats[IngredientStats.P90_KEY] = percentiles[2]
+                if kind == GRAINS_KEY:
+                    item_stats[IngredientStats.SHARE_KEY] = group['share']
+                stats[group['_id']['style']][kind].append(item_stats)
+        return stats
+
+    def get_ingredient_stats(self, db, style, desired_yield, by_style=True, server_side=False, materialized=False, exact_style=False, dedupe=False):
+        """Returns the statistics for each ingredient of the recipes whose style contains the given one (or all recipes, if style is None)."""
+        """If exact_style is set then the recipes' canonical style has to match the given one's, which the database looks up with an index."""
+        """If server_side is set then the database computes them, when it can. Otherwise the recipes are read and they're computed here."""
+        """If materialized is set then they're looked up in the style statistics, where the style has to match exactly once normalized."""
+        """If dedupe is set then each cluster of duplicate recipes only counts once, which means reading the recipes and computing them here."""
+        if dedupe:
+            materialized = False
+            server_side = False
+        if materialized:
+            stats = self.lookup_ingredient_stats(db, style, desired_yield, by_style)
+            if stats is not None:
+                return stats
+            print("Computing the statistics from the recipes since there aren't any stored statistics for the style.")
+        if server_side:
+            stats = self.aggregate_ingredient_stats(db, style, desired_yield, by_style, exact_style)
+            if stats is not None:
+                return stats
+            print("Computing the statistics locally since the database can't, or the recipes haven't all been normalized.")
+        fields = [Keys.LAST_VISIT_TIME_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+        if style is not None and exact_style and self.all_styles_canonicalized(db):
+            all_pages = db.query_pages(canonical_style=self.normalize_style(style), has_fields=[GRAINS_KEY], fields=fields)
+        elif style is not None and exact_style:
+            canonical_style = self.normalize_style(style)
+            all_pages = db.query_pages(has_fields=[GRAINS_KEY], fields=fields)
+            all_pages = (page for page in all_pages if self.normalize_style(page.get(STYLE_KEY)) == canonical_style)
+        else:
+            all_pages = db.query_pages(style=style, has_fields=[GRAINS_KEY], fields=fields)
+        if dedupe:
+            all_pages = self.dedupe_recipes(all_pages)
+        return self.compute_ingredient_stats(all_pages, desired_yield, by_style)
+
+    def generate_avg_recipe(self, db, style, desired_yield, server_side=False, materialized=False, exact_style=False, dedupe=False):
         """Looks through the database of crawled web pages, gets all beer recipes of the given style, normalizes the amounts"""
         """and writes a recipe using the most popular grains and hops and the avg amount in which they appear."""
-        all_pages = db.retrieve_all_pages()
-        lower_style = style.lower()
-
-        grains = []
-        hops = []
-        yeasts = []
-
-        # The recipes were collected from various sites and will need normalizing
-        # after we filter for the recipes that match the search criteria.
-        for page in all_pages:
-
-            # Filter for the desired beer style.
-            if STYLE_KEY in page and page[STYLE_KEY].lower().find(lower_style) >= 0:
-                grain_value = None
-                hops_value = None
-                yield_size = None
-                scale = None # Amount to scale the recipe by; will try to nomalize on a 3 gallon yield
 
-                if GRAINS_KEY in page:
-                    grain_value = page[GRAINS_KEY]
-                if HOPS_KEY in page:
-                    hops_value = page[HOPS_KEY]
-                if YIELD_SIZE_KEY in page:
-                    yield_size = self.normalize_amount_str(page[YIELD_SIZE_KEY], 1.0)
-                    scale = desired_yield / float(yield_size.split(' ')[0]) 
-
-                norm_grains, norm_hops = self.normalize_grains_and_hops(grain_value, hops_value, scale)
-
-                grains.extend(norm_grains)
-                hops.extend(norm_hops)
-                yeasts.extend(page[YEASTS_KEY])
+        # The database filters for the recipes that match the search criteria, treat them as one style.
+        stats = self.get_ingredient_stats(db, style, desired_yield, by_style=False, server_side=server_side, materialized=materialized, exact_style=exact_style, dedupe=dedupe)
+        style_stats = stats.get(None, { GRAINS_KEY: [], HOPS_KEY: [], YEASTS_KEY: [] })
+        grain_stats = style_stats[GRAINS_KEY]
+        hop_stats = style_stats[HOPS_KEY]
+        yeast_stats = style_stats[YEASTS_KEY]
 
         #
         # Print the normalized inputs.
@@ -340,40 +511,28 @@ class RecipeWriter(object):
         print("------")
         print("Grains")
         print("------")
-        fermentable_names = []
-        for grain in grains:
-            fermentable_names.append(grain[FERMENTABLES_KEY])
-        counted_fermentables = collections.Counter(fermentable_names).most_common()
-        for fermentable in counted_fermentables:
-            print(fermentable)
+        for grain in grain_stats:
+            print((grain[IngredientStats.NAME_KEY], grain[IngredientStats.COUNT_KEY]))
 
         print("----")
         print("Hops")
         print("----")
-        hop_names = []
-        for hop in hops:
-            hop_names.append(hop[VARIETY_KEY])
-        counted_hop_names = collections.Counter(hop_names).most_common()
-        for hop_name in counted_hop_names:
-            print(hop_name)
+        for hop in hop_stats:
+            print((hop[IngredientStats.NAME_KEY], hop[IngredientStats.COUNT_KEY]))
 
         print("------")
         print("Yeasts")
         print("------")
-        counted_yeasts = collections.Counter(yeasts).most_common()
-        for yeast in counted_yeasts:
-            print(yeast)
+        for yeast in yeast_stats:
+            print((yeast[IngredientStats.NAME_KEY], yeast[IngredientStats.COUNT_KEY]))
 
         #
         # Do we have enough to write the recipe?
         #
 
-        if len(counted_fermentables) < 3:
-            print("ERROR: Not enough data to write a recipe.")
-        if len(counted_hop_names) < 3:
-            print("ERROR: Not enough data to write a recipe.")
-        if len(counted_yeasts) < 1:
+        if len(grain_stats) < 4 or len(hop_stats) < 3 or len(yeast_stats) < 1:
             print("ERROR: Not enough data to write a recipe.")
+            return
 
         #
         # Write the recipe
@@ -384,62 +543,327 @@ class RecipeWriter(object):
         print("------")
 
         # Grains
-        grain_name = counted_fermentables[0][0]
-        grain_amount = self.compute_avg_amount(grains, grain_name)
-        print(grain_name + ", {:.2f}".format(grain_amount) + " lbs")
-        grain_name = counted_fermentables[1][0]
-        grain_amount = self.compute_avg_amount(grains, grain_name)
-        print(grain_name + ", {:.2f}".format(grain_amount) + " lbs")
-        grain_name = counted_fermentables[2][0]
-        grain_amount = self.compute_avg_amount(grains, grain_name)
-        print(grain_name + ", {:.2f}".format(grain_amount) + " lbs")
-        grain_name = counted_fermentables[3][0]
-        grain_amount = self.compute_avg_amount(grains, grain_name)
-        print(grain_name + ", {:.2f}".format(grain_amount) + " lbs")
+        for grain in grain_stats[0:4]:
+            grain_amount = grain[IngredientStats.MEAN_KEY]
+            if grain_amount is None:
+                grain_amount = 0.0
+            print(grain[IngredientStats.NAME_KEY] + ", {:.2f}".format(grain_amount) + " lbs")
 
         # Hops
-        print(counted_hop_names[0][0] + " Hops")
-        print(counted_hop_names[1][0] + " Hops")
-        print(counted_hop_names[2][0] + " Hops")
+        for hop in hop_stats[0:3]:
+            print(hop[IngredientStats.NAME_KEY] + " Hops")
 
         # Yeast
-        print(counted_yeasts[0][0])
+        print(yeast_stats[0][IngredientStats.NAME_KEY])
 
-    def export_to_json(self, db):
-        """Exports the beer recipes to JSON."""
-        all_data = []
-        all_pages = db.retrieve_all_pages()
-        for page in all_pages:
+    def normalize_recipe(self, page):
+        """Normalizes a recipe, as read from the database, for export."""
+        grain_value = page[GRAINS_KEY]
 
-            if GRAINS_KEY in page:
-                grain_value = page[GRAINS_KEY]
-            else: # Filter out pages that aren't recipes
-                continue
+        if HOPS_KEY in page:
+            hops_value = page[HOPS_KEY]
+        else:
+            hops_value = None
 
-            if HOPS_KEY in page:
-                hops_value = page[HOPS_KEY]
-            else:
-                hops_value = None
+        page[GRAINS_KEY], page[HOPS_KEY] = self.normalize_grains_and_hops(grain_value, hops_value, 1.0)
 
-            page[GRAINS_KEY], page[HOPS_KEY] = self.normalize_grains_and_hops(grain_value, hops_value, 1.0)
+        # This isn't serializable so get rid of it.
+        if ID_KEY in page:
+            del page[ID_KEY]
 
-            # This isn't serializable so get rid of it.
-            if ID_KEY in page:
-                del page[ID_KEY]
+        return page
 
-            all_data.append(page)
+    def export_to_json(self, db):
+        """Exports the beer recipes to JSON."""
+        all_data = []
+        all_pages = db.query_pages(has_fields=[GRAINS_KEY], fields=RECIPE_FIELDS) # Filter out pages that aren't recipes
+        for page in all_pages:
+            all_data.append(self.normalize_recipe(page))
         
         return json.dumps(all_data)
 
+    def export_to_ndjson(self, db, output, num_processes=None, ordered=True, batch_size=EXPORT_BATCH_SIZE):
+        """Streams the beer recipes to the output file, as newline delimited JSON, one recipe per line. Recipes are normalized"""
+        """by a pool of num_processes processes (defaults to one per core, 1 does it in this process), batch_size at a time."""
+        """If ordered is FALSE then batches are written as soon as they're done rather than in database order. Only a few"""
+        """batches are in flight at once, so memory use doesn't depend on the number of recipes. Returns the number of recipes."""
+        all_pages = db.query_pages(has_fields=[GRAINS_KEY], fields=RECIPE_FIELDS) # Filter out pages that aren't recipes
+        num_recipes = 0
+
+        # Without a pool.
+        if num_processes == 1:
+            for page in all_pages:
+                output.write(json.dumps(self.normalize_recipe(page)) + "\n")
+                num_recipes = num_recipes + 1
+            return num_recipes
+
+        pool = multiprocessing.Pool(num_processes, initializer=init_export_worker, initargs=(self.grain_rules_file,))
+        max_in_flight = 2 * (num_processes or multiprocessing.cpu_count())
+        in_flight = collections.deque() # Ordered output: the batches being normalized, in database order
+        done = queue.Queue() # Unordered output: the batches that are done, in the order they finished
+        num_in_flight = 0
+        try:
+            batch = []
+            for page in itertools.chain(all_pages, [None]):
+                if page is not None:
+                    batch.append(page)
+                    num_recipes = num_recipes + 1
+                    if len(batch) < batch_size:
+                        continue
+                if len(batch) > 0:
+                    if ordered:
+                        in_flight.append(pool.apply_async(normalize_export_batch, (batch,)))
+                    else:
+                        pool.apply_async(normalize_export_batch, (batch,), callback=done.put, error_callback=done.put)
+                    num_in_flight = num_in_flight + 1
+                    batch = []
+
+                # Write the batches that are done, waiting for one if too many are in flight, or for all of them at the end.
+                while num_in_flight > 0 and (num_in_flight >= max_in_flight or page is None):
+                    lines = in_flight.popleft().get() if ordered else done.get()
+                    if isinstance(lines, Exception):
+                        raise lines
+                    output.write(lines)
+                    num_in_flight = num_in_flight - 1
+        finally:
+            pool.terminate()
+        return num_recipes
+
+    def export_to_columns(self, db, path, file_format=ColumnarExport.FORMAT_NPY):
+        """Exports the beer recipes as three tables: recipes (url, host, title, style and yield, in gallons), ingredients (the"""
+        """vocabulary, where the row is the ingredient's ID, with its kind and name) and amounts (a sparse recipe by ingredient"""
+        """matrix, in coordinate form, with the unscaled amount, or NaN if it isn't known). See ColumnarExport for the formats."""
+        """Returns the number of recipes."""
+        recipe_columns = { Keys.URL_KEY: [], Keys.HOST_KEY: [], TITLE_KEY: [], STYLE_KEY: [], 'yield': [] }
+        ingredient_ids = {} # (kind, name) -> ID
+        ingredient_columns = { 'kind': [], 'name': [] }
+        amount_columns = { 'recipe': [], 'ingredient': [], 'amount': [] }
+
+        fields = [Keys.URL_KEY, Keys.HOST_KEY, TITLE_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+        for page in db.query_pages(has_fields=[GRAINS_KEY], fields=fields):
+            yield_gallons, ingredients = self.normalize_ingredients(page)
+            recipe_id = len(recipe_columns[Keys.URL_KEY])
+            for key in [Keys.URL_KEY, Keys.HOST_KEY, TITLE_KEY, STYLE_KEY]:
+                recipe_columns[key].append(page.get(key) or "")
+            recipe_columns['yield'].append(np.nan if yield_gallons is None else yield_gallons)
+
+            for kind in [GRAINS_KEY, HOPS_KEY, YEASTS_KEY]:
+                for name, amount in ingredients[kind]:
+                    ingredient_id = ingredient_ids.get((kind, name))
+                    if ingredient_id is None:
+                        ingredient_id = len(ingredient_ids)
+                        ingredient_ids[(kind, name)] = ingredient_id
+                        ingredient_columns['kind'].append(kind)
+                        ingredient_columns['name'].append(name)
+                    amount_columns['recipe'].append(recipe_id)
+                    amount_columns['ingredient'].append(ingredient_id)
+                    amount_columns['amount'].append(np.nan if amount is None else amount)
+
+        # Fixed width types, so that the columns can be memory mapped.
+        tables = {}
+        tables['recipes'] = dict((key, np.array(values, dtype=np.float64 if key == 'yield' else str)) for key, values in recipe_columns.items())
+        tables['ingredients'] = dict((key, np.array(values, dtype=str)) for key, values in ingredient_columns.items())
+        tables['amounts'] = { 'recipe': np.array(amount_columns['recipe'], dtype=np.int32),
+                              'ingredient': np.array(amount_columns['ingredient'], dtype=np.int32),
+                              'amount': np.array(amount_columns['amount'], dtype=np.float64) }
+        ColumnarExport.write_tables(tables, path, file_format)
+        return len(recipe_columns[Keys.URL_KEY])
+
+    def export_changes_to_json(self, db, since):
+        """Exports the beer recipes that were added or changed after the given time, along with tombstones for the ones that were deleted."""
+        """Returns the JSON and the watermark to pass as 'since' on the next export."""
+
+        # Writes can reach the database a little after their visit time, so don't advance the watermark right up to the present.
+        # Anything in that window is exported again next time, which is harmless since the export is keyed by URL.
+        max_watermark = time.time() - WATERMARK_SAFETY_SECS
+        watermark = since
+
+        recipes = []
+        for page in db.query_pages(has_fields=[GRAINS_KEY], fields=RECIPE_FIELDS, visited_since=since):
+            if page[Keys.LAST_VISIT_TIME_KEY] <= max_watermark:
+                watermark = max(watermark, page[Keys.LAST_VISIT_TIME_KEY])
+            recipes.append(self.normalize_recipe(page))
+
+        deleted = []
+        for tombstone in db.retrieve_tombstones(since):
+            if tombstone[Keys.DELETED_TIME_KEY] <= max_watermark:
+                watermark = max(watermark, tombstone[Keys.DELETED_TIME_KEY])
+            deleted.append(tombstone)
+
+        export = { 'since': since, 'watermark': watermark, 'recipes': recipes, 'deleted': deleted }
+        return json.dumps(export), watermark
+
+    def load_watermark(self, file_name):
+        """Reads the watermark that was saved by the previous incremental export. Returns zero (export everything) if there isn't one."""
+        if not os.path.isfile(file_name):
+            return 0.0
+        with open(file_name, 'r') as f:
+            return json.load(f)['watermark']
+
+    def save_watermark(self, file_name, watermark):
+        """Saves the watermark for the next incremental export."""
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, 'w') as f:
+            json.dump({ 'watermark': watermark }, f)
+        os.rename(temp_file_name, file_name)
+
+    def index_recipe(self, index, page):
+        """Adds the recipe, or its new version, to the ingredient index."""
+        _, ingredients = self.normalize_ingredients(page)
+        index.add_recipe(page[Keys.URL_KEY], self.normalize_style(page.get(STYLE_KEY)), ingredients, GRAINS_KEY)
+
+    def update_ingredient_index(self, db, index):
+        """Brings the ingredient index up to date with the recipes that were added, changed or deleted since it was last updated."""
+        """Returns the number of recipes that were indexed."""
+
+        # Same watermark as the incremental JSON export.
+        max_watermark = time.time() - WATERMARK_SAFETY_SECS
+        since = index.watermark
+        watermark = since
+
+        for tombstone in db.retrieve_tombstones(since):
+            if tombstone[Keys.DELETED_TIME_KEY] <= max_watermark:
+                watermark = max(watermark, tombstone[Keys.DELETED_TIME_KEY])
+            index.remove_recipe(tombstone[Keys.URL_KEY])
+
+        num_indexed = 0
+        fields = [Keys.URL_KEY, Keys.LAST_VISIT_TIME_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]
+        visited_since = since if since > 0 else None # A new index needs every recipe, even those without a visit time
+        for page in db.query_pages(has_fields=[GRAINS_KEY], fields=fields, visited_since=visited_since):
+            if page.get(Keys.LAST_VISIT_TIME_KEY, 0) <= max_watermark:
+                watermark = max(watermark, page.get(Keys.LAST_VISIT_TIME_KEY, 0))
+            self.index_recipe(index, page)
+            num_indexed = num_indexed + 1
+
+        index.watermark = watermark
+        index.merge_pending()
+        return num_indexed
+
+    def load_ingredient_index(self, db, file_name, rebuild=False):
+        """Loads the ingredient index from the file, brings it up to date, and saves it again. It's rebuilt from scratch if it doesn't"""
+        """exist, if rebuild is set, if the normalization has changed, or if most of its IDs belong to deleted recipes."""
+        index = IngredientIndex.IngredientIndex()
+        if not rebuild and os.path.isfile(file_name):
+            index.load(file_name)
+            if index.version != self.get_normalization_version() or index.num_deleted() > index.num_recipes():
+                index = IngredientIndex.IngredientIndex()
+        index.version = self.get_normalization_version()
+        self.update_ingredient_index(db, index)
+        index.save(file_name)
+        return index
+
+    def resolve_query_term(self, kind, text):
+        """Normalizes a term of an ingredient index query the same way as the recipes were, so that, e.g., style:"IPA - American" finds"""
+        """American IPAs and "crystal malt" finds all of the crystal malts."""
+        if kind == IngredientIndex.STYLE_KIND:
+            return self.normalize_style(text)
+        if kind is None or kind == GRAINS_KEY:
+            return self.normalize_grain_name(text)
+        return text
+
+    def query_recipes(self, index, query_str):
+        """Returns the sorted IDs, in the ingredient index, of the recipes that match the query. See IngredientIndex for the syntax."""
+        return index.query(query_str, self.resolve_query_term)
+
+    def make_recipe_vectors(self, pages):
+        """Normalizes the recipes and returns their vectors (see RecipeSimilarity) along with the list of the recipes, in the order of the vectors' rows."""
+        vectors = RecipeSimilarity.RecipeVectors(SIMILARITY_KIND_WEIGHTS)
+        rows = []
+        for page in pages:
+            _, ingredients = self.normalize_ingredients(page)
+            vectors.add_recipe(ingredients)
+            rows.append(page)
+        vectors.finish()
+        return vectors, rows
+
+    def find_similar_recipes(self, db, url, k):
+        """Returns a list of (URL, similarity) tuples for the k recipes that are most similar to the one with the given URL, or None if it isn't a recipe."""
+        vectors, rows = self.make_recipe_vectors(db.query_pages(has_fields=[GRAINS_KEY], fields=[Keys.URL_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]))
+        for row, page in enumerate(rows):
+            if page[Keys.URL_KEY] == url:
+                return [(rows[other_row][Keys.URL_KEY], similarity) for other_row, similarity in vectors.top_k(row, k)]
+        return None
+
+    def find_duplicate_recipes(self, db, threshold=RecipeSimilarity.DEFAULT_DUPLICATE_THRESHOLD):
+        """Returns a list of the clusters of duplicate recipes, each a list of URLs, largest first."""
+        vectors, rows = self.make_recipe_vectors(db.query_pages(has_fields=[GRAINS_KEY], fields=[Keys.URL_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]))
+        clusters = {}
+        for row, root in enumerate(vectors.duplicate_clusters(threshold).tolist()):
+            clusters.setdefault(root, []).append(rows[row][Keys.URL_KEY])
+        return sorted([cluster for cluster in clusters.values() if len(cluster) > 1], key=len, reverse=True)
+
+    def dedupe_recipes(self, pages, threshold=RecipeSimilarity.DEFAULT_DUPLICATE_THRESHOLD):
+        """Returns the list of the recipes with only the first recipe of each cluster of duplicates."""
+        vectors, rows = self.make_recipe_vectors(pages)
+        roots = vectors.duplicate_clusters(threshold)
+        return [page for row, page in enumerate(rows) if roots[row] == row]
+
+    def all_styles_canonicalized(self, db):
+        """Returns TRUE if every recipe with a style has its canonical style stored, e.g. by the crawler or by --normalize."""
+        missing = db.query_pages(has_fields=[STYLE_KEY], missing_fields=[Keys.CANONICAL_STYLE_KEY], fields=[Keys.URL_KEY], batch_size=1)
+        if missing is None:
+            return False
+        for _ in missing:
+            return False
+        return True
+
     def list_styles(self, db):
-        all_styles = set()
-        all_pages = db.retrieve_all_pages()
+        """Returns the sorted list of the canonical styles of the recipes. The database computes it from the canonical style index, unless"""
+        """some of the recipes don't have their canonical style stored, in which case their styles are read and canonicalized here."""
+        all_styles = None
+        if self.all_styles_canonicalized(db):
+            all_styles = db.distinct_values(Keys.CANONICAL_STYLE_KEY)
+        if all_styles is None:
+            all_styles = set()
+            all_pages = db.query_pages(has_fields=[STYLE_KEY], fields=[STYLE_KEY])
+
+            for page in all_pages:
+                all_styles.add(self.normalize_style(page[STYLE_KEY]))
+
+        return sorted(all_styles)
+
+class StyleStatsObserver(Database.PageObserver):
+    """Keeps the style statistics up to date as recipes are written. Each write that changes a recipe also stores its new normalized"""
+    """copy of the ingredients, and the statistics are adjusted by the difference between it and the one it replaces."""
+
+    def __init__(self, writer, style_stats):
+        self.writer = writer
+        self.style_stats = style_stats
+        super(StyleStatsObserver, self).__init__()
+
+    def get_fields(self):
+        return [Keys.LAST_VISIT_TIME_KEY, STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY, NORMALIZED_KEY]
+
+    def pages_changed(self, changes):
+        for url, old_page, new_fields in changes:
+            old_normalized = None
+            if old_page is not None:
+                old_normalized = old_page.get(NORMALIZED_KEY)
+
+            # Deleted, re-normalized, or a write that changes the recipe?
+            if new_fields is None:
+                new_normalized = None
+            elif NORMALIZED_KEY in new_fields:
+                new_normalized = new_fields[NORMALIZED_KEY]
+            elif any([key in new_fields for key in [STYLE_KEY, YIELD_SIZE_KEY, GRAINS_KEY, HOPS_KEY, YEASTS_KEY]]):
+                page = dict(old_page or {})
+                page.update(new_fields)
+                if GRAINS_KEY not in page:
+                    continue
+                normalized_fields = self.writer.make_normalized_fields(page)
+                new_fields.update(normalized_fields)
+                new_normalized = normalized_fields[NORMALIZED_KEY]
+            else:
+                continue
 
-        for page in all_pages:
-            if STYLE_KEY in page:
-                all_styles.add(page[STYLE_KEY])
+            self.writer.update_style_stats(self.style_stats, old_normalized, -1)
+            self.writer.update_style_stats(self.style_stats, new_normalized)
+
+    def flush(self):
+        return self.style_stats.flush()
 
-        return all_styles
+    def discard(self):
+        self.style_stats.discard()
 
 def main():
     """This is the entry point that is used to perform unit tests on this module."""
@@ -448,37 +872,151 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--style", default=None, help="Style of beers to dump.", required=False)
     parser.add_argument("--mongodb-addr", default="localhost:27017", help="Address of the mongo database.", required=False)
+    parser.add_argument("--db", default=None, help="URI of the database (mongodb://host:port or sqlite:///path/to/file.db). Overrides --mongodb-addr.", required=False)
     parser.add_argument("--json", action="store_true", default=False, help="Exports the recipes as JSON.", required=False)
+    parser.add_argument("--since", type=float, default=None, help="With --json, only exports the recipes that changed after this timestamp, along with the ones that were deleted.", required=False)
+    parser.add_argument("--watermark-file", default=None, help="With --json, only exports what changed since the previous export, as recorded in this file, and then updates the file.", required=False)
+    parser.add_argument("--stats", action="store_true", default=False, help="Prints, as JSON, the statistics for each ingredient of each style (or of the styles matching --style).", required=False)
+    parser.add_argument("--normalize", action="store_true", default=False, help="Stores a normalized copy of the ingredients with each recipe, which lets --server-side work.", required=False)
+    parser.add_argument("--server-side", action="store_true", default=False, help="With --stats or --style, lets the database compute the statistics when it can.", required=False)
+    parser.add_argument("--materialized", action="store_true", default=False, help="With --stats or --style, looks the statistics up in the style statistics, which are kept up to date as recipes are written.", required=False)
+    parser.add_argument("--rebuild-style-stats", action="store_true", default=False, help="Recomputes the style statistics from all of the recipes.", required=False)
+    parser.add_argument("--exact-style", action="store_true", default=False, help="With --stats or --style, only uses the recipes whose canonical style (see --normalize) is the same as that of --style.", required=False)
+    parser.add_argument("--grain-rules", default=NameNormalizer.DEFAULT_GRAIN_RULES_FILE, help="JSON file of the rules for normalizing grain names.", required=False)
+    parser.add_argument("--style-rules", default=StyleCanonicalizer.DEFAULT_STYLE_RULES_FILE, help="JSON file of the rules for canonicalizing style names.", required=False)
+    parser.add_argument("--ndjson", default=None, help="Streams the recipes, as newline delimited JSON, to this file (gzip compressed if it ends in .gz, - for stdout).", required=False)
+    parser.add_argument("--processes", type=int, default=None, help="With --ndjson, the number of processes that normalize recipes, defaults to one per core.", required=False)
+    parser.add_argument("--unordered", action="store_true", default=False, help="With --ndjson, writes recipes as soon as they're normalized instead of in database order.", required=False)
+    parser.add_argument("--columns", default=None, help="Exports the recipes, ingredient vocabulary and recipe by ingredient amounts, as columns, to this path.", required=False)
+    parser.add_argument("--columns-format", default=ColumnarExport.FORMAT_NPY, choices=ColumnarExport.FORMATS, help="With --columns, the format: a directory of .npy files, an .npz file, or a directory of Arrow or Parquet files.", required=False)
+    parser.add_argument("--query", default=None, help="Prints the URLs of the recipes that match this ingredient query, e.g. 'citra AND mosaic AND NOT crystal' (see IngredientIndex).", required=False)
+    parser.add_argument("--by-style", action="store_true", default=False, help="With --query, prints the number of matching recipes of each style instead of their URLs.", required=False)
+    parser.add_argument("--index-file", default=DEFAULT_INDEX_FILE, help="With --query, the file in which the ingredient index is kept. It's brought up to date before each query.", required=False)
+    parser.add_argument("--rebuild-index", action="store_true", default=False, help="Rebuilds the ingredient index from scratch.", required=False)
+    parser.add_argument("--dedupe", action="store_true", default=False, help="With --stats or --style, counts each cluster of duplicate recipes once.", required=False)
+    parser.add_argument("--similar", default=None, help="Prints the recipes that are most similar to the one with this URL.", required=False)
+    parser.add_argument("--top-k", type=int, default=10, help="With --similar, the number of recipes to print.", required=False)
+    parser.add_argument("--duplicates", action="store_true", default=False, help="Prints the clusters of duplicate recipes.", required=False)
+    parser.add_argument("--duplicate-threshold", type=float, default=RecipeSimilarity.DEFAULT_DUPLICATE_THRESHOLD, help="With --duplicates, the minimum similarity, between 0 and 1, of duplicate recipes.", required=False)
     parser.add_argument("--list-styles", action="store_true", default=False, help="Prints all styles of beer found in the database.", required=False)
     args = parser.parse_args()
 
     # Instantiate the object that connects to the database.
     db = None
-    if args.mongodb_addr is not None:
-        db = CrawlerDatabase.MongoDatabase()
-        db.connect(args.mongodb_addr)
+    db_uri = args.db if args.db else args.mongodb_addr
+    if db_uri is not None:
+        db = Database.open_database(db_uri)
 
     # Sanity check.
     if db is None:
         print("ERROR: No database.")
 
+    # Keep the style statistics up to date with whatever we write.
+    if db is not None and db.style_stats is not None:
+        db.add_page_observer(StyleStatsObserver(RecipeWriter(args.grain_rules, args.style_rules), db.style_stats))
+
+    # Recompute the style statistics.
+    if args.rebuild_style_stats:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        print("Counted " + str(writer.rebuild_style_stats(db)) + " recipe(s).")
+
+    # Bring the normalized copies of the ingredients up to date.
+    if args.normalize:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        print("Normalized " + str(writer.normalize_stored_recipes(db)) + " recipe(s).")
+
+    # This option allows the user to dump the ingredient statistics to stdout.
+    if args.stats:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        stats = writer.get_ingredient_stats(db, args.style, 3.0, server_side=args.server_side, materialized=args.materialized, exact_style=args.exact_style, dedupe=args.dedupe)
+        print(json.dumps(stats))
+
     # This option allows the user to dump recipes to stdout.
-    if args.style is not None:
+    elif args.style is not None:
 
-        writer = RecipeWriter()
-        writer.generate_avg_recipe(db, args.style, 3.0)
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        writer.generate_avg_recipe(db, args.style, 3.0, args.server_side, args.materialized, args.exact_style, args.dedupe)
 
     # Are we exporting the recipes?
     if args.json:
 
-        writer = RecipeWriter()
-        data = writer.export_to_json(db)
-        print(data)
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+
+        # Incremental export?
+        if args.since is not None or args.watermark_file is not None:
+            since = args.since
+            if since is None:
+                since = writer.load_watermark(args.watermark_file)
+            data, watermark = writer.export_changes_to_json(db, since)
+            print(data)
+            if args.watermark_file is not None:
+                writer.save_watermark(args.watermark_file, watermark)
+        else:
+            data = writer.export_to_json(db)
+            print(data)
+
+    # Are we streaming the recipes?
+    if args.ndjson is not None:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        if args.ndjson == '-':
+            writer.export_to_ndjson(db, sys.stdout, args.processes, not args.unordered)
+        else:
+            if args.ndjson.endswith('.gz'):
+                output = io.TextIOWrapper(gzip.open(args.ndjson, 'wb'), encoding='utf-8')
+            else:
+                output = io.open(args.ndjson, 'w', encoding='utf-8')
+            with output:
+                writer.export_to_ndjson(db, output, args.processes, not args.unordered)
+
+    # Are we exporting the recipes as columns?
+    if args.columns is not None:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        print("Exported " + str(writer.export_to_columns(db, args.columns, args.columns_format)) + " recipe(s).")
+
+    # Are we querying the ingredient index?
+    if args.query is not None or args.rebuild_index:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        index = writer.load_ingredient_index(db, args.index_file, args.rebuild_index)
+        if args.query is not None:
+            try:
+                ids = writer.query_recipes(index, args.query)
+                if args.by_style:
+                    for style, count in index.count_by_style(ids):
+                        print(style + ": " + str(count))
+                else:
+                    for recipe_id in ids.tolist():
+                        print(index.urls[recipe_id])
+            except ValueError as e:
+                print("ERROR: " + str(e))
+
+    # Are we looking for similar recipes?
+    if args.similar is not None:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        similar = writer.find_similar_recipes(db, args.similar, args.top_k)
+        if similar is None:
+            print("ERROR: " + args.similar + " isn't a recipe.")
+        else:
+            for url, similarity in similar:
+                print("{:.3f} ".format(similarity) + url)
+
+    # Are we looking for duplicate recipes?
+    if args.duplicates:
+
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
+        for cluster in writer.find_duplicate_recipes(db, args.duplicate_threshold):
+            print(" ".join(cluster))
 
     # Are we exporting the styles?
     if args.list_styles:
 
-        writer = RecipeWriter()
+        writer = RecipeWriter(args.grain_rules, args.style_rules)
         data = writer.list_styles(db)
         print(data)
 
@@ -0,0 +1,569 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Embedded SQLite database implementation, for crawls that don't need a database server"""
+
+import json
+import re
+import sqlite3
+import sys
+import time
+import traceback
+import Database
+import ExtractionCache
+import Keys
+import PageHistory
+import PageStore
+import StyleStats
+
+SQLITE_MAX_VARIABLES = 900 # SQLite limits the number of parameters in a single statement
+SCHEMA_VERSION = 1 # Stored as the user_version of the file. Increment this, and add a migration, whenever the layout of the pages table changes
+
+# Fields that get their own column, everything else is stored as a JSON document.
+COLUMN_KEYS = [Keys.URL_KEY, Keys.HOST_KEY, Keys.LAST_VISIT_TIME_KEY, Keys.STYLE_KEY, Keys.PAGE_SOURCE_KEY, Keys.PAGE_SOURCE_REF_KEY]
+COLUMN_NAMES = ['url', 'host', 'last_visit_time', 'style', 'page_source', 'page_source_ref']
+COLUMN_NAME_FOR_KEY = dict(zip(COLUMN_KEYS, COLUMN_NAMES))
+METADATA_KEYS = [Keys.URL_KEY, Keys.HOST_KEY, Keys.LAST_VISIT_TIME_KEY, Keys.PAGE_SOURCE_REF_KEY]
+
+def doc_field_expression(field):
+    """Returns the SQL expression for a field of the JSON document. It's written out, rather than a parameter, so that it matches the"""
+    """expression of any index on the field."""
+    return "json_extract(doc, '$.\"" + field.replace("'", "''").replace('"', '\\"') + "\"')"
+
+def sqlite_regexp(pattern, value):
+    """Implements the REGEXP operator, which SQLite leaves to the application. Case-insensitive, like the MongoDB queries."""
+    if value is None:
+        return False
+    return re.search(pattern, value, re.IGNORECASE) is not None
+
+class SqlitePageStore(PageStore.PageStore):
+    """Stores each page source as a compressed row in its own table, keyed by its hash."""
+    """Writes are buffered and flushed in the same transaction as the page writes."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = {}
+        PageStore.PageStore.__init__(self)
+
+    def put(self, raw_content):
+        ref = PageStore.content_hash(raw_content)
+        if ref not in self.pending:
+            self.pending[ref] = PageStore.compress(raw_content)
+        return ref
+
+    def get(self, ref):
+        if ref in self.pending:
+            codec, data = self.pending[ref]
+            return PageStore.decompress(codec, data)
+        try:
+            row = self.conn.execute("SELECT codec, data FROM page_sources WHERE hash = ?", (ref,)).fetchone()
+            if row is not None:
+                return PageStore.decompress(row[0], bytes(row[1]))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return True
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO page_sources (hash, codec, data) VALUES (?, ?, ?)", [(ref, codec, sqlite3.Binary(data)) for ref, (codec, data) in self.pending.items()])
+            self.pending = {}
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class SqlitePageHistory(PageHistory.PageHistory):
+    """Stores page versions as rows in their own table."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        PageHistory.PageHistory.__init__(self)
+
+    def load_latest_versions(self, urls):
+        latest = {}
+        for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+            chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+            sql = "SELECT rowid, url, data FROM page_versions WHERE is_full = 1 AND url IN (" + ",".join(["?"] * len(chunk)) + ")"
+            for row in self.conn.execute(sql, chunk):
+                latest[row[1]] = (row[0], bytes(row[2]))
+        return latest
+
+    def load_versions(self, url):
+        cursor = self.conn.execute("SELECT version_time, is_full, data FROM page_versions WHERE url = ? ORDER BY version_time DESC", (url,))
+        return [(row[0], row[1] == 1, bytes(row[2])) for row in cursor]
+
+    def save_versions(self, new_versions, replaced_versions):
+        try:
+            with self.conn:
+                self.conn.executemany("UPDATE page_versions SET is_full = 0, data = ? WHERE rowid = ?", [(sqlite3.Binary(delta), version_id) for version_id, delta in replaced_versions])
+                self.conn.executemany("INSERT INTO page_versions (url, version_time, is_full, data) VALUES (?, ?, 1, ?)", [(url, version_time, sqlite3.Binary(data)) for url, version_time, data in new_versions])
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def compact(self, max_versions, max_age_secs):
+        try:
+            with self.conn:
+                # Old versions (but never the newest, which is the full version).
+                if max_age_secs is not None:
+                    self.conn.execute("DELETE FROM page_versions WHERE is_full = 0 AND version_time < ?", (time.time() - max_age_secs,))
+
+                # Pages with too many versions.
+                if max_versions is not None:
+                    self.conn.execute("DELETE FROM page_versions WHERE rowid IN (SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER (PARTITION BY url ORDER BY version_time DESC) AS n FROM page_versions) WHERE n > ?)", (max(max_versions, 1),))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class SqliteExtractionCache(ExtractionCache.ExtractionCache):
+    """Stores extraction results, as JSON, in their own table."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        ExtractionCache.ExtractionCache.__init__(self)
+
+    def load(self, keys):
+        values = {}
+        try:
+            for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[i:i + SQLITE_MAX_VARIABLES]
+                sql = "SELECT key, result FROM extractions WHERE key IN (" + ",".join(["?"] * len(chunk)) + ")"
+                for row in self.conn.execute(sql, chunk):
+                    values[row[0]] = json.loads(row[1])
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return values
+
+    def save(self, entries):
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO extractions (key, module, version, result) VALUES (?, ?, ?, ?)", [(key, module_name, str(module_version), json.dumps(value)) for key, module_name, module_version, value in entries])
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def invalidate(self, module_name, current_version):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM extractions WHERE module = ? AND version != ?", (module_name, str(current_version)))
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class SqliteStyleStats(StyleStats.StyleStats):
+    """Stores the per style ingredient statistics in their own table, keyed by style, kind and name."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        StyleStats.StyleStats.__init__(self)
+
+    def load_style(self, style):
+        try:
+            cursor = self.conn.execute("SELECT kind, name, count, amount_count, amount_sum, share_count, share_sum FROM style_stats WHERE style = ?", (style,))
+            return [(row[0], row[1], list(row[2:])) for row in cursor]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def load_styles(self):
+        try:
+            cursor = self.conn.execute("SELECT style, count FROM style_stats WHERE kind = ? AND name = ? AND count > 0", (StyleStats.RECIPES_KIND, StyleStats.RECIPES_KIND))
+            return dict((row[0], row[1]) for row in cursor)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return {}
+
+    def save_deltas(self, deltas):
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT INTO style_stats (style, kind, name, count, amount_count, amount_sum, share_count, share_sum) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (style, kind, name) DO UPDATE SET count = count + excluded.count, amount_count = amount_count + excluded.amount_count, "
+                    "amount_sum = amount_sum + excluded.amount_sum, share_count = share_count + excluded.share_count, share_sum = share_sum + excluded.share_sum",
+                    [[style, kind, name] + sums for style, kind, name, sums in deltas])
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def clear(self):
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM style_stats")
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+class SqliteDatabase(Database.Database):
+    """Implements the same page API as MongoDatabase, but in a local SQLite file (in WAL mode)."""
+
+    def __init__(self):
+        Database.Database.__init__(self)
+
+    def connect(self, db_file):
+        """Connects/creates the database"""
+        try:
+            self.db_file = db_file
+            self.conn = sqlite3.connect(db_file)
+            self.conn.create_function("REGEXP", 2, sqlite_regexp)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            with self.conn:
+                self.conn.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, host TEXT, last_visit_time REAL, style TEXT, page_source BLOB, page_source_ref TEXT, doc TEXT)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS pages_host ON pages (host)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS pages_last_visit_time ON pages (last_visit_time)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS pages_style ON pages (style)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS pages_canonical_style ON pages (" + doc_field_expression(Keys.CANONICAL_STYLE_KEY) + ")")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS page_sources (hash TEXT PRIMARY KEY, codec TEXT, data BLOB)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS tombstones (url TEXT PRIMARY KEY, deleted_time REAL)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS tombstones_deleted_time ON tombstones (deleted_time)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS page_versions (url TEXT, version_time REAL, is_full INTEGER, data BLOB)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS page_versions_url ON page_versions (url, version_time)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, module TEXT, version TEXT, result TEXT)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS extractions_module ON extractions (module, version)")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS style_stats (style TEXT, kind TEXT, name TEXT, count INTEGER, amount_count INTEGER, amount_sum REAL, share_count INTEGER, share_sum REAL, PRIMARY KEY (style, kind, name))")
+            if self.page_store is None:
+                self.page_store = SqlitePageStore(self.conn)
+            self.page_history = SqlitePageHistory(self.conn)
+            self.extraction_cache = SqliteExtractionCache(self.conn)
+            self.style_stats = SqliteStyleStats(self.conn)
+            return self.ensure_schema()
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def migrate_move_page_sources(self):
+        """Schema version 1: moves the page sources that were stored in the pages table into the page store, leaving a reference to each."""
+        while True:
+            rows = self.conn.execute("SELECT url, page_source FROM pages WHERE page_source IS NOT NULL LIMIT ?", (self.write_batch_size,)).fetchall()
+            if len(rows) == 0:
+                break
+            updates = []
+            for url, raw_content in rows:
+                ref = self.page_store.put(bytes(raw_content))
+                if ref is None:
+                    raise Exception("Failed to move the page source of " + url + " to the page store.")
+                updates.append((ref, url))
+
+            # The page sources have to be in the page store before the pages stop holding them.
+            if not self.page_store.flush():
+                raise Exception("Failed to write the page sources to the page store.")
+            with self.conn:
+                self.conn.executemany("UPDATE pages SET page_source = NULL, page_source_ref = ? WHERE url = ?", updates)
+
+    def ensure_schema(self):
+        """Brings the pages table up to the current schema version."""
+        try:
+            migrations = [ (1, self.migrate_move_page_sources) ]
+
+            # Apply any migrations the file hasn't had, recording progress after each one.
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for migration_version, migration in migrations:
+                if migration_version > version:
+                    migration()
+                    version = migration_version
+                    self.conn.execute("PRAGMA user_version = %d" % version)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def row_to_page(self, row):
+        """Converts a row (all of the columns, then the JSON document) into the same dictionary that MongoDatabase would return."""
+        page = {}
+        if row[-1]:
+            page.update(json.loads(row[-1]))
+        for key, value in zip(COLUMN_KEYS, row[:-1]):
+            if value is not None:
+                page[key] = bytes(value) if key == Keys.PAGE_SOURCE_KEY else value
+        return page
+
+    def page_to_row(self, url, page):
+        """Inverse of row_to_page."""
+        doc = {}
+        for key in page:
+            if key not in COLUMN_KEYS:
+                doc[key] = page[key]
+        row = [url]
+        for key in COLUMN_KEYS[1:]:
+            value = page.get(key)
+            if key == Keys.PAGE_SOURCE_KEY and value is not None:
+                value = sqlite3.Binary(PageStore.to_bytes(value))
+            row.append(value)
+        row.append(json.dumps(doc))
+        return row
+
+    def select_pages(self, where, params):
+        """Runs a SELECT of entire pages and returns a generator of page dictionaries."""
+        cursor = self.conn.execute("SELECT " + ", ".join(COLUMN_NAMES) + ", doc FROM pages " + where, params)
+        for row in cursor:
+            yield self.row_to_page(row)
+
+    def retrieve_page(self, url):
+        """Retrieve method for a webpage."""
+        try:
+            for page in self.select_pages("WHERE url = ?", (url,)):
+                return page
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_page_metadata(self, url):
+        """Retrieve method for a webpage that only returns the metadata fields (no page source or extracted content)."""
+        pages = self.retrieve_pages_metadata([url])
+        return pages.get(url)
+
+    def retrieve_pages_metadata(self, urls):
+        """Batched version of retrieve_page_metadata. Returns a dictionary that maps each of the given URLs that is in the database to its metadata."""
+        try:
+            pages = {}
+            urls = list(urls)
+            for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+                chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+                sql = "SELECT url, host, last_visit_time, page_source_ref FROM pages WHERE url IN (" + ",".join(["?"] * len(chunk)) + ")"
+                for row in self.conn.execute(sql, chunk):
+                    page = {}
+                    for key, value in zip(METADATA_KEYS, row):
+                        if value is not None:
+                            page[key] = value
+                    pages[row[0]] = page
+            return pages
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return {}
+
+    def retrieve_pages(self, urls, fields):
+        """Returns a dictionary that maps each of the given URLs that is in the database to its page, with only the given fields."""
+        try:
+            pages = {}
+            urls = list(urls)
+            fields = list(fields)
+            if Keys.URL_KEY not in fields:
+                fields.append(Keys.URL_KEY)
+            for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+                chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+                for page in self.stream_pages("WHERE url IN (" + ",".join(["?"] * len(chunk)) + ")", chunk, fields, Database.DEFAULT_QUERY_BATCH_SIZE):
+                    pages[page[Keys.URL_KEY]] = page
+            return pages
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_all_pages(self):
+        """Retrieve method for a webpage."""
+        try:
+            return self.select_pages("", ())
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def query_pages(self, host=None, style=None, style_is_regex=False, has_fields=None, fields=None, batch_size=Database.DEFAULT_QUERY_BATCH_SIZE, visited_since=None, canonical_style=None, missing_fields=None):
+        """Returns a generator over the pages that match all of the given criteria. See Database.query_pages."""
+        try:
+            conditions = []
+            params = []
+            if host is not None:
+                conditions.append("(host = ? OR host LIKE ?)")
+                params.extend([host, "%." + host])
+            if style is not None:
+                if style_is_regex:
+                    conditions.append("style REGEXP ?")
+                    params.append(style)
+                else:
+                    conditions.append("instr(lower(style), ?) > 0")
+                    params.append(style.lower())
+            if canonical_style is not None:
+                conditions.append(doc_field_expression(Keys.CANONICAL_STYLE_KEY) + " = ?")
+                params.append(canonical_style)
+            if has_fields is not None:
+                for field in has_fields:
+                    if field in COLUMN_NAME_FOR_KEY:
+                        conditions.append(COLUMN_NAME_FOR_KEY[field] + " IS NOT NULL")
+                    else:
+                        conditions.append("json_type(doc, ?) IS NOT NULL")
+                        params.append('$."' + field.replace('"', '\\"') + '"')
+            if missing_fields is not None:
+                for field in missing_fields:
+                    if field in COLUMN_NAME_FOR_KEY:
+                        conditions.append(COLUMN_NAME_FOR_KEY[field] + " IS NULL")
+                    else:
+                        conditions.append(doc_field_expression(field) + " IS NULL")
+            if visited_since is not None:
+                conditions.append("last_visit_time > ?")
+                params.append(visited_since)
+            where = ""
+            if len(conditions) > 0:
+                where = "WHERE " + " AND ".join(conditions)
+            return self.stream_pages(where, params, fields, batch_size)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def distinct_values(self, field):
+        """Returns the list of the distinct values of the field across all pages. Uses the field's index, if it has one."""
+        try:
+            if field in COLUMN_NAME_FOR_KEY:
+                expression = COLUMN_NAME_FOR_KEY[field]
+            else:
+                expression = doc_field_expression(field)
+            cursor = self.conn.execute("SELECT DISTINCT " + expression + " FROM pages WHERE " + expression + " IS NOT NULL")
+            return [row[0] for row in cursor]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def stream_pages(self, where, params, fields, batch_size):
+        """Generator for query_pages. Only reads the columns that are needed for the requested fields."""
+        if fields is None:
+            for page in self.select_pages(where, params):
+                yield page
+            return
+
+        # Only read the JSON document if one of the requested fields lives in it.
+        column_keys = [key for key in COLUMN_KEYS if key in fields]
+        need_doc = len(column_keys) < len(fields)
+        columns = [COLUMN_NAME_FOR_KEY[key] for key in column_keys]
+        if need_doc:
+            columns.append("doc")
+        if len(columns) == 0:
+            columns.append("url")
+        cursor = self.conn.execute("SELECT " + ", ".join(columns) + " FROM pages " + where, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                page = {}
+                if need_doc and row[-1]:
+                    doc = json.loads(row[-1])
+                    for field in fields:
+                        if field in doc:
+                            page[field] = doc[field]
+                for key, value in zip(column_keys, row):
+                    if value is not None:
+                        page[key] = bytes(value) if key == Keys.PAGE_SOURCE_KEY else value
+                yield page
+
+    def delete_page(self, url, deleted_time):
+        """Deletes the page, if it exists, and leaves a tombstone so that incremental exports know it is gone."""
+        try:
+            self.discard_pending_write(url)
+            if not self.notify_page_observers([(url, None)]):
+                return False
+            with self.conn:
+                cursor = self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+                if cursor.rowcount > 0:
+                    self.conn.execute("INSERT OR REPLACE INTO tombstones (url, deleted_time) VALUES (?, ?)", (url, deleted_time))
+            return self.finish_page_observers(True)
+        except:
+            self.finish_page_observers(False)
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_tombstones(self, since):
+        """Returns a generator over the tombstones of the pages deleted after the given time."""
+        try:
+            cursor = self.conn.execute("SELECT url, deleted_time FROM tombstones WHERE deleted_time > ?", (since,))
+            return ({ Keys.URL_KEY: row[0], Keys.DELETED_TIME_KEY: row[1] } for row in cursor)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def bulk_upsert_pages(self, writes):
+        """Writes a list of (url, fields) tuples in a single transaction, merging the fields into any existing pages."""
+        """If the transaction fails then the pages are written one at a time, so that only the ones with errors fail. See Database.bulk_upsert_pages."""
+        try:
+            # Read the existing pages so the new fields can be merged into them.
+            urls = [url for url, _ in writes]
+            existing = {}
+            for i in range(0, len(urls), SQLITE_MAX_VARIABLES):
+                chunk = urls[i:i + SQLITE_MAX_VARIABLES]
+                for page in self.select_pages("WHERE url IN (" + ",".join(["?"] * len(chunk)) + ")", chunk):
+                    existing[page[Keys.URL_KEY]] = page
+
+            # A page that can't be turned into a row, e.g. because a field can't be serialized, can never be written.
+            failures = []
+            rows = []
+            row_writes = []
+            for url, fields in writes:
+                page = existing.get(url, {})
+                page.update(fields)
+                try:
+                    rows.append(self.page_to_row(url, page))
+                    row_writes.append((url, fields))
+                except (TypeError, ValueError):
+                    self.log_error("ERROR: Failed to write " + url + ": " + str(sys.exc_info()[1]))
+                    failures.append((url, fields, True))
+
+            try:
+                with self.conn:
+                    self.conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                return failures
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error:
+                self.log_error(traceback.format_exc())
+
+            # Find the rows with errors.
+            for row, (url, fields) in zip(rows, row_writes):
+                try:
+                    with self.conn:
+                        self.conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+                except sqlite3.OperationalError:
+                    failures.append((url, fields, False))
+                except sqlite3.Error:
+                    self.log_error("ERROR: Failed to write " + url + ": " + str(sys.exc_info()[1]))
+                    failures.append((url, fields, True))
+            return failures
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return [(url, fields, False) for url, fields in writes]
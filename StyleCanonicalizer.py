@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Maps the many ways of writing a beer style ("21A. American IPA", "IPA - American") to one canonical name"""
+
+# The rules file is JSON with the following items:
+#   "styles": maps each style code, e.g. "21A", to the canonical name of that style.
+#   "aliases": maps other names for a style to its canonical name.
+#
+# Names are compared by a key that ignores case, accents, punctuation and word order. A leading style code is removed
+# before the name is looked up, and is only used if the name isn't recognized, since sites use codes from different
+# versions of the guidelines. Names that still aren't recognized are fuzzy matched against the known ones and, failing
+# that, are only cleaned up. Results are memoized.
+
+import difflib
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+DEFAULT_STYLE_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BjcpStyles.json')
+FUZZY_CUTOFF = 0.88 # Minimum similarity, between 0 and 1, for a fuzzy match
+
+CODE_PATTERN = re.compile(r"^\s*(\d{1,2}[a-z]?)\b\s*[.:)\-]?\s*", re.IGNORECASE)
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def make_key(name):
+    """Returns the key by which names are compared: the lower case, unaccented words, sorted."""
+    decomposed = unicodedata.normalize('NFKD', name)
+    plain = "".join([c for c in decomposed if not unicodedata.combining(c)]).lower()
+    return " ".join(sorted(WORD_PATTERN.findall(plain)))
+
+class StyleCanonicalizer(object):
+    """Compiled set of style rules."""
+
+    def __init__(self, rules):
+        """Constructor. Builds the lookup tables from the rules, which are a dictionary in the format described above."""
+        self.codes = {}
+        self.names = {} # Key -> canonical name
+        for code, name in rules.get('styles', {}).items():
+            self.codes[code.lower()] = name
+            self.names[make_key(name)] = name
+        for alias, name in rules.get('aliases', {}).items():
+            self.names.setdefault(make_key(alias), name)
+        self.canonical_names = set(self.codes.values())
+        self.known_keys = list(self.names.keys())
+        self.memo = {}
+        self.digest = hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest() # Changes whenever the rules do
+        super(StyleCanonicalizer, self).__init__()
+
+    def canonicalize_uncached(self, style):
+        """Applies the rules to the style."""
+        code = None
+        name = style
+        match = CODE_PATTERN.match(style)
+        if match is not None:
+            code = match.group(1).lower()
+            name = style[match.end():]
+
+        # Sites often follow the style with a variant, e.g. "Specialty IPA: Black IPA".
+        key = make_key(name)
+        if key in self.names:
+            return self.names[key]
+        if name.find(':') > 0:
+            base_key = make_key(name.split(':')[0])
+            if base_key in self.names:
+                return self.names[base_key]
+        if code is not None and code in self.codes:
+            return self.codes[code]
+        if len(key) > 0:
+            close_keys = difflib.get_close_matches(key, self.known_keys, 1, FUZZY_CUTOFF)
+            if len(close_keys) > 0:
+                return self.names[close_keys[0]]
+        return " ".join(name.split())
+
+    def canonicalize(self, style):
+        """Returns the canonical name of the style, or an empty string if there isn't a style."""
+        if style is None:
+            return ""
+        canonical_style = self.memo.get(style)
+        if canonical_style is None:
+            canonical_style = self.canonicalize_uncached(style)
+            self.memo[style] = canonical_style
+        return canonical_style
+
+    def is_known(self, canonical_style):
+        """Returns TRUE if the canonical style is one of the styles in the rules, rather than a cleaned up unknown one."""
+        return canonical_style in self.canonical_names
+
+def load_canonicalizer(file_name):
+    """Creates a canonicalizer from a JSON rules file."""
+    with open(file_name, 'r') as f:
+        return StyleCanonicalizer(json.load(f))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# MIT License
+#
+# Copyright (c) 2020 Mike Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Per style ingredient statistics, stored as running sums that are kept up to date as recipes are written"""
+
+# Each (style, kind, ingredient) has a count of the recipes that use it and running sums of its amounts and grist
+# shares. Adding a recipe adds to them, and replacing or deleting one subtracts what the old version added, so the
+# statistics for a style are a single indexed lookup. Amounts are stored per gallon of yield, so only the amounts of
+# recipes with a known yield contribute to the means. Percentiles can't be kept this way and are None.
+
+import logging
+import IngredientStats
+
+STYLE_KEY = 'style'
+KIND_KEY = 'kind'
+NAME_KEY = 'name'
+COUNT_KEY = 'count'
+AMOUNT_COUNT_KEY = 'amount count'
+AMOUNT_SUM_KEY = 'amount sum'
+SHARE_COUNT_KEY = 'share count'
+SHARE_SUM_KEY = 'share sum'
+SUM_KEYS = [COUNT_KEY, AMOUNT_COUNT_KEY, AMOUNT_SUM_KEY, SHARE_COUNT_KEY, SHARE_SUM_KEY]
+RECIPES_KIND = '' # Kind, and name, under which the number of recipes of each style is kept
+
+class StyleStats(object):
+    """Base class for the per style ingredient statistics store. The child class provides the storage primitives."""
+
+    def __init__(self):
+        self.pending = {} # (style, kind, name) -> list of deltas, in the order of SUM_KEYS, flushed along with the page writes
+        super(StyleStats, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def add_delta(self, style, kind, name, deltas):
+        """Buffers changes to the sums of one ingredient."""
+        key = (style, kind, name)
+        sums = self.pending.get(key)
+        if sums is None:
+            self.pending[key] = list(deltas)
+        else:
+            for i, delta in enumerate(deltas):
+                sums[i] = sums[i] + delta
+
+    def add_recipe(self, style, yield_gallons, ingredients, grist_kind=None, sign=1):
+        """Adds a recipe to the statistics, or subtracts it if sign is -1. ingredients maps each kind to a list of (name, amount)"""
+        """tuples, where the amount may be None. The amounts of the grist kind are used to compute each ingredient's share of the grist."""
+        self.add_delta(style, RECIPES_KIND, RECIPES_KIND, [sign, 0, 0.0, 0, 0.0])
+
+        grist_total = 0.0
+        if grist_kind is not None:
+            grist_total = sum([amount for _, amount in ingredients.get(grist_kind, []) if amount is not None])
+
+        for kind, items in ingredients.items():
+            for name, amount in items:
+                deltas = [sign, 0, 0.0, 0, 0.0]
+                if amount is not None and yield_gallons:
+                    deltas[1] = sign
+                    deltas[2] = sign * amount / yield_gallons
+                if kind == grist_kind and amount is not None and grist_total > 0:
+                    deltas[3] = sign
+                    deltas[4] = sign * amount / grist_total
+                self.add_delta(style, kind, name, deltas)
+
+    def remove_recipe(self, style, yield_gallons, ingredients, grist_kind=None):
+        """Subtracts what add_recipe added for the same recipe."""
+        self.add_recipe(style, yield_gallons, ingredients, grist_kind, -1)
+
+    def discard(self):
+        """Forgets the buffered changes, for when the page writes they came from failed."""
+        self.pending = {}
+
+    def flush(self):
+        """Writes the buffered changes."""
+        if len(self.pending) == 0:
+            return True
+        deltas = [(style, kind, name, sums) for (style, kind, name), sums in self.pending.items()]
+        self.pending = {}
+        return self.save_deltas(deltas)
+
+    def retrieve_style(self, style, kinds, grist_kind=None, desired_yield=1.0):
+        """Returns the statistics of the given style in the same form as one style of IngredientStats.compute, or None if there"""
+        """aren't any recipes of that style. Means are scaled to the desired yield."""
+        rows = self.load_style(style)
+        if rows is None:
+            return None
+        stats = { IngredientStats.RECIPES_KEY: 0 }
+        for kind in kinds:
+            stats[kind] = []
+        for kind, name, sums in rows:
+            count, amount_count, amount_sum, share_count, share_sum = sums
+            if count <= 0:
+                continue
+            if kind == RECIPES_KIND:
+                stats[IngredientStats.RECIPES_KEY] = count
+                continue
+            if kind not in stats:
+                continue
+            item_stats = {}
+            item_stats[IngredientStats.NAME_KEY] = name
+            item_stats[IngredientStats.COUNT_KEY] = count
+            item_stats[IngredientStats.MEAN_KEY] = amount_sum / amount_count * desired_yield if amount_count > 0 else None
+            item_stats[IngredientStats.MEDIAN_KEY] = None
+            item_stats[IngredientStats.P10_KEY] = None
+            item_stats[IngredientStats.P90_KEY] = None
+            if kind == grist_kind:
+                item_stats[IngredientStats.SHARE_KEY] = share_sum / share_count if share_count > 0 else None
+            stats[kind].append(item_stats)
+        if stats[IngredientStats.RECIPES_KEY] == 0:
+            return None
+
+        # Most used first, then alphabetically.
+        for kind in kinds:
+            stats[kind].sort(key=lambda item_stats: (-item_stats[IngredientStats.COUNT_KEY], item_stats[IngredientStats.NAME_KEY]))
+        return stats
+
+    def retrieve_styles(self):
+        """Returns a dictionary that maps each style to its number of recipes."""
+        return self.load_styles()
+
+    def load_style(self, style):
+        """Returns a list of (kind, name, sums) tuples, with the sums in the order of SUM_KEYS, for the given style, or None on error."""
+        """To be overridden in the child class."""
+        return None
+
+    def load_styles(self):
+        """Returns a dictionary that maps each style that has recipes to its number of recipes."""
+        """To be overridden in the child class."""
+        return {}
+
+    def save_deltas(self, deltas):
+        """Adds a list of (style, kind, name, deltas) tuples, with the deltas in the order of SUM_KEYS, to the stored sums, in bulk."""
+        """To be overridden in the child class."""
+        return False
+
+    def clear(self):
+        """Deletes all of the statistics, so that they can be rebuilt."""
+        """To be overridden in the child class."""
+        return False